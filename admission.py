@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+class QueueFullError(Exception):
+    """排隊已滿，請求被拒絕"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """單個請求的排隊憑證"""
+
+    def __init__(self, ip: str, task_id: str):
+        self.ip = ip
+        self.task_id = task_id
+        self.enqueued_at = time.time()
+        self.granted_at = None
+        self.released = False
+        self._granted = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def on_granted(self, callback):
+        """註冊獲准入時執行的回調（已獲准入時立即執行）
+
+        回調在授予名額的線程中執行（通常是釋放名額的請求），應當快速返回，
+        例如以 loop.call_soon_threadsafe 喚醒等待中的協程。
+        """
+        with self._callbacks_lock:
+            if not self._granted.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _grant(self):
+        with self._callbacks_lock:
+            self._granted.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"執行准入回調失敗: {e}")
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.is_set()
+
+    @property
+    def wait_seconds(self) -> float:
+        """排隊等待的秒數"""
+        end = self.granted_at if self.granted_at is not None else time.time()
+        return end - self.enqueued_at
+
+class AdmissionController:
+    """RAG 任務的准入控制器
+
+    - 全局限制同時執行的 LLM 任務數
+    - 各 IP 之間以輪詢方式公平排隊（同一 IP 開多個分頁不會插隊）
+    - 排隊總數或單一 IP 的排隊數超出上限時直接拒絕，並給出建議的重試秒數
+
+    控制器是進程內的：多 worker 部署時，全局上限按 worker 計算。
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_queue_depth: int = 20,
+                 max_queue_per_ip: int = 3, default_task_seconds: float = 90.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_per_ip = max_queue_per_ip
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # {ip: deque[AdmissionTicket]}，順序即輪詢順序
+        self._active = {}  # {task_id: AdmissionTicket}
+        self._avg_task_seconds = default_task_seconds
+        self.rejected_count = 0
+
+    def _queued_count(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _retry_after(self) -> int:
+        """按平均任務耗時估算建議的重試秒數"""
+        waves = (self._queued_count() // max(self.max_concurrent, 1)) + 1
+        return int(waves * self._avg_task_seconds)
+
+    def _dispatch(self):
+        """在有空閒名額時，按 IP 輪詢授予排隊中的請求"""
+        while len(self._active) < self.max_concurrent and self._queues:
+            ip, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            # 已服務的 IP 移到輪詢隊尾
+            del self._queues[ip]
+            if queue:
+                self._queues[ip] = queue
+            ticket.granted_at = time.time()
+            self._active[ticket.task_id] = ticket
+            ticket._grant()
+
+    def enqueue(self, ip: str, task_id: str) -> AdmissionTicket:
+        """請求准入，排隊已滿時拋出 QueueFullError"""
+        with self._lock:
+            queue = self._queues.get(ip)
+            if self._queued_count() >= self.max_queue_depth:
+                self.rejected_count += 1
+                raise QueueFullError("目前排隊人數過多", self._retry_after())
+            if queue is not None and len(queue) >= self.max_queue_per_ip:
+                self.rejected_count += 1
+                raise QueueFullError("您已有多個問題在排隊中", self._retry_after())
+
+            ticket = AdmissionTicket(ip, task_id)
+            if queue is None:
+                self._queues[ip] = deque()
+            self._queues[ip].append(ticket)
+            self._dispatch()
+            return ticket
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        """返回請求在輪詢順序下的排隊位置（1 表示下一個），已獲准入時返回 0"""
+        with self._lock:
+            if ticket.granted or ticket.released:
+                return 0
+            queue = self._queues.get(ticket.ip)
+            if queue is None or ticket not in queue:
+                return 0
+            order = list(self._queues.keys())
+            my_rank = order.index(ticket.ip)
+            depth = list(queue).index(ticket)
+            position = 0
+            for rank, ip in enumerate(order):
+                if ip == ticket.ip:
+                    position += depth + 1
+                    continue
+                # 輪詢順序中排在前面的 IP 每輪都先被服務，排在後面的少服務一輪
+                position += min(len(self._queues[ip]), depth + 1 if rank < my_rank else depth)
+            return position
+
+    def wait(self, ticket: AdmissionTicket, timeout: Optional[float] = None) -> bool:
+        """阻塞等待准入，返回是否已獲准入"""
+        return ticket._granted.wait(timeout)
+
+    def release(self, ticket: AdmissionTicket):
+        """釋放名額（或取消仍在排隊中的請求）"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.task_id in self._active:
+                del self._active[ticket.task_id]
+                # 以指數移動平均更新任務耗時，用於估算重試時間
+                duration = time.time() - ticket.granted_at
+                self._avg_task_seconds = 0.8 * self._avg_task_seconds + 0.2 * duration
+            else:
+                queue = self._queues.get(ticket.ip)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[ticket.ip]
+            self._dispatch()
+
+    def stats(self) -> Dict:
+        """當前狀態，供監控使用"""
+        with self._lock:
+            return {
+                'active': len(self._active),
+                'queued': self._queued_count(),
+                'queued_ips': len(self._queues),
+                'max_concurrent': self.max_concurrent,
+                'max_queue_depth': self.max_queue_depth,
+                'rejected': self.rejected_count,
+                'avg_task_seconds': round(self._avg_task_seconds, 1),
+            }
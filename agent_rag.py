@@ -1,31 +1,151 @@
-import autogen
 import ollama
 from typing import List, Dict
 import json
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import TextLoader, PyPDFLoader
 import os
 import glob
-import pandas as pd
-from docx import Document
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 import uuid
 import time
-from opencc import OpenCC
+import threading
+from collections import deque
+from functools import lru_cache
+
+# langchain、pandas、python-docx、sklearn、opencc 等重量級依賴
+# 均在首次使用時才導入，以縮短應用啟動與測試收集時間
 
 # 導入自定義的 JSONVectorDB
 from vector_db import JSONVectorDB
+from reranker import get_reranker, rerank
+from context_builder import pack_context, get_token_counter, expanded_content
+from ticket_splitter import iter_ticket_chunks
+from query_expansion import QUERY_EXPANSION_SYSTEM_MESSAGE, rule_variants, parse_llm_variants, merge_variants
+from telemetry import span, traced
+from cancellation import CancellationToken, TaskCancelled, CANCELLATIONS, run_cancellable
+
+# 文檔篩選代理的系統提示詞
+DOCUMENT_FILTER_SYSTEM_MESSAGE = """您是東擎科技(ASRock Industrial)技術支援部門(TSD)的專業文檔篩選專家。您的任務是:
+1.仔細閱讀提供的文檔內容
+2.精確判斷歷史技術支援文檔是否與用戶查詢相關。
+3.客戶必須與用戶問題的客戶匹配
+4.如果相關，返回 "RELEVANT: [相關原因]"
+5.如果不相關，返回 "NOT_RELEVANT: [不相關原因]"
+6.請只返回判斷結果，不要添加其他內容。
+
+**型號識別規則**：
+    - 4x4-7XXX = 7000系列
+    - 4x4-6XXX = 6000系列  
+    - 4x4-5XXX = 5000系列
+    - 依此類推
+    - NUC MTL = NUC 125 155
+"""
+
+# 答案整合代理的系統提示詞
+ANSWER_SYNTHESIZER_SYSTEM_MESSAGE = """您是答案整合專家。您的任務是：
+1. 基於篩選後的相關文檔，為用戶問題提供綜合性答案
+2. 整合所有相關信息，提供完整且準確的回答
+3. 如果信息不足，請明確指出
+4. 使用繁體中文回答
+請提供詳細、有用的答案。"""
+
+@lru_cache(maxsize=1)
+def _get_s2t_converter():
+    """延遲建立並快取簡轉繁轉換器"""
+    from opencc import OpenCC
+    return OpenCC('s2t')  # 簡體到繁體
+
+def _text_splitter(chunk_size: int, chunk_overlap: int):
+    """延遲導入 langchain 並建立文本分割器"""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+    )
+
+def _ollama_host() -> str:
+    """Ollama 服務地址；OLLAMA_HOST 可省略協議與端口（例如 127.0.0.1:11500）"""
+    host = os.environ.get('OLLAMA_HOST', '').strip() or 'localhost:11434'
+    if '://' not in host:
+        host = f"http://{host}"
+    scheme, _, address = host.partition('://')
+    if ':' not in address.split('/')[0]:
+        address = f"{address.rstrip('/')}:11434"
+    return f"{scheme}://{address.rstrip('/')}"
+
+_loop_clients = {}
+_loop_clients_lock = threading.Lock()
+
+def _loop_client(host: str) -> ollama.AsyncClient:
+    """同步流程中可取消的 Ollama 呼叫所用的客戶端（只在 cancellation 的背景事件循環中使用）"""
+    with _loop_clients_lock:
+        if host not in _loop_clients:
+            _loop_clients[host] = ollama.AsyncClient(host=host)
+        return _loop_clients[host]
 
 def convert_to_traditional(text: str) -> str:
     """將簡體中文轉換為繁體中文"""
-    cc = OpenCC('s2t')  # 簡體到繁體
-    return cc.convert(text)
+    return _get_s2t_converter().convert(text)
+
+class SpeculativeSynthesis:
+    """投機生成：篩選仍在進行時，以已確認的相關文檔在背景線程中提前生成答案
+    
+    篩選結束後，若最終的相關文檔集合與投機時相同，直接採用投機結果；
+    否則丟棄並以最終集合重新生成。同一時間最多只有一個投機生成在執行。
+    """
+    
+    def __init__(self, rag_system, question: str):
+        self.rag_system = rag_system
+        self.question = question
+        self.started = 0
+        self._thread = None
+        self._keys = None
+        self._answer = None
+        self._token = None
+    
+    def maybe_start(self, relevant_docs: List[Dict]):
+        """相關文檔集合有變化且沒有投機生成在執行時，以當前集合開始生成"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        keys = [self.rag_system._doc_key(doc) for doc in relevant_docs]
+        if not keys or keys == self._keys:
+            return
+        self._keys = keys
+        self._answer = None
+        # 子令牌：任務取消時一併取消，投機結果被丟棄時單獨取消
+        self._token = self.rag_system.cancel_token.child()
+        self._thread = threading.Thread(target=self._run, args=(list(relevant_docs),), daemon=True)
+        self._thread.start()
+        self.started += 1
+        print(f"以 {len(keys)} 個已確認的相關文檔開始投機生成答案")
+    
+    def _run(self, docs: List[Dict]):
+        try:
+            self._answer = self.rag_system.generate_answer(self.question, docs, cancel_token=self._token)
+        except Exception as e:
+            print(f"投機生成答案失敗: {e}")
+            self._answer = None
+    
+    def result(self, relevant_docs: List[Dict]):
+        """返回可採用的投機答案；集合不同或生成失敗時返回 None"""
+        if self._thread is None:
+            return None
+        keys = [self.rag_system._doc_key(doc) for doc in relevant_docs]
+        if keys != self._keys:
+            # 丟棄的投機生成不再佔用 Ollama
+            self._token.cancel('speculation discarded')
+            return None
+        self._thread.join()
+        return self._answer
+    
+    def cancel(self):
+        """放棄投機生成（查詢出錯或客戶端斷開時），中止進行中的 Ollama 呼叫"""
+        if self._token is not None:
+            self._token.cancel('speculation discarded')
 
 class CustomRAGAgentSystem:
-    def __init__(self, reset_db=False, db_path="./custom_json_rag_db"):
-        # Ollama配置
-        self.base_url = "http://localhost:11434/v1"
+    def __init__(self, reset_db=False, db_path="./custom_json_rag_db", collection=None):
+        # Ollama配置（與 ollama 套件相同，可由 OLLAMA_HOST 指定）
+        self.ollama_host = _ollama_host()
         self.embedding_model = "tsd_4500datas_summary20250606_epoch11_f32:latest"
         self.llm_model = "qwen3:30b"
         # self.llm_model = "gemma3:27b"
@@ -36,8 +156,11 @@ class CustomRAGAgentSystem:
             import shutil
             shutil.rmtree(db_path)
         
-        # 創建自定義資料庫實例
-        self.collection = JSONVectorDB(db_path)
+        # 創建自定義資料庫實例（可共享已載入的實例，避免每個請求重新讀取索引）
+        if collection is not None and not reset_db:
+            self.collection = collection
+        else:
+            self.collection = JSONVectorDB(db_path)
         
         # 如果需要重置
         if reset_db:
@@ -47,92 +170,66 @@ class CustomRAGAgentSystem:
             except:
                 pass
         
-        # AutoGen配置
-        self.config_list = [
-            {
-                'base_url': self.base_url,
-                'api_key': "fakekey",
-                'model': self.llm_model,
-            }
-        ]
-        
-        self.llm_config = {
-            "config_list": self.config_list,
-            "temperature": 0.0,
-        }
+        # 篩選與答案生成的取樣溫度
+        self.temperature = 0.0
         
-        # 添加任務中斷標誌
-        self._stop_flag = False
+        # 每篩選完一個文檔後的等待秒數
+        self.filter_interval = float(os.environ.get('TSD_FILTER_INTERVAL', 12))
         
-        self.setup_agents()
+        # 向量搜索與 LLM 篩選之間的重排階段（TSD_RERANKER 未設置時不重排）
+        # 啟用時先取 rerank_candidates 個候選，重排並套用分數門檻後只把前幾個交給 LLM 篩選
+        self.rerank_candidates = int(os.environ.get('TSD_RERANK_CANDIDATES', 12))
+        min_score = os.environ.get('TSD_RERANK_MIN_SCORE')
+        self.rerank_min_score = float(min_score) if min_score else None
+        
+        # 提前終止：確認 early_stop_relevant 個相關文檔後（0 表示關閉），
+        # 或下一個候選的相似度低於 similarity_floor 時，停止篩選其餘文檔
+        self.early_stop_relevant = int(os.environ.get('TSD_EARLY_STOP_RELEVANT', 0))
+        similarity_floor = os.environ.get('TSD_SIMILARITY_FLOOR')
+        self.similarity_floor = float(similarity_floor) if similarity_floor else None
+        # 查詢改寫：none（預設）、rules（型號規則與中英術語對照）、llm（另以 LLM 改寫，失敗時只用規則）
+        # 原問題與最多 query_expansion_max 個改寫以一次嵌入呼叫計算，搜索時合併評分
+        self.query_expansion = os.environ.get('TSD_QUERY_EXPANSION', 'none').lower()
+        self.query_expansion_max = int(os.environ.get('TSD_QUERY_EXPANSION_MAX', 3))
+        self.query_expansion_model = os.environ.get('TSD_QUERY_EXPANSION_MODEL') or self.llm_model
+        # txt / md / pdf 的切分方式: fixed（固定 850 字元）或 records（按「編號與日期」紀錄，每筆工單一個片段，
+        # 超過 record_max_chars 時再切分），records 模式的片段帶有各自的工單編號與日期
+        self.chunking = os.environ.get('TSD_CHUNKING', 'fixed').lower()
+        self.record_max_chars = int(os.environ.get('TSD_RECORD_MAX_CHARS', 1500))
+        # 每個命中片段附帶前後各 neighbor_chunks 個相鄰片段（0 表示關閉），篩選與答案生成時一併提供給 LLM
+        self.neighbor_chunks = int(os.environ.get('TSD_NEIGHBOR_CHUNKS', 0))
+        # Ollama 模型常駐時間：篩選呼叫之間模型與其 KV 快取（共享的提示詞前綴）保持載入
+        self.keep_alive = os.environ.get('TSD_OLLAMA_KEEP_ALIVE', '30m')
+        # 所有呼叫使用相同的 num_ctx，避免因參數不同而重新載入模型
+        num_ctx = os.environ.get('TSD_OLLAMA_NUM_CTX')
+        self.num_ctx = int(num_ctx) if num_ctx else None
+        # 本任務各階段的追蹤區段（保存到歷史紀錄）
+        self.span_log = deque(maxlen=500)
+        # 本任務中 LLM 呼叫的提示詞 token 統計（prefill 被前綴快取省下的部分）
+        self.prefill_stats = {'calls': 0, 'prompt_tokens': 0, 'evaluated_tokens': 0, 'avoided_tokens': 0}
+        
+        # 答案整合提示詞中文檔上下文的 token 預算（未設定或 0 時不限制，所有相關文檔完整放入）
+        context_token_budget = int(os.environ.get('TSD_CONTEXT_TOKEN_BUDGET') or 0)
+        self.context_token_budget = context_token_budget if context_token_budget > 0 else None
+        # 投機生成：篩選進行中即以已確認的相關文檔開始生成答案
+        self.speculative_synthesis = os.environ.get('TSD_SPECULATIVE_SYNTHESIS', '').lower() in ('1', 'true', 'yes')
+        
+        # 任務取消令牌：取消時打斷等待並中止進行中的 Ollama 呼叫
+        self.cancel_token = CancellationToken()
     
-    def stop_current_task(self):
-        """設置停止標誌"""
-        self._stop_flag = True
-        print("任務停止標誌已設置")
+    def stop_current_task(self, reason: str = 'stop'):
+        """取消任務（reason 記入 tsd_cancellations_total，例如 disconnect、page_reload、shutdown）"""
+        if self.cancel_token.cancel(reason):
+            CANCELLATIONS.inc(trigger=reason)
+            print(f"任務已取消: {reason}")
+    
+    @property
+    def _stop_flag(self) -> bool:
+        return self.cancel_token.cancelled
     
     def _check_stop_flag(self):
         """檢查是否應該停止任務"""
-        if self._stop_flag:
-            raise Exception("任務已被用戶中斷")
-    
-    def setup_agents(self):
-        """設置AutoGen代理"""
-        
-        # 文檔篩選代理
-        self.document_filter = autogen.AssistantAgent(
-            name="DocumentFilter",
-            llm_config=self.llm_config,
-#             system_message="""您是文檔篩選專家。您的任務是：
-# 1. 仔細閱讀提供的文檔內容
-# 2. 判斷文檔是否與用戶問題相關
-# 3. 如果相關，返回 "RELEVANT: [相關原因]"
-# 4. 如果不相關，返回 "NOT_RELEVANT: [不相關原因]"
-# 5. 請保持客觀和準確的判斷
-# 請只返回判斷結果，不要添加其他內容。"""
-#             system_message="""您是東擎科技(ASRock Industrial)技術支援部門(TSD)的專業文檔篩選專家。您的任務是:
-# 1.仔細閱讀提供的文檔內容
-# 2.精確判斷歷史技術支援文檔是否與用戶查詢相關。
-#     **篩選標準（必須同時滿足）：**
-#     **產品型號**：文檔中的產品型號必須與用戶詢問的型號一致，但有時候會有系列的問題可以以常理判斷
-#     **型號識別規則**：
-#     - 4x4-7XXX = 7000系列
-#     - 4x4-6XXX = 6000系列  
-#     - 4x4-5XXX = 5000系列
-#     - 依此類推
-#     **客戶**：文檔中的客戶必須與用戶查詢的問題匹配
-#     **問題類型相關**：文檔中描述的技術問題必須與用戶查詢的問題類型相關
-# 3. 如果相關，返回 "RELEVANT: [相關原因]"
-# 4. 如果不相關，返回 "NOT_RELEVANT: [不相關原因]"
-# 5.請只返回判斷結果，不要添加其他內容。"""
-        system_message="""您是東擎科技(ASRock Industrial)技術支援部門(TSD)的專業文檔篩選專家。您的任務是:
-1.仔細閱讀提供的文檔內容
-2.精確判斷歷史技術支援文檔是否與用戶查詢相關。
-3.客戶必須與用戶問題的客戶匹配
-4.如果相關，返回 "RELEVANT: [相關原因]"
-5.如果不相關，返回 "NOT_RELEVANT: [不相關原因]"
-6.請只返回判斷結果，不要添加其他內容。
-
-**型號識別規則**：
-    - 4x4-7XXX = 7000系列
-    - 4x4-6XXX = 6000系列  
-    - 4x4-5XXX = 5000系列
-    - 依此類推
-    - NUC MTL = NUC 125 155
-"""
-        )
-        
-        # 答案整合代理
-        self.answer_synthesizer = autogen.AssistantAgent(
-            name="AnswerSynthesizer",
-            llm_config=self.llm_config,
-            system_message="""您是答案整合專家。您的任務是：
-1. 基於篩選後的相關文檔，為用戶問題提供綜合性答案
-2. 整合所有相關信息，提供完整且準確的回答
-3. 如果信息不足，請明確指出
-4. 使用繁體中文回答
-請提供詳細、有用的答案。"""
-        )
+        self.cancel_token.raise_if_cancelled()
     
     def add_documents_from_directory(self, directory_path: str, file_patterns: List[str] = None):
         """從資料夾載入所有文檔到RAG資料庫"""
@@ -187,11 +284,13 @@ class CustomRAGAgentSystem:
         print(f"\n載入完成: 成功處理 {successful_files}/{total_files} 個文件")
         return successful_files > 0
     
+    @traced('ingest.docx')
     def add_word_document(self, file_path: str, original_filename: str = None):
         """處理Word文檔 (.docx, .doc)"""
         try:
             print(f"正在處理Word文檔: {file_path}")
             
+            from docx import Document
             doc = Document(file_path)
             
             full_text = []
@@ -219,11 +318,7 @@ class CustomRAGAgentSystem:
                 print(f"警告: Word文檔 {file_path} 沒有文本內容")
                 return False
             
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=850,
-                chunk_overlap=100,
-                length_function=len,
-            )
+            text_splitter = _text_splitter(chunk_size=850, chunk_overlap=100)
             chunks = text_splitter.split_text(text)
             
             ids = []
@@ -232,7 +327,8 @@ class CustomRAGAgentSystem:
             metadatas = []
             
             for i, chunk in enumerate(chunks):
-                response = ollama.embed(model=self.embedding_model, input=chunk)
+                with span('ingest.embed'):
+                    response = ollama.embed(model=self.embedding_model, input=chunk)
                 embedding = response["embeddings"][0]
                 
                 doc_id = f"{os.path.basename(file_path)}_{i}"
@@ -243,6 +339,7 @@ class CustomRAGAgentSystem:
                     "source": file_path, 
                     "chunk_id": i, 
                     "file_type": "docx",
+                    "chunk_overlap": 100,
                     "original_filename": original_filename if original_filename else os.path.basename(file_path),
                     "paragraphs_count": len(doc.paragraphs),
                     "tables_count": len(doc.tables)
@@ -264,11 +361,14 @@ class CustomRAGAgentSystem:
             print(f"添加Word文檔失敗: {e}")
             return False
     
+    @traced('ingest.excel')
     def add_excel_document(self, file_path: str, original_filename: str = None):
         """處理Excel文檔 (.xlsx, .xls)"""
         try:
             print(f"正在處理Excel文檔: {file_path}")
             
+            import pandas as pd
+            
             try:
                 excel_file = pd.ExcelFile(file_path)
                 sheet_names = excel_file.sheet_names
@@ -319,11 +419,7 @@ class CustomRAGAgentSystem:
                 print(f"警告: Excel文檔 {file_path} 沒有數據內容")
                 return False
             
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1200,
-                chunk_overlap=100,
-                length_function=len,
-            )
+            text_splitter = _text_splitter(chunk_size=1200, chunk_overlap=100)
             chunks = text_splitter.split_text(text)
             
             ids = []
@@ -332,7 +428,8 @@ class CustomRAGAgentSystem:
             metadatas = []
             
             for i, chunk in enumerate(chunks):
-                response = ollama.embed(model=self.embedding_model, input=chunk)
+                with span('ingest.embed'):
+                    response = ollama.embed(model=self.embedding_model, input=chunk)
                 embedding = response["embeddings"][0]
                 
                 doc_id = f"{os.path.basename(file_path)}_{i}"
@@ -343,6 +440,7 @@ class CustomRAGAgentSystem:
                     "source": file_path, 
                     "chunk_id": i, 
                     "file_type": "excel",
+                    "chunk_overlap": 100,
                     "original_filename": original_filename if original_filename else os.path.basename(file_path),
                     "sheets_count": len(sheet_names),
                     "sheet_names": sheet_names
@@ -363,6 +461,7 @@ class CustomRAGAgentSystem:
             print(f"添加Excel文檔失敗: {e}")
             return False
     
+    @traced('ingest.json')
     def add_json_document(self, file_path: str, original_filename: str = None):
         """專門處理JSON文檔"""
         try:
@@ -376,11 +475,7 @@ class CustomRAGAgentSystem:
             else:
                 text = str(json_data)
             
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=850,
-                chunk_overlap=0,
-                length_function=len,
-            )
+            text_splitter = _text_splitter(chunk_size=850, chunk_overlap=0)
             chunks = text_splitter.split_text(text)
             
             ids = []
@@ -389,7 +484,8 @@ class CustomRAGAgentSystem:
             metadatas = []
             
             for i, chunk in enumerate(chunks):
-                response = ollama.embed(model=self.embedding_model, input=chunk)
+                with span('ingest.embed'):
+                    response = ollama.embed(model=self.embedding_model, input=chunk)
                 embedding = response["embeddings"][0]
                 
                 doc_id = f"{os.path.basename(file_path)}_{i}"
@@ -400,6 +496,7 @@ class CustomRAGAgentSystem:
                     "source": file_path, 
                     "chunk_id": i, 
                     "file_type": "json",
+                    "chunk_overlap": 0,
                     "original_filename": original_filename if original_filename else os.path.basename(file_path)
                 })
             
@@ -417,10 +514,14 @@ class CustomRAGAgentSystem:
             print(f"添加JSON文檔失敗: {e}")
             return False
     
+    @traced('ingest.document')
     def add_document(self, file_path: str, doc_type: str = "txt", original_filename: str = None):
         """添加單個文檔到RAG資料庫"""
+        if self.chunking == 'records':
+            return self._add_record_document(file_path, doc_type, original_filename)
         try:
             if doc_type.lower() == "pdf":
+                from langchain_community.document_loaders import PyPDFLoader
                 loader = PyPDFLoader(file_path)
                 documents = loader.load()
                 text = "\n".join([doc.page_content for doc in documents])
@@ -431,11 +532,7 @@ class CustomRAGAgentSystem:
             # 檢查是否包含時間戳模板
             has_timestamp_template = "編號與日期:" in text
             
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=850,
-                chunk_overlap=0,
-                length_function=len,
-            )
+            text_splitter = _text_splitter(chunk_size=850, chunk_overlap=0)
             chunks = text_splitter.split_text(text)
             
             ids = []
@@ -444,7 +541,8 @@ class CustomRAGAgentSystem:
             metadatas = []
             
             for i, chunk in enumerate(chunks):
-                response = ollama.embed(model=self.embedding_model, input=chunk)
+                with span('ingest.embed'):
+                    response = ollama.embed(model=self.embedding_model, input=chunk)
                 embedding = response["embeddings"][0]
                 
                 doc_id = f"{os.path.basename(file_path)}_{i}"
@@ -456,7 +554,8 @@ class CustomRAGAgentSystem:
                     "chunk_id": i, 
                     "file_type": doc_type,
                     "original_filename": original_filename if original_filename else os.path.basename(file_path),
-                    "has_timestamp_template": has_timestamp_template
+                    "has_timestamp_template": has_timestamp_template,
+                    "chunk_overlap": 0
                 })
             
             self.collection.add(
@@ -475,35 +574,80 @@ class CustomRAGAgentSystem:
             print(f"添加文檔失敗: {e}")
             return False
     
-    def list_loaded_documents(self):
-        """顯示已載入的文檔列表"""
+    def _add_record_document(self, file_path: str, doc_type: str = "txt", original_filename: str = None,
+                             embed_batch_size: int = 32):
+        """按工單紀錄切分並添加文檔（TSD_CHUNKING=records）
+        
+        txt / md 逐行串流讀取，不需把整個文件載入記憶體；每 embed_batch_size 個片段以一次 Ollama 呼叫計算嵌入。
+        每個片段的元數據帶有 ticket_number 與 ticket_date，向量庫以 ticket_date 作為片段時間戳。
+        """
         try:
-            all_docs = self.collection.get(include=["metadatas"])
+            if doc_type.lower() == "pdf":
+                from langchain_community.document_loaders import PyPDFLoader
+                pages = PyPDFLoader(file_path).load()
+                lines = (line for page in pages for line in page.page_content.splitlines(keepends=True))
+                source = None
+            else:
+                source = open(file_path, 'r', encoding='utf-8')
+                lines = source
             
-            file_stats = {}
-            for metadata in all_docs["metadatas"]:
-                source = metadata.get("source", "unknown")
-                filename = os.path.basename(source)
-                file_type = metadata.get("file_type", "unknown")
-                
-                if filename not in file_stats:
-                    file_stats[filename] = {
-                        "chunks": 0,
-                        "type": file_type,
-                        "path": source,
-                        "extra_info": {}
+            ids, embeddings, documents, metadatas = [], [], [], []
+            pending = []
+            
+            def flush():
+                with span('ingest.embed', chunks=len(pending)):
+                    response = ollama.embed(model=self.embedding_model, input=[chunk['text'] for chunk in pending])
+                for chunk, embedding in zip(pending, response["embeddings"]):
+                    i = len(ids)
+                    ids.append(f"{os.path.basename(file_path)}_{i}")
+                    embeddings.append(embedding)
+                    documents.append(chunk['text'])
+                    metadata = {
+                        "source": file_path,
+                        "chunk_id": i,
+                        "file_type": doc_type,
+                        "original_filename": original_filename if original_filename else os.path.basename(file_path),
+                        "has_timestamp_template": chunk['ticket_number'] is not None,
+                        "chunking": "records",
+                        "chunk_overlap": 0,
                     }
-                file_stats[filename]["chunks"] += 1
-                
-                if file_type == "docx":
-                    file_stats[filename]["extra_info"]["paragraphs"] = metadata.get("paragraphs_count", 0)
-                    file_stats[filename]["extra_info"]["tables"] = metadata.get("tables_count", 0)
-                elif file_type == "excel":
-                    file_stats[filename]["extra_info"]["sheets"] = metadata.get("sheets_count", 0)
-                    file_stats[filename]["extra_info"]["sheet_names"] = metadata.get("sheet_names", [])
+                    if chunk['ticket_number'] is not None:
+                        metadata.update(ticket_number=chunk['ticket_number'], ticket_date=chunk['ticket_date'],
+                                        record_part=chunk['record_part'], record_parts=chunk['record_parts'])
+                    metadatas.append(metadata)
+                pending.clear()
+            
+            try:
+                for chunk in iter_ticket_chunks(lines, self.record_max_chars):
+                    pending.append(chunk)
+                    if len(pending) >= embed_batch_size:
+                        flush()
+                if pending:
+                    flush()
+            finally:
+                if source is not None:
+                    source.close()
+            
+            if not ids:
+                print(f"文檔沒有內容: {file_path}")
+                return False
+            
+            self.collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+            tickets = len({m["ticket_number"] for m in metadatas if "ticket_number" in m})
+            print(f"成功添加文檔: {file_path}，共{len(ids)}個片段（{tickets} 筆工單）")
+            return True
+            
+        except Exception as e:
+            print(f"添加文檔失敗: {e}")
+            return False
+    
+    def list_loaded_documents(self):
+        """顯示已載入的文檔列表"""
+        try:
+            file_stats = self.collection.list_files()
             
             print(f"\n已載入的文檔列表 (共 {len(file_stats)} 個文件):")
-            for filename, stats in file_stats.items():
+            for stats in file_stats:
                 extra_info = ""
                 if stats["type"] == "docx" and stats["extra_info"]:
                     extra_info = f" [段落:{stats['extra_info'].get('paragraphs', 0)}, 表格:{stats['extra_info'].get('tables', 0)}]";
@@ -521,6 +665,7 @@ class CustomRAGAgentSystem:
         except Exception as e:
             print(f"獲取文檔列表失敗: {e}")
     
+    @traced('search')
     def search_documents(self, query: str, n_results: int = 6, date_range: str = '') -> List[Dict]:
         """搜索最相關的文檔"""
         try:
@@ -529,194 +674,16 @@ class CustomRAGAgentSystem:
             # 檢查停止標誌
             self._check_stop_flag()
             
-            # 獲取查詢的嵌入向量
-            response = ollama.embed(model=self.embedding_model, input=query)
-            query_embedding = np.array(response["embeddings"][0]).reshape(1, -1)
+            queries = self.expand_query(query)
+            
+            # 獲取查詢（含改寫）的嵌入向量，一次呼叫批量計算
+            query_embedding = self.embed_queries(queries)
             print(f"查詢向量維度: {query_embedding.shape}")
             
             # 檢查停止標誌
             self._check_stop_flag()
             
-            # 獲取所有文檔
-            all_docs = self.collection.get(include=["documents", "metadatas", "embeddings"])
-            print(f"獲取到 {len(all_docs['documents'])} 個文檔")
-            
-            # 調試：檢查數據結構
-            print("文檔結構:", {
-                "documents": len(all_docs["documents"]),
-                "metadatas": len(all_docs["metadatas"]),
-                "embeddings": len(all_docs["embeddings"])
-            })
-            
-            # 如果有時間區間，進行過濾
-            if date_range and date_range.strip():
-                try:
-                    # 檢查是否為 "all time"
-                    if date_range.strip() == "all time":
-                        print("選擇了所有時間範圍，不進行時間過濾")
-                        filtered_docs = []
-                        for i in range(len(all_docs["documents"])):
-                            doc_content = all_docs["documents"][i]
-                            doc_metadata = all_docs["metadatas"][i]
-                            doc_embedding = all_docs["embeddings"][i]
-                            doc_timestamp = None
-                            
-                            # 嘗試從元數據中獲取時間戳
-                            if "timestamp" in doc_metadata:
-                                try:
-                                    doc_timestamp = int(doc_metadata["timestamp"])
-                                except (ValueError, TypeError):
-                                    pass
-                            
-                            # 如果元數據中沒有，則檢查文檔內容
-                            if doc_timestamp is None and "編號與日期:" in doc_content:
-                                import re
-                                pattern = r'\(\d+\)\s*(\d{8})'
-                                match = re.search(pattern, doc_content)
-                                if match:
-                                    doc_timestamp = int(match.group(1))
-                            
-                            filtered_docs.append({
-                                "document": doc_content,
-                                "metadata": doc_metadata,
-                                "embedding": doc_embedding,
-                                "timestamp": str(doc_timestamp) if doc_timestamp else ""
-                            })
-                    else:
-                        start_date, end_date = date_range.split(' - ')
-                        start_date = int(start_date.strip())
-                        end_date = int(end_date.strip())
-                        print(f"時間區間: {start_date} - {end_date}")
-                        
-                        filtered_docs = []
-                        for i in range(len(all_docs["documents"])):
-                            # 從文檔內容中提取時間戳
-                            doc_content = all_docs["documents"][i]
-                            doc_metadata = all_docs["metadatas"][i]
-                            doc_embedding = all_docs["embeddings"][i]
-                            doc_timestamp = None
-                            
-                            # 首先檢查元數據中是否有時間戳
-                            if "timestamp" in doc_metadata:
-                                try:
-                                    doc_timestamp = int(doc_metadata["timestamp"])
-                                except (ValueError, TypeError) as e:
-                                    print(f"解析時間戳失敗: {e}, 原始值: {doc_metadata['timestamp']}")
-                                    pass
-                            
-                            # 如果元數據中沒有，則檢查文檔內容
-                            if doc_timestamp is None and "編號與日期:" in doc_content:
-                                import re
-                                pattern = r'\(\d+\)\s*(\d{8})'
-                                match = re.search(pattern, doc_content)
-                                if match:
-                                    doc_timestamp = int(match.group(1))
-                                    print(f"從內容中找到時間戳: {doc_timestamp}")
-                            
-                            # 如果還是沒有找到時間戳，跳過此文檔
-                            if doc_timestamp is None:
-                                print(f"文檔沒有時間戳，跳過: {doc_metadata.get('original_filename', 'unknown')}")
-                                continue
-                            
-                            # 檢查時間戳是否在指定範圍內
-                            if start_date <= doc_timestamp <= end_date:
-                                filtered_docs.append({
-                                    "document": doc_content,
-                                    "metadata": doc_metadata,
-                                    "embedding": doc_embedding,
-                                    "timestamp": str(doc_timestamp)
-                                })
-                        
-                        print(f"時間區間過濾後剩餘 {len(filtered_docs)} 個文檔")
-                        
-                        if len(filtered_docs) == 0:
-                            print("沒有找到符合時間區間的文檔")
-                            return []
-                            
-                except Exception as e:
-                    print(f"時間區間過濾失敗: {str(e)}")
-                    # 如果時間過濾失敗，則回退到不過濾，但仍嘗試提取時間戳
-                    filtered_docs = []
-                    for i in range(len(all_docs["documents"])):
-                        doc_content = all_docs["documents"][i]
-                        doc_metadata = all_docs["metadatas"][i]
-                        doc_embedding = all_docs["embeddings"][i]
-                        doc_timestamp = None
-                        if "timestamp" in doc_metadata:
-                            try:
-                                doc_timestamp = int(doc_metadata["timestamp"])
-                            except (ValueError, TypeError):
-                                pass
-                        if doc_timestamp is None and "編號與日期:" in doc_content:
-                            import re
-                            pattern = r'\(\d+\)\s*(\d{8})'
-                            match = re.search(pattern, doc_content)
-                            if match:
-                                doc_timestamp = int(match.group(1))
-                        
-                        filtered_docs.append({
-                            "document": doc_content,
-                            "metadata": doc_metadata,
-                            "embedding": doc_embedding,
-                            "timestamp": str(doc_timestamp) if doc_timestamp else ""
-                        })
-            else:
-                # 如果沒有時間區間，直接使用所有文檔，但仍然提取時間戳
-                filtered_docs = []
-                for i in range(len(all_docs["documents"])):
-                    doc_content = all_docs["documents"][i]
-                    doc_metadata = all_docs["metadatas"][i]
-                    doc_embedding = all_docs["embeddings"][i]
-                    doc_timestamp = None
-                    
-                    # 嘗試從元數據中獲取時間戳
-                    if "timestamp" in doc_metadata:
-                        try:
-                            doc_timestamp = int(doc_metadata["timestamp"])
-                        except (ValueError, TypeError):
-                            pass
-                    
-                    # 如果元數據中沒有，則檢查文檔內容
-                    if doc_timestamp is None and "編號與日期:" in doc_content:
-                        import re
-                        pattern = r'\(\d+\)\s*(\d{8})'
-                        match = re.search(pattern, doc_content)
-                        if match:
-                            doc_timestamp = int(match.group(1))
-                    
-                    filtered_docs.append({
-                        "document": doc_content,
-                        "metadata": doc_metadata,
-                        "embedding": doc_embedding,
-                        "timestamp": str(doc_timestamp) if doc_timestamp else "" # 確保有timestamp字段
-                    })
-            
-            # 計算相似度
-            results = []
-            for doc in filtered_docs:
-                try:
-                    # 確保向量維度正確
-                    doc_vec = np.array(doc["embedding"]).reshape(1, -1)
-                    if doc_vec.shape[1] != query_embedding.shape[1]:
-                        print(f"向量維度不匹配: 文檔向量 {doc_vec.shape}, 查詢向量 {query_embedding.shape}")
-                        continue
-                        
-                    similarity = cosine_similarity(query_embedding, doc_vec)[0][0]
-                    distance = 1 - similarity
-                    results.append({
-                        "content": doc["document"],
-                        "metadata": doc["metadata"],
-                        "distance": distance,
-                        "chunk_id": doc["metadata"].get("chunk_id", 0),
-                        "timestamp": doc.get("timestamp", "")
-                    })
-                except Exception as e:
-                    print(f"計算相似度時發生錯誤: {str(e)}")
-                    continue
-            
-            # 按距離排序並返回前 n_results 個結果
-            results.sort(key=lambda x: x["distance"])
-            final_results = results[:n_results]
+            final_results = self._rank_documents(query_embedding, n_results, date_range)
             print(f"返回 {len(final_results)} 個結果")
             
             # 在關鍵步驟後檢查停止標誌
@@ -731,145 +698,337 @@ class CustomRAGAgentSystem:
             print(f"文檔搜索失敗: {str(e)}")
             return []
     
-    def filter_documents(self, query: str, documents: List[Dict]) -> List[Dict]:
-        """使用第一個LLM篩選文檔"""
-        relevant_docs = []
-        filter_interactions = {}  # 保存每個文檔的交互訊息
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """以一次 Ollama 呼叫計算多個查詢的嵌入向量，返回 (查詢數, 維度) 矩陣（可被取消）"""
+        with span('search.embed', log=self.span_log, queries=len(queries)):
+            response = run_cancellable(
+                self.cancel_token,
+                _loop_client(self.ollama_host).embed(model=self.embedding_model, input=queries, keep_alive=self.keep_alive),
+                stage='search.embed'
+            )
+        return np.array(response["embeddings"])
+    
+    def expand_query(self, query: str) -> List[str]:
+        """返回 [原問題, 改寫...]；未啟用查詢改寫時只有原問題"""
+        if self.query_expansion not in ('rules', 'llm'):
+            return [query]
+        llm_output = None
+        if self.query_expansion == 'llm':
+            try:
+                with span('search.expand', log=self.span_log):
+                    llm_output = self._ollama_chat(QUERY_EXPANSION_SYSTEM_MESSAGE, query, stage='search.expand',
+                                                   model=self.query_expansion_model)
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                print(f"LLM 查詢改寫失敗，只使用規則改寫: {e}")
+        return self._merge_expansions(query, llm_output)
+    
+    def _merge_expansions(self, query: str, llm_output: str = None) -> List[str]:
+        """合併 LLM 與規則改寫（LLM 改寫優先），去重並限制數量"""
+        variants = rule_variants(query)
+        if llm_output:
+            variants = parse_llm_variants(llm_output) + variants
+        queries = merge_variants(query, variants, self.query_expansion_max)
+        if len(queries) > 1:
+            print(f"查詢改寫: {queries[1:]}")
+        return queries
+    
+    def _rank_documents(self, query_embedding: np.ndarray, n_results: int, date_range: str = '') -> List[Dict]:
+        """按時間區間過濾文檔並以餘弦距離排序（不涉及任何網路呼叫）
         
-        for doc in documents:
-            # 檢查停止標誌
-            self._check_stop_flag()
-            
-            filter_user_proxy = autogen.UserProxyAgent(
-                name="filter_user_proxy",
-                human_input_mode="NEVER",
-                max_consecutive_auto_reply=1,
-                is_termination_msg=lambda x: True,
-                code_execution_config=False,
-                llm_config=self.llm_config,
+        時間過濾由向量庫按月份分片進行，只掃描與區間重疊的分片，
+        最後只讀取排名靠前片段的內容。
+        query_embedding 有多行（查詢改寫）時，各片段取最高相似度合併排序。
+        """
+        bounds = self._parse_date_range(date_range)
+        # 計算相似度（量化模式下由向量庫負責粗排與精排）
+        with span('search.vector', log=self.span_log, date_range=bool(bounds)):
+            hits = self.collection.search(query_embedding, n_results, date_range=bounds)
+        if not hits and bounds:
+            print("沒有找到符合時間區間的文檔")
+        return self._fetch_hits(hits)
+    
+    def rank_documents_batch(self, query_embeddings: np.ndarray, n_results: int, date_range: str = '') -> List[List[Dict]]:
+        """同一時間區間的多個問題一起排序：每行一個問題的查詢向量，返回各問題的結果列表"""
+        bounds = self._parse_date_range(date_range)
+        with span('search.vector', log=self.span_log, date_range=bool(bounds), queries=len(query_embeddings)):
+            hits_per_query = self.collection.search_batch(query_embeddings, n_results, date_range=bounds)
+        return [self._fetch_hits(hits) for hits in hits_per_query]
+    
+    def _parse_date_range(self, date_range: str = ''):
+        """解析 "YYYYMMDD - YYYYMMDD" 時間區間，返回 (start, end)；不限時間或格式錯誤時返回 None（不過濾）"""
+        if not date_range or not date_range.strip():
+            return None
+        if date_range.strip() == "all time":
+            print("選擇了所有時間範圍，不進行時間過濾")
+            return None
+        try:
+            start_date, end_date = date_range.split(' - ')
+            start_date = int(start_date.strip())
+            end_date = int(end_date.strip())
+            print(f"時間區間: {start_date} - {end_date}")
+            return start_date, end_date
+        except Exception as e:
+            print(f"時間區間過濾失敗: {str(e)}")
+            # 如果時間過濾失敗，則回退到不過濾
+            return None
+    
+    def _fetch_hits(self, hits) -> List[Dict]:
+        """讀取搜索命中片段的內容與元數據，組成搜索結果"""
+        # 只讀取排名靠前片段的內容
+        with span('search.fetch', log=self.span_log):
+            top_docs = self.collection.get(ids=[doc_id for doc_id, _ in hits], include=["ids", "documents", "metadatas"])
+        similarity = dict(hits)
+        results = []
+        for doc_id, content, doc_metadata in zip(top_docs["ids"], top_docs["documents"], top_docs["metadatas"]):
+            try:
+                doc_timestamp = int(doc_metadata.get("timestamp"))
+            except (ValueError, TypeError):
+                doc_timestamp = None
+            results.append({
+                "id": doc_id,
+                "content": content,
+                "metadata": doc_metadata,
+                "distance": 1 - similarity[doc_id],
+                "chunk_id": doc_metadata.get("chunk_id", 0),
+                "timestamp": str(doc_timestamp) if doc_timestamp else ""
+            })
+        if self.neighbor_chunks:
+            self._attach_neighbors(results)
+        return results
+    
+    def _attach_neighbors(self, results: List[Dict]):
+        """為每個命中片段附上同一文件前後各 neighbor_chunks 個片段（doc['neighbors']）
+        
+        只查片段順序索引，不再計算相似度；本身也是命中結果的片段不重複附加，
+        多個命中共享的相鄰片段在打包上下文時合併為一份。
+        """
+        with span('search.neighbors', log=self.span_log):
+            hit_ids = {doc['id'] for doc in results}
+            for doc in results:
+                doc['neighbors'] = self.collection.get_neighbors(doc['id'], self.neighbor_chunks, exclude=hit_ids)
+    
+    def candidate_count(self, n_results: int) -> int:
+        """向量搜索應取的候選數：啟用重排時擴大到 rerank_candidates"""
+        if get_reranker() is None:
+            return n_results
+        return max(n_results, self.rerank_candidates)
+    
+    @traced('rerank')
+    def rerank_documents(self, query: str, documents: List[Dict], n_results: int) -> List[Dict]:
+        """以 CPU 重排器重新排序候選並套用分數門檻，只保留前 n_results 個進入 LLM 篩選"""
+        return rerank(get_reranker(), query, documents, n_results, self.rerank_min_score)
+    
+    def early_stop_reason(self, relevant_docs: List[Dict], next_doc: Dict) -> str:
+        """按提前終止策略判斷是否停止篩選，返回原因；不應停止時返回 None"""
+        if self.early_stop_relevant and len(relevant_docs) >= self.early_stop_relevant:
+            return f"已確認 {len(relevant_docs)} 個相關文檔，跳過其餘文檔的篩選"
+        if self.similarity_floor is not None and 1 - next_doc['distance'] < self.similarity_floor:
+            return f"其餘文檔相似度低於 {self.similarity_floor}，停止篩選"
+        return None
+    
+    def _doc_key(self, doc: Dict) -> str:
+        """生成文檔在篩選交互訊息中的鍵: <原始文件名>_<chunk_id>"""
+        metadata = doc['metadata']
+        return f"{metadata.get('original_filename', os.path.basename(metadata['source']))}_{metadata.get('chunk_id', 0)}"
+    
+    def _build_filter_prompt(self, query: str, doc: Dict) -> str:
+        """構建文檔篩選提示詞
+        
+        同一問題的所有篩選呼叫共享完全相同的前綴（系統提示詞 + 問題 + 指示），
+        只有結尾的文檔內容不同，Ollama 可重用前綴的 KV 快取而不必重新 prefill。
+        """
+        return f"""用戶問題: {query}
+
+請判斷以下文檔是否與用戶問題相關。
+
+文檔內容:
+{expanded_content(doc)}
+"""
+    
+    def _chat_options(self) -> Dict:
+        """Ollama 原生 API 的呼叫參數（各呼叫保持一致）"""
+        options = {'temperature': self.temperature}
+        if self.num_ctx:
+            options['num_ctx'] = self.num_ctx
+        return {'options': options, 'keep_alive': self.keep_alive}
+    
+    def _record_prefill(self, system_message: str, prompt: str, response) -> Dict:
+        """記錄一次呼叫的 prefill 統計
+        
+        prompt_eval_count 是 Ollama 實際處理的提示詞 token 數，命中前綴快取時只計算新的部分；
+        提示詞總 token 數以本地分詞器估算，兩者之差即省下的 prefill。
+        """
+        prompt_tokens = get_token_counter().count(system_message + prompt)
+        evaluated = response.get("prompt_eval_count") or 0
+        self.prefill_stats['calls'] += 1
+        self.prefill_stats['prompt_tokens'] += prompt_tokens
+        self.prefill_stats['evaluated_tokens'] += evaluated
+        self.prefill_stats['avoided_tokens'] += max(prompt_tokens - evaluated, 0)
+        return self.prefill_stats
+    
+    def _ollama_chat(self, system_message: str, prompt: str, stage: str, cancel_token: CancellationToken = None,
+                     model: str = None) -> str:
+        """直接呼叫 Ollama chat API（可傳入 keep_alive，並取得 prompt_eval_count）
+        
+        呼叫可被取消：令牌取消時關閉 HTTP 連線，Ollama 隨即停止處理。
+        """
+        response = run_cancellable(
+            cancel_token or self.cancel_token,
+            _loop_client(self.ollama_host).chat(
+                model=model or self.llm_model,
+                messages=[
+                    {'role': 'system', 'content': system_message},
+                    {'role': 'user', 'content': prompt},
+                ],
+                **self._chat_options(),
+            ),
+            stage=stage
+        )
+        self._record_prefill(system_message, prompt, response)
+        return response["message"]["content"]
+    
+    def warm_up(self):
+        """啟動時預先載入嵌入與 LLM 模型，並以篩選系統提示詞填充前綴快取"""
+        try:
+            start_time = time.time()
+            ollama.embed(model=self.embedding_model, input="warm up", keep_alive=self.keep_alive)
+            options = self._chat_options()
+            options['options'] = dict(options['options'], num_predict=1)
+            ollama.chat(
+                model=self.llm_model,
+                messages=[
+                    {'role': 'system', 'content': DOCUMENT_FILTER_SYSTEM_MESSAGE},
+                    {'role': 'user', 'content': "用戶問題:"},
+                ],
+                **options,
             )
-            
-            filter_prompt = f"""
+            print(f"模型預熱完成，耗時 {time.time() - start_time:.2f} 秒（keep_alive={self.keep_alive}）")
+        except Exception as e:
+            print(f"模型預熱失敗: {e}")
+    
+    def _build_synthesis_prompt(self, query: str, relevant_docs: List[Dict]) -> str:
+        """構建答案整合提示詞（相鄰片段合併、去重，並按相關度裝入 token 預算）"""
+        blocks = pack_context(relevant_docs, self.context_token_budget)
+        print(f"上下文打包: {len(relevant_docs)} 個片段 → {len(blocks)} 段, "
+              f"{sum(block['tokens'] for block in blocks)} tokens (預算 {self.context_token_budget or '不限'})")
+        context = "\n\n".join([f"文檔{i+1}:\n{block['content']}" 
+                              for i, block in enumerate(blocks)])
+        
+        return f"""
+基於以下相關文檔回答用戶問題:
+
 用戶問題: {query}
 
-文檔內容:
-{doc['content']}
+相關文檔:
+{context}
 
-請判斷此文檔是否與用戶問題相關。
+請提供綜合性的答案:
 """
+    
+    def _filter_interaction(self, doc: Dict, filter_prompt: str, prompt_time: float,
+                            content: str = None, error: Exception = None) -> Dict:
+        """整理一次篩選呼叫的交互訊息（同步與異步篩選共用）
+        
+        呼叫失敗或模型沒有返回內容時默認為相關並記錄錯誤，單個文檔的失敗不會中斷整個查詢；
+        任務取消（TaskCancelled）不經過這裡，由呼叫方向上傳遞。
+        """
+        messages = [{'role': 'user', 'content': filter_prompt, 'timestamp': prompt_time}]
+        interaction = {
+            'messages': messages,
+            'is_relevant': True,
+            'filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
+            'chunk_id': doc['metadata'].get('chunk_id', 0)
+        }
+        if error is None and content:
+            # 將AI分析結果轉換為繁體中文
+            traditional_content = convert_to_traditional(content)
+            messages.append({'role': 'assistant', 'content': traditional_content, 'timestamp': time.time()})
+            interaction['is_relevant'] = "NOT_RELEVANT:" not in traditional_content
+        else:
+            interaction['error'] = str(error) if error is not None else "模型沒有返回內容"
+            print(f"獲取篩選結果失敗: {interaction['error']}")
+        return interaction
+    
+    @traced('filter')
+    def filter_documents(self, query: str, documents: List[Dict], on_relevant=None) -> List[Dict]:
+        """使用第一個LLM篩選文檔
+        
+        on_relevant: 每確認一個相關文檔後以當前相關文檔列表呼叫（用於投機生成）
+        篩選直接呼叫 Ollama 原生 API，以便設置 keep_alive 並重用提示詞前綴的 KV 快取。
+        """
+        relevant_docs = []
+        filter_interactions = {}  # 保存每個文檔的交互訊息
+        
+        for doc in documents:
+            # 檢查停止標誌
+            self._check_stop_flag()
             
-            # 記錄交互開始
-            interaction_messages = []
-            interaction_messages.append({
-                'role': 'user',
-                'content': filter_prompt,
-                'timestamp': time.time()
-            })
-            
-            filter_user_proxy.initiate_chat(
-                self.document_filter,
-                message=filter_prompt,
-                max_turns=1
-            )
+            stop_reason = self.early_stop_reason(relevant_docs, doc)
+            if stop_reason:
+                print(stop_reason)
+                break
             
+            filter_prompt = self._build_filter_prompt(query, doc)
+            prompt_time = time.time()
+            filter_content, error = None, None
             try:
-                last_message = filter_user_proxy.last_message(self.document_filter)
-                if last_message:
-                    # 將AI分析結果轉換為繁體中文
-                    traditional_content = convert_to_traditional(last_message["content"])
-                    
-                    interaction_messages.append({
-                        'role': 'assistant',
-                        'content': traditional_content,
-                        'timestamp': time.time()
-                    })
-                    
-                    # 保存交互訊息
-                    doc_key = f"{doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source']))}_{doc['metadata'].get('chunk_id', 0)}"
-                    filter_interactions[doc_key] = {
-                        'messages': interaction_messages,
-                        'is_relevant': "NOT_RELEVANT:" not in traditional_content,
-                        'filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
-                        'chunk_id': doc['metadata'].get('chunk_id', 0)
-                    }
-                    
-                    if "NOT_RELEVANT:" not in traditional_content:
-                        relevant_docs.append(doc)
+                with span('filter.llm', log=self.span_log, doc=self._doc_key(doc)):
+                    filter_content = self._ollama_chat(DOCUMENT_FILTER_SYSTEM_MESSAGE, filter_prompt, stage='filter.llm')
+            except TaskCancelled:
+                raise
             except Exception as e:
-                print(f"獲取篩選結果失敗: {e}")
-                # 即使失敗也保存交互訊息
-                doc_key = f"{doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source']))}_{doc['metadata'].get('chunk_id', 0)}"
-                filter_interactions[doc_key] = {
-                    'messages': interaction_messages,
-                    'is_relevant': True,  # 失敗時默認認為相關
-                    'filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
-                    'chunk_id': doc['metadata'].get('chunk_id', 0),
-                    'error': str(e)
-                }
+                error = e
+            
+            interaction = self._filter_interaction(doc, filter_prompt, prompt_time, filter_content, error)
+            filter_interactions[self._doc_key(doc)] = interaction
+            if interaction['is_relevant']:
                 relevant_docs.append(doc)
+                if on_relevant:
+                    on_relevant(relevant_docs)
             
-            # 每處理完一個文檔後休息3秒
-            time.sleep(12)
+            # 每處理完一個文檔後休息一段時間（取消時立即結束）
+            with span('filter.sleep', log=self.span_log):
+                self.cancel_token.sleep(self.filter_interval, stage='filter.sleep')
             
             # 檢查停止標誌
             self._check_stop_flag()
         
         # 將交互訊息添加到每個相關文檔中
         for doc in relevant_docs:
-            doc_key = f"{doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source']))}_{doc['metadata'].get('chunk_id', 0)}"
+            doc_key = self._doc_key(doc)
             if doc_key in filter_interactions:
                 doc['filter_interaction'] = filter_interactions[doc_key]
         
         return relevant_docs, filter_interactions
     
-    def generate_answer(self, query: str, relevant_docs: List[Dict]) -> str:
-        """使用第二個LLM生成最終答案"""
+    @traced('generate')
+    def generate_answer(self, query: str, relevant_docs: List[Dict], cancel_token: CancellationToken = None) -> str:
+        """使用第二個LLM生成最終答案
+        
+        與篩選相同，直接呼叫 Ollama 原生 API（系統提示詞與溫度和 AnswerSynthesizer 代理一致），
+        取消時可中止進行中的生成；cancel_token 預設為任務令牌（投機生成使用子令牌）。
+        """
         if len(relevant_docs) == 0:
             return "沒有找到相關文檔來回答您的問題。"
         
+        token = cancel_token or self.cancel_token
         # 檢查停止標誌
-        self._check_stop_flag()
-        
-        synthesis_user_proxy = autogen.UserProxyAgent(
-            name="synthesis_user_proxy",
-            human_input_mode="NEVER",
-            max_consecutive_auto_reply=1,
-            is_termination_msg=lambda x: x.get("content", "").rstrip().endswith("TERMINATE"),
-            code_execution_config=False,
-            llm_config=self.llm_config,
-        )
-        
-        context = "\n\n".join([f"文檔{i+1}:\n{doc['content']}" 
-                              for i, doc in enumerate(relevant_docs)])
-        
-        synthesis_prompt = f"""
-基於以下相關文檔回答用戶問題:
-
-用戶問題: {query}
-
-相關文檔:
-{context}
-
-請提供綜合性的答案:
-"""
+        token.raise_if_cancelled()
         
-        synthesis_user_proxy.initiate_chat(
-            self.answer_synthesizer,
-            message=synthesis_prompt,
-            max_turns=1
-        )
+        synthesis_prompt = self._build_synthesis_prompt(query, relevant_docs)
         
         try:
-            # 檢查停止標誌
-            self._check_stop_flag()
+            with span('generate.llm', log=self.span_log):
+                content = self._ollama_chat(ANSWER_SYNTHESIZER_SYSTEM_MESSAGE, synthesis_prompt,
+                                            stage='generate.llm', cancel_token=token)
             
-            last_message = synthesis_user_proxy.last_message(self.answer_synthesizer)
-            if last_message:
-                return convert_to_traditional(last_message["content"])
-                # return last_message["content"]
+            if content:
+                return convert_to_traditional(content)
             return "生成答案失敗"
         except Exception as e:
-            if self._stop_flag:
+            if token.cancelled:
                 return "答案生成被用戶中斷"
             print(f"獲取答案失敗: {e}")
             return "生成答案過程中發生錯誤"
@@ -879,8 +1038,9 @@ class CustomRAGAgentSystem:
         print(f"\n開始處理問題: {question}")
         
         print("1. 搜索相關文檔...")
-        documents = self.search_documents(question, n_results=6)
+        documents = self.search_documents(question, n_results=self.candidate_count(6))
         print(f"找到 {len(documents)} 個候選文檔")
+        documents = self.rerank_documents(question, documents, 6)
         
         if not documents:
             return "沒有找到相關文檔"
@@ -893,7 +1053,11 @@ class CustomRAGAgentSystem:
             print(f"  {i}. {filename} ({file_type}) - 相似度: {1-distance:.3f}")
         
         print("\n2. 篩選相關文檔...")
-        relevant_docs, filter_interactions = self.filter_documents(question, documents)
+        start_time = time.time()
+        speculation = SpeculativeSynthesis(self, question) if self.speculative_synthesis else None
+        relevant_docs, filter_interactions = self.filter_documents(
+            question, documents, on_relevant=speculation.maybe_start if speculation else None
+        )
         print(f"篩選後保留 {len(relevant_docs)} 個相關文檔")
         
         if relevant_docs:
@@ -904,6 +1068,11 @@ class CustomRAGAgentSystem:
                 print(f"  {i}. {filename} ({file_type})")
         
         print("\n3. 生成最終答案...")
-        answer = self.generate_answer(question, relevant_docs)
+        answer = speculation.result(relevant_docs) if speculation else None
+        if answer is None:
+            answer = self.generate_answer(question, relevant_docs)
+        else:
+            print("採用投機生成的答案")
+        print(f"篩選開始到得到答案耗時 {time.time() - start_time:.2f} 秒")
         
         return answer 
\ No newline at end of file
@@ -1,14 +1,23 @@
 from flask import Flask, render_template, request, jsonify, Response
 import os
 from werkzeug.utils import secure_filename
-from agent_rag import CustomRAGAgentSystem
+from agent_rag import CustomRAGAgentSystem, SpeculativeSynthesis
+from admission import AdmissionController, QueueFullError
+from history_store import HistoryStore
+from reranker import get_reranker
+from telemetry import metrics, STAGE_LATENCY
+from query_pipeline import (
+    StageCall, query_events, failure_event, format_sse, format_step,
+)
+from task_janitor import InteractionCache, Janitor
 import uuid
 import json
 import time
 import threading
 import subprocess
 import tempfile
-import glob
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from contextlib import contextmanager
 from datetime import datetime
 
 app = Flask(__name__)
@@ -23,17 +32,135 @@ HISTORY_DIR = 'history'
 running_tasks_by_ip = {}
 task_lock = threading.Lock()
 
-# 全局變量用於保存已完成的任務的篩選交互訊息
-completed_task_interactions = {}
-completed_task_lock = threading.Lock()
+# 已完成任務的篩選交互訊息（見下方）
+completed_task_interactions = None
+
+# 任務狀態清理設定（秒 / 位元組）
+INTERACTION_TTL = float(os.environ.get('TSD_INTERACTION_TTL', 3600))
+INTERACTION_MAX_BYTES = int(os.environ.get('TSD_INTERACTION_MAX_BYTES', 64 * 1024 * 1024))
+TASK_MAX_AGE = float(os.environ.get('TSD_TASK_MAX_AGE', 7200))
+JANITOR_INTERVAL = float(os.environ.get('TSD_JANITOR_INTERVAL', 60))
+SPILL_RETENTION_DAYS = float(os.environ.get('TSD_SPILL_RETENTION_DAYS', 7))
+
+# 向量庫背景壓縮：每 TSD_COMPACT_INTERVAL 秒最多一次（0 為停用），
+# 作廢的嵌入行達到 TSD_COMPACT_DEAD_RATIO 時重寫嵌入文件，否則只對帳片段文件
+COMPACT_INTERVAL = float(os.environ.get('TSD_COMPACT_INTERVAL', 3600))
+COMPACT_DEAD_RATIO = float(os.environ.get('TSD_COMPACT_DEAD_RATIO', 0.2))
+last_compaction = {}
+
+# 准入控制：全局限制同時執行的 LLM 任務數，並按 IP 輪詢排隊
+admission_controller = AdmissionController(
+    max_concurrent=int(os.environ.get('TSD_MAX_CONCURRENT_TASKS', 2)),
+    max_queue_depth=int(os.environ.get('TSD_MAX_QUEUE_DEPTH', 20)),
+    max_queue_per_ip=int(os.environ.get('TSD_MAX_QUEUE_PER_IP', 3)),
+)
+
+# SSE 心跳間隔（秒）：長時間呼叫期間定期寫入注釋行，以便及時發現客戶端已斷開
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('TSD_SSE_HEARTBEAT', 5))
+
+# 串流查詢各階段的共享工作線程池（見 run_with_heartbeat），默認為同時任務數的兩倍，
+# 留出餘量給客戶端斷開後仍在收尾的階段
+STAGE_WORKERS = int(os.environ.get('TSD_STAGE_WORKERS', 0)) or 2 * admission_controller.max_concurrent
 
 # 確保上傳目錄存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # 確保歷史紀錄目錄存在
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
-# 初始化RAG系統
-rag_system = CustomRAGAgentSystem(reset_db=False, db_path="./custom_json_rag_db")
+# 歷史紀錄索引（SQLite）延遲到應用啟動（或首次使用）時才建立，初始化時會導入舊版 JSON 紀錄
+_history_store = None
+_history_store_lock = threading.Lock()
+
+def get_history_store():
+    """獲取共享的歷史紀錄庫，首次呼叫時建立"""
+    global _history_store
+    if _history_store is None:
+        with _history_store_lock:
+            if _history_store is None:
+                _history_store = HistoryStore(HISTORY_DIR)
+    return _history_store
+
+def spill_interactions(task_id, payload):
+    """淘汰的交互訊息寫入歷史紀錄庫"""
+    return get_history_store().spill_interactions(task_id, payload)
+
+# 超過 TTL 或記憶體預算時按 LRU 淘汰，淘汰的交互訊息寫入歷史紀錄庫，仍可按 task_id 查詢
+completed_task_interactions = InteractionCache(
+    ttl_seconds=INTERACTION_TTL,
+    max_bytes=INTERACTION_MAX_BYTES,
+    spill=spill_interactions,
+)
+
+# RAG系統延遲到應用啟動（或首次使用）時才初始化，導入本模組不會建立任何代理
+_rag_system = None
+_rag_system_lock = threading.Lock()
+
+def get_rag_system():
+    """獲取共享的RAG系統實例，首次呼叫時建立"""
+    global _rag_system
+    if _rag_system is None:
+        with _rag_system_lock:
+            if _rag_system is None:
+                _rag_system = CustomRAGAgentSystem(reset_db=False, db_path="./custom_json_rag_db")
+    return _rag_system
+
+def _vector_store_stats():
+    """向量庫快取統計（RAG 系統尚未建立時為空）"""
+    if _rag_system is None:
+        return {}
+    return {(('kind', kind),): value for kind, value in _rag_system.collection.cache_stats.items()}
+
+def _vector_store_hit_ratio():
+    if _rag_system is None:
+        return {}
+    stats = _rag_system.collection.cache_stats
+    ratios = {}
+    for cache, hits, misses in (('chunk', 'chunk_cache_hits', 'chunk_cache_misses'),
+                                ('document', 'document_cache_hits', 'document_disk_reads')):
+        total = stats[hits] + stats[misses]
+        ratios[(('cache', cache),)] = round(stats[hits] / total, 4) if total else 0
+    return ratios
+
+def _vector_store_rows():
+    if _rag_system is None:
+        return {}
+    stats = _rag_system.collection.storage_stats()
+    return {(('state', 'live'),): stats['live_rows'], (('state', 'dead'),): stats['dead_rows']}
+
+# 指標（/metrics）
+QUERY_COUNT = metrics.counter('tsd_queries_total', '查詢次數（按結果）')
+PREFILL_TOKENS = metrics.counter('tsd_prefill_tokens_total', 'LLM 提示詞 token 數（prompt: 送出, evaluated: 實際處理, avoided: 前綴快取省下）')
+metrics.gauge('tsd_admission_active', '正在執行的 LLM 任務數', lambda: admission_controller.stats()['active'])
+metrics.gauge('tsd_admission_queued', '排隊中的請求數', lambda: admission_controller.stats()['queued'])
+metrics.gauge('tsd_admission_rejected', '因排隊已滿被拒絕的請求累計數', lambda: admission_controller.stats()['rejected'])
+metrics.gauge('tsd_running_tasks', '任務表中的任務數', lambda: sum(len(tasks) for tasks in running_tasks_by_ip.values()))
+metrics.gauge('tsd_completed_interactions', '記憶體中保存的已完成任務交互訊息數',
+              lambda: completed_task_interactions.size()['entries'])
+metrics.gauge('tsd_completed_interactions_bytes', '記憶體中已完成任務交互訊息的大小（位元組）',
+              lambda: completed_task_interactions.size()['bytes'])
+metrics.gauge('tsd_completed_interactions_evicted', '已完成任務交互訊息的淘汰累計數（ttl: 過期, budget: 超出記憶體預算）',
+              lambda: {(('reason', 'ttl'),): completed_task_interactions.stats['evicted_ttl'],
+                       (('reason', 'budget'),): completed_task_interactions.stats['evicted_budget']})
+metrics.gauge('tsd_completed_interactions_spilled', '淘汰時寫入歷史紀錄庫的交互訊息累計數',
+              lambda: completed_task_interactions.stats['spilled'])
+metrics.gauge('tsd_vector_store_cache_events', '向量庫快取命中與讀盤次數', _vector_store_stats)
+metrics.gauge('tsd_vector_store_cache_hit_ratio', '向量庫快取命中率', _vector_store_hit_ratio)
+metrics.gauge('tsd_vector_store_chunks', '向量庫中的片段數',
+              lambda: len(_rag_system.collection.index["documents"]) if _rag_system is not None else 0)
+metrics.gauge('tsd_vector_store_embedding_rows', '嵌入文件的行數（live: 被索引引用, dead: 待壓縮回收）',
+              _vector_store_rows)
+metrics.gauge('tsd_vector_store_compaction_reclaimed_bytes', '最近一次背景壓縮回收的位元組數',
+              lambda: last_compaction.get('bytes_reclaimed', 0))
+
+def record_query_metrics(ticket, task_rag_system, outcome):
+    """記錄一次查詢的結果、排隊時間與 prefill 統計"""
+    QUERY_COUNT.inc(outcome=outcome)
+    if ticket.granted_at is not None:
+        STAGE_LATENCY.observe(ticket.wait_seconds, stage='queue')
+    stats = task_rag_system.prefill_stats
+    PREFILL_TOKENS.inc(stats['prompt_tokens'], kind='prompt')
+    PREFILL_TOKENS.inc(stats['evaluated_tokens'], kind='evaluated')
+    PREFILL_TOKENS.inc(stats['avoided_tokens'], kind='avoided')
 
 # 允許的文件類型
 ALLOWED_EXTENSIONS = {
@@ -43,13 +170,6 @@ ALLOWED_EXTENSIONS = {
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def format_sse(data: str, event=None) -> str:
-    """格式化 SSE 數據"""
-    msg = f'data: {data}\n\n'
-    if event is not None:
-        msg = f'event: {event}\n{msg}'
-    return msg
-
 def get_client_ip():
     """獲取客戶端IP地址"""
     # 檢查是否有代理
@@ -61,20 +181,54 @@ def get_client_ip():
         return request.remote_addr
 
 def cleanup_expired_tasks():
-    """清理過期的已完成任務（保留1小時）"""
+    """清理過期的已完成任務（保留 TSD_INTERACTION_TTL 秒，淘汰時寫入歷史紀錄庫）"""
+    expired = completed_task_interactions.expire()
+    if expired:
+        print(f"清理了 {expired} 個過期任務")
+
+def reap_stale_tasks():
+    """中斷並移除執行超過 TSD_TASK_MAX_AGE 秒的任務（例如連線異常後未被清理的任務）"""
     current_time = time.time()
-    expired_tasks = []
-    
-    with completed_task_lock:
-        for task_id, task_data in completed_task_interactions.items():
-            if current_time - task_data['completed_time'] > 3600:  # 1小時後過期
-                expired_tasks.append(task_id)
-        
-        for task_id in expired_tasks:
-            del completed_task_interactions[task_id]
-    
-    if expired_tasks:
-        print(f"清理了 {len(expired_tasks)} 個過期任務")
+    reaped = 0
+    with task_lock:
+        for ip in list(running_tasks_by_ip.keys()):
+            tasks = running_tasks_by_ip[ip]
+            for task_id in [task_id for task_id, task_data in tasks.items()
+                            if current_time - task_data['start_time'] > TASK_MAX_AGE]:
+                task_data = tasks.pop(task_id)
+                if task_data.get('rag_system'):
+                    task_data['rag_system'].stop_current_task('expired')
+                reaped += 1
+            if not tasks:
+                del running_tasks_by_ip[ip]
+    if reaped:
+        print(f"清理了 {reaped} 個逾時未結束的任務")
+
+def purge_spilled_interactions():
+    """刪除歷史紀錄庫中保存過久的淘汰交互訊息"""
+    purged = get_history_store().purge_spilled(SPILL_RETENTION_DAYS * 86400)
+    if purged:
+        print(f"刪除了 {purged} 筆過期的交互訊息")
+
+def compact_vector_store():
+    """背景壓縮向量庫：對帳片段文件，作廢的嵌入行足夠多時重寫嵌入文件（多個 worker 之間以文件鎖互斥）"""
+    if _rag_system is None or COMPACT_INTERVAL <= 0:
+        return
+    if time.time() - last_compaction.get('finished_at', 0) < COMPACT_INTERVAL:
+        return
+    collection = _rag_system.collection
+    stats = collection.storage_stats()
+    reclaim = stats['rows'] > 0 and stats['dead_rows'] / stats['rows'] >= COMPACT_DEAD_RATIO
+    report = collection.compact(reclaim_embeddings=reclaim)
+    report['finished_at'] = time.time()
+    last_compaction.clear()
+    last_compaction.update(report)
+    if report['skipped'] or report['bytes_reclaimed'] or report['missing_files'] or report['invalid_embeddings']:
+        print(f"向量庫背景壓縮: {report}")
+
+# 背景清理線程：首次登記任務或修改文檔時啟動（gunicorn 預載後 fork，不在導入時建立線程）
+task_janitor = Janitor(JANITOR_INTERVAL, [cleanup_expired_tasks, reap_stale_tasks, purge_spilled_interactions,
+                                          compact_vector_store])
 
 def cleanup_ip_tasks(ip):
     """清理指定IP的所有正在執行的任務"""
@@ -82,10 +236,232 @@ def cleanup_ip_tasks(ip):
         if ip in running_tasks_by_ip:
             for task_id, task_data in running_tasks_by_ip[ip].items():
                 if task_data.get('rag_system'):
-                    task_data['rag_system'].stop_current_task()
+                    task_data['rag_system'].stop_current_task('page_reload')
             del running_tasks_by_ip[ip]
             print(f"已清理IP {ip} 的所有任務")
 
+def format_queue_event(ticket):
+    """格式化排隊位置的 SSE 事件"""
+    stats = admission_controller.stats()
+    return format_sse(json.dumps({
+        'step': 'queue',
+        'position': admission_controller.position(ticket),
+        'active': stats['active'],
+        'queued': stats['queued']
+    }))
+
+def format_rejected_response(error):
+    """排隊已滿時返回的 SSE 響應（附帶重試建議）"""
+    body = format_sse(json.dumps({
+        'step': 'error',
+        'message': f'{error}，請於 {error.retry_after} 秒後重試',
+        'retry_after': error.retry_after
+    }))
+    return body, {'Retry-After': str(error.retry_after)}
+
+def format_heartbeat() -> str:
+    """SSE 注釋行（EventSource 會忽略）"""
+    return ': keep-alive\n\n'
+
+def wait_for_admission(ticket, task_rag_system):
+    """等待准入，排隊位置變化時產出 SSE 事件，位置不變時定期產出心跳"""
+    last_position = None
+    last_sent = time.time()
+    while not admission_controller.wait(ticket, timeout=1.0):
+        task_rag_system._check_stop_flag()
+        position = admission_controller.position(ticket)
+        if position != last_position:
+            last_position = position
+            last_sent = time.time()
+            yield format_queue_event(ticket)
+        elif time.time() - last_sent >= SSE_HEARTBEAT_SECONDS:
+            last_sent = time.time()
+            yield format_heartbeat()
+    if last_position is not None:
+        # 通知前端排隊結束
+        yield format_queue_event(ticket)
+
+_stage_executor = None
+_stage_executor_lock = threading.Lock()
+
+def get_stage_executor():
+    """獲取共享的階段工作線程池，首次呼叫時建立（在 fork 出的工作進程中建立，不繼承父進程的線程）"""
+    global _stage_executor
+    if _stage_executor is None:
+        with _stage_executor_lock:
+            if _stage_executor is None:
+                _stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='query-stage')
+    return _stage_executor
+
+def run_with_heartbeat(func, *args, **kwargs):
+    """在共享工作線程池中執行阻塞呼叫，等待期間定期產出 SSE 心跳，最後返回呼叫結果
+    
+    用法: result = yield from run_with_heartbeat(func, ...)
+    客戶端已斷開時寫入心跳失敗，WSGI 伺服器關閉生成器（GeneratorExit），由 query_stream 取消任務；
+    工作線程中的 Ollama 呼叫隨任務令牌一併中止，線程隨即歸還線程池。
+    """
+    future = get_stage_executor().submit(func, *args, **kwargs)
+    while not wait_futures([future], timeout=SSE_HEARTBEAT_SECONDS).done:
+        yield format_heartbeat()
+    return future.result()
+
+class QueryStages:
+    """query_events 請求的階段（同步實現，由 drive_query_events 在工作線程中執行）"""
+    
+    def __init__(self, task_rag_system, speculation, task_id):
+        self.rag_system = task_rag_system
+        self.speculation = speculation
+        self.task_id = task_id
+    
+    def search(self, question, n_results, date_range):
+        return self.rag_system.search_documents(question, n_results=n_results, date_range=date_range)
+    
+    def rerank(self, question, documents, n_results):
+        return self.rag_system.rerank_documents(question, documents, n_results)
+    
+    def filter(self, question, doc):
+        return self.rag_system.filter_documents(question, [doc])
+    
+    def speculative_result(self, relevant_docs):
+        return self.speculation.result(relevant_docs)
+    
+    def generate(self, question, relevant_docs):
+        return self.rag_system.generate_answer(question, relevant_docs)
+    
+    def save_history(self, question, date_range, steps_data, filter_interactions):
+        save_history(question, date_range, steps_data, self.task_id, filter_interactions)
+
+def drive_query_events(events, stages):
+    """驅動 query_events：SSE 事件直接產出，StageCall 以 run_with_heartbeat 執行後把結果傳回
+    
+    用法: yield from drive_query_events(query_events(...), QueryStages(...))
+    """
+    result = None
+    try:
+        while True:
+            try:
+                item = events.send(result)
+            except StopIteration:
+                return
+            if isinstance(item, StageCall):
+                result = yield from run_with_heartbeat(getattr(stages, item.stage), *item.args, **item.kwargs)
+            else:
+                result = None
+                yield item
+    finally:
+        events.close()
+
+class QueryStreamTask:
+    """一次串流查詢的收尾（Flask 與 ASGI 版本共用）
+    
+    finish() 只執行一次：取消投機生成、釋放准入名額、記錄查詢指標，並把任務移出執行列表；
+    close() 在響應關閉時呼叫，生成器沒有執行到 finally（例如客戶端在首次產出前斷開）時視為斷開，先中止任務。
+    """
+    
+    def __init__(self, client_ip, task_id, ticket, task_rag_system, speculation=None):
+        self.client_ip = client_ip
+        self.task_id = task_id
+        self.ticket = ticket
+        self.rag_system = task_rag_system
+        self.speculation = speculation
+        self.outcome = 'incomplete'
+        self._finished = False
+        self._lock = threading.Lock()
+    
+    def finish(self):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        if self.speculation:
+            self.speculation.cancel()
+        admission_controller.release(self.ticket)
+        record_query_metrics(self.ticket, self.rag_system, self.outcome)
+        # 保存篩選交互訊息到已完成任務中
+        finish_task(self.client_ip, self.task_id)
+    
+    def close(self):
+        if self._finished:
+            return
+        self.outcome = 'cancelled'
+        self.rag_system.stop_current_task('disconnect')
+        self.finish()
+
+def register_task(ip, task_id, task_rag_system):
+    """記錄任務到對應的IP"""
+    task_janitor.ensure_started()
+    with task_lock:
+        if ip not in running_tasks_by_ip:
+            running_tasks_by_ip[ip] = {}
+        running_tasks_by_ip[ip][task_id] = {
+            'rag_system': task_rag_system,
+            'start_time': time.time()
+        }
+
+def set_task_interactions(ip, task_id, filter_interactions):
+    """保存交互訊息到任務中，供後續API調用"""
+    with task_lock:
+        if ip in running_tasks_by_ip and task_id in running_tasks_by_ip[ip]:
+            running_tasks_by_ip[ip][task_id]['filter_interactions'] = filter_interactions
+
+def finish_task(ip, task_id):
+    """將任務移出執行列表，並把篩選交互訊息保存到已完成任務中"""
+    with task_lock:
+        if ip in running_tasks_by_ip and task_id in running_tasks_by_ip[ip]:
+            task_data = running_tasks_by_ip[ip][task_id]
+            del running_tasks_by_ip[ip][task_id]
+            
+            # 如果該IP沒有其他任務了，清理IP條目
+            if not running_tasks_by_ip[ip]:
+                del running_tasks_by_ip[ip]
+        else:
+            return
+    # 序列化與可能的淘汰寫盤在任務鎖之外進行
+    if 'filter_interactions' in task_data:
+        completed_task_interactions.put(task_id, task_data['filter_interactions'])
+
+def save_history(question, date_range, steps_data, task_id, filter_interactions):
+    """儲存查詢歷史紀錄"""
+    try:
+        history_id = f"{int(time.time())}_{uuid.uuid4().hex}"
+        history_obj = {
+            'id': history_id,
+            'timestamp': int(time.time()),
+            'question': question,
+            'date_range': date_range,
+            'steps': steps_data,
+            'task_id': task_id,
+            'filter_interactions': filter_interactions
+        }
+        get_history_store().save(history_obj)
+    except Exception as e:
+        print(f"儲存歷史紀錄失敗: {e}")
+
+def stop_all_tasks():
+    """中斷所有正在執行的任務（服務器關閉時使用）"""
+    with task_lock:
+        count = 0
+        for ip, tasks in running_tasks_by_ip.items():
+            for task_id, task_data in tasks.items():
+                if task_data.get('rag_system'):
+                    task_data['rag_system'].stop_current_task('shutdown')
+                    count += 1
+    if count:
+        print(f"已中斷 {count} 個正在執行的任務")
+    return count
+
+def preload_vector_store():
+    """將向量資料庫與嵌入矩陣載入記憶體（應用啟動時呼叫，一併建立歷史紀錄庫）"""
+    start_time = time.time()
+    get_history_store()
+    get_rag_system().collection.preload()
+    # 啟用重排時一併載入重排模型，避免第一個查詢承擔載入時間
+    get_reranker()
+    # 在背景預熱 Ollama 模型（載入 LLM 可能需要數十秒，不阻塞啟動）
+    if os.environ.get('TSD_WARM_UP', '1') != '0':
+        threading.Thread(target=get_rag_system().warm_up, daemon=True).start()
+    print(f"向量資料庫預載完成，耗時 {time.time() - start_time:.2f} 秒")
+
 @app.route('/')
 def index():
     # 清理過期任務
@@ -127,193 +503,53 @@ def query_stream():
     # 生成唯一的任務ID
     task_id = str(uuid.uuid4())
     
-    # 創建新的RAG系統實例
-    task_rag_system = CustomRAGAgentSystem(reset_db=False, db_path="./custom_json_rag_db")
+    # 創建新的RAG系統實例，共享已載入的向量資料庫
+    task_rag_system = CustomRAGAgentSystem(reset_db=False, db_path="./custom_json_rag_db", collection=get_rag_system().collection)
+    
+    # 請求准入，排隊過深時直接拒絕
+    try:
+        ticket = admission_controller.enqueue(client_ip, task_id)
+    except QueueFullError as e:
+        body, headers = format_rejected_response(e)
+        return Response(body, mimetype='text/event-stream', headers=headers)
     
     # 記錄任務到對應的IP
-    with task_lock:
-        if client_ip not in running_tasks_by_ip:
-            running_tasks_by_ip[client_ip] = {}
-        running_tasks_by_ip[client_ip][task_id] = {
-            'rag_system': task_rag_system,
-            'start_time': time.time()
-        }
+    register_task(client_ip, task_id, task_rag_system)
+    speculation = SpeculativeSynthesis(task_rag_system, question) if task_rag_system.speculative_synthesis else None
+    stream_task = QueryStreamTask(client_ip, task_id, ticket, task_rag_system, speculation)
     
     def generate():
         try:
             print(f"收到查詢請求: IP={client_ip}, 問題='{question}', 時間區間='{date_range}'")
             
             # 首先發送任務ID
-            yield format_sse(json.dumps({
-                'step': 'task_id',
-                'task_id': task_id
-            }))
-            
-            # 1. 搜索文檔步驟
-            documents = task_rag_system.search_documents(question, n_results=4, date_range=date_range if date_range else None)
-            print(f"搜索到 {len(documents)} 個文檔")
-            
-            if not documents:
-                yield format_sse(json.dumps({
-                    'step': 'error',
-                    'message': '在指定時間範圍內沒有找到相關文檔'
-                }))
-                return
-            
-            search_results = [
-                {
-                    'filename': os.path.basename(doc['metadata']['source']),
-                    'original_filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
-                    'similarity': 1 - doc['distance'],
-                    'chunk_id': doc['metadata'].get('chunk_id', 0),
-                    'timestamp': doc.get('timestamp', '')
-                } for doc in documents
-            ]
-            
-            # 發送搜索結果
-            yield format_sse(json.dumps({
-                'step': 'search',
-                'results': search_results
-            }))
-            
-            # 2. 篩選文檔步驟
-            relevant_docs = []
-            all_filter_interactions = {}  # 保存所有文檔的交互訊息
-            
-            for i, doc in enumerate(documents):
-                # 發送當前正在處理的文檔信息
-                yield format_sse(json.dumps({
-                    'step': 'filter_progress',
-                    'current_doc': {
-                        'filename': os.path.basename(doc['metadata']['source']),
-                        'original_filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
-                        'progress': f"正在分析第 {i+1}/{len(documents)} 個文檔",
-                        'similarity': 1 - doc['distance'],
-                        'status': 'analyzing'
-                    }
-                }))
-                
-                # 發送 filter_user_proxy 的思考過程
-                yield format_sse(json.dumps({
-                    'step': 'filter_thought',
-                    'thought': f"正在評估文檔 '{doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source']))}' 與問題的相關性..."
-                }))
-                
-                # 檢查文檔相關性
-                relevant_docs_batch, filter_interactions = task_rag_system.filter_documents(question, [doc])
-                
-                # 保存交互訊息
-                all_filter_interactions.update(filter_interactions)
-                
-                # 發送篩選結果
-                doc_key = f"{doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source']))}_{doc['metadata'].get('chunk_id', 0)}"
-                is_relevant = filter_interactions.get(doc_key, {}).get('is_relevant', False)
-                
-                yield format_sse(json.dumps({
-                    'step': 'filter_result',
-                    'result': {
-                        'filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
-                        'is_relevant': is_relevant,
-                        'thought': "這個文檔" + ("與問題高度相關" if is_relevant else "與問題關聯度較低")
-                    }
-                }))
-                
-                if is_relevant:
-                    relevant_docs.append(doc)
-            
-            print(f"篩選後剩餘 {len(relevant_docs)} 個文檔")
-            
-            # 保存交互訊息到任務中，供後續API調用
-            with task_lock:
-                if client_ip in running_tasks_by_ip and task_id in running_tasks_by_ip[client_ip]:
-                    running_tasks_by_ip[client_ip][task_id]['filter_interactions'] = all_filter_interactions
-            
-            if not relevant_docs:
-                # 發送篩選結果（空結果）
-                yield format_sse(json.dumps({
-                    'step': 'filter',
-                    'results': []
-                }))
-                
-                # 直接進入答案步驟，返回沒有找到相關文檔的訊息
-                yield format_sse(json.dumps({
-                    'step': 'answer',
-                    'answer': '沒有找到相關文檔來回答您的問題。'
-                }))
-                return
-            
-            filtered_results = [
-                {
-                    'filename': os.path.basename(doc['metadata']['source']),
-                    'original_filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
-                    'relevance_score': doc.get('relevance_score', 1.0),
-                    'chunk_id': doc['metadata'].get('chunk_id', 0),
-                    'timestamp': doc.get('timestamp', '')
-                } for doc in relevant_docs
-            ]
-            
-            # 發送篩選結果
-            yield format_sse(json.dumps({
-                'step': 'filter',
-                'results': filtered_results
-            }))
+            yield format_step('task_id', task_id=task_id)
             
-            # 3. 生成答案步驟
-            answer = task_rag_system.generate_answer(question, relevant_docs)
+            # 0. 排隊等待 LLM 名額
+            yield from wait_for_admission(ticket, task_rag_system)
             
-            # 發送最終答案
-            yield format_sse(json.dumps({
-                'step': 'answer',
-                'answer': answer
-            }))
-            
-            steps_data = {'search': None, 'filter': None, 'answer': None}
-            steps_data['search'] = search_results
-            steps_data['filter'] = filtered_results
-            steps_data['answer'] = answer
-            
-            # 儲存歷史紀錄
-            try:
-                history_id = f"{int(time.time())}_{uuid.uuid4().hex}"
-                history_obj = {
-                    'id': history_id,
-                    'timestamp': int(time.time()),
-                    'question': question,
-                    'date_range': date_range,
-                    'steps': steps_data,
-                    'task_id': task_id,
-                    'filter_interactions': all_filter_interactions
-                }
-                os.makedirs(HISTORY_DIR, exist_ok=True)
-                with open(os.path.join(HISTORY_DIR, f"{history_id}.json"), 'w', encoding='utf-8') as fp:
-                    json.dump(history_obj, fp, ensure_ascii=False, indent=2)
-            except Exception as e:
-                print(f"儲存歷史紀錄失敗: {e}")
+            # 1-3. 搜索 → 重排 → 篩選 → 生成答案
+            yield from drive_query_events(
+                query_events(task_rag_system, question, date_range, speculation, stream_task,
+                             lambda interactions: set_task_interactions(client_ip, task_id, interactions)),
+                QueryStages(task_rag_system, speculation, task_id)
+            )
             
+        except GeneratorExit:
+            # 客戶端斷開連線：中止進行中的 Ollama 呼叫
+            stream_task.outcome = 'cancelled'
+            task_rag_system.stop_current_task('disconnect')
+            raise
         except Exception as e:
-            print(f"處理查詢時發生錯誤: {str(e)}")
-            yield format_sse(json.dumps({
-                'step': 'error',
-                'message': f'處理查詢時發生錯誤: {str(e)}'
-            }))
+            stream_task.outcome, event = failure_event(e)
+            yield event
         finally:
-            # 保存篩選交互訊息到已完成任務中
-            with task_lock:
-                if client_ip in running_tasks_by_ip and task_id in running_tasks_by_ip[client_ip]:
-                    task_data = running_tasks_by_ip[client_ip][task_id]
-                    if 'filter_interactions' in task_data:
-                        with completed_task_lock:
-                            completed_task_interactions[task_id] = {
-                                'filter_interactions': task_data['filter_interactions'],
-                                'completed_time': time.time()
-                            }
-                    del running_tasks_by_ip[client_ip][task_id]
-                    
-                    # 如果該IP沒有其他任務了，清理IP條目
-                    if not running_tasks_by_ip[client_ip]:
-                        del running_tasks_by_ip[client_ip]
+            stream_task.finish()
     
-    return Response(generate(), mimetype='text/event-stream')
+    response = Response(generate(), mimetype='text/event-stream')
+    # 客戶端在生成器啟動前斷開時，也要中止任務、釋放排隊名額並移出任務表
+    response.call_on_close(stream_task.close)
+    return response
 
 @app.route('/api/query', methods=['POST'])
 def query():
@@ -325,6 +561,7 @@ def query():
     
     try:
         # 獲取RAG系統的處理過程
+        rag_system = get_rag_system()
         documents = rag_system.search_documents(question, n_results=4)
         relevant_docs = rag_system.filter_documents(question, documents)
         answer = rag_system.generate_answer(question, relevant_docs)
@@ -353,6 +590,58 @@ def query():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/query/batch', methods=['POST'])
+def query_batch():
+    """批量問題查詢：請求體為 JSONL（每行 {"id", "question", "date_range"}），結果以 NDJSON 逐行返回
+    
+    每個問題的 LLM 階段都經過准入控制（以 batch:<IP> 排隊，與互動查詢輪流取得名額），
+    客戶端斷開時取消其餘問題。
+    """
+    from batch_query import BatchQueryRunner, parse_questions
+    
+    questions = parse_questions(request.get_data(as_text=True).splitlines())
+    if not questions:
+        return jsonify({'error': '沒有可執行的問題'}), 400
+    
+    client_ip = get_client_ip()
+    batch_id = uuid.uuid4().hex[:8]
+    admission_key = f"batch:{client_ip}"
+    
+    @contextmanager
+    def admit(question_id, task_rag_system):
+        ticket = None
+        while ticket is None:
+            try:
+                ticket = admission_controller.enqueue(admission_key, f"{batch_id}:{question_id}")
+            except QueueFullError as e:
+                task_rag_system.cancel_token.sleep(e.retry_after, stage='batch.queue')
+        try:
+            while not admission_controller.wait(ticket, timeout=1.0):
+                task_rag_system._check_stop_flag()
+            yield
+        finally:
+            admission_controller.release(ticket)
+    
+    workers = request.args.get('workers', type=int) or admission_controller.max_queue_per_ip
+    runner = BatchQueryRunner(
+        get_rag_system().collection,
+        workers=min(workers, admission_controller.max_queue_per_ip),
+        batch_size=request.args.get('batch_size', 32, type=int),
+        n_results=request.args.get('n_results', 4, type=int),
+        admit=admit,
+    )
+    print(f"收到批量查詢: IP={client_ip}, {len(questions)} 個問題")
+    
+    def generate():
+        try:
+            for result in runner.run(questions):
+                yield json.dumps(result, ensure_ascii=False) + '\n'
+        except GeneratorExit:
+            runner.cancel('disconnect')
+            raise
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
 def convert_doc_to_docx(doc_path):
     """將 .doc 文件轉換為 .docx 格式"""
     try:
@@ -381,6 +670,7 @@ def upload_file():
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': '沒有選擇文件'}), 400
+    task_janitor.ensure_started()
     
     if file and allowed_file(file.filename):
         try:
@@ -409,6 +699,7 @@ def upload_file():
                 
                 success = False
                 converted_file = None
+                rag_system = get_rag_system()
                 
                 if file_ext == 'doc':
                     # 轉換 .doc 到 .docx
@@ -463,57 +754,21 @@ def upload_file():
 @app.route('/api/documents', methods=['GET'])
 def list_documents():
     try:
-        all_docs = rag_system.collection.get(include=["metadatas"])
-        file_stats = {}
-        
-        for metadata in all_docs["metadatas"]:
-            source = metadata.get("source", "unknown")
-            display_name = metadata.get("original_filename", os.path.basename(source))
-            file_type = metadata.get("file_type", "unknown")
-            
-            if source not in file_stats:
-                file_stats[source] = {
-                    "chunks": 0,
-                    "type": file_type,
-                    "path": source,
-                    "display_name": display_name,
-                    "original_filename": metadata.get("original_filename"),
-                    "extra_info": {}
-                }
-            file_stats[source]["chunks"] += 1
-            
-            if file_type == "docx":
-                file_stats[source]["extra_info"]["paragraphs"] = metadata.get("paragraphs_count", 0)
-                file_stats[source]["extra_info"]["tables"] = metadata.get("tables_count", 0)
-            elif file_type == "excel":
-                file_stats[source]["extra_info"]["sheets"] = metadata.get("sheets_count", 0)
-                file_stats[source]["extra_info"]["sheet_names"] = metadata.get("sheet_names", [])
-        
-        return jsonify(list(file_stats.values()))
+        return jsonify(get_rag_system().collection.list_files())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/documents/<path:filename>', methods=['DELETE'])
 def delete_document(filename):
     try:
-        all_docs = rag_system.collection.get(include=["ids", "metadatas"])
-        doc_ids_to_delete = []
-        
-        # 遍歷所有文檔，找到匹配的文件
-        for i, metadata in enumerate(all_docs["metadatas"]):
-            source = metadata.get("source", "")
-            original_filename = metadata.get("original_filename", "")
-            
-            # 檢查是否匹配原始文件名或源文件路徑
-            # 使用 basename 來比較文件名，避免路徑差異
-            if (os.path.basename(source) == os.path.basename(filename) or 
-                original_filename == filename or 
-                os.path.basename(source) == filename):
-                doc_ids_to_delete.append(all_docs["ids"][i])
+        collection = get_rag_system().collection
+        # 從文件目錄查找匹配的片段（比較原始文件名、源文件路徑及其 basename）
+        doc_ids_to_delete = collection.find_file_ids([filename])
         
         if doc_ids_to_delete:
-            # 刪除文檔
-            rag_system.collection.delete(ids=doc_ids_to_delete)
+            # 刪除文檔（作廢的嵌入行由背景壓縮回收）
+            task_janitor.ensure_started()
+            collection.delete(ids=doc_ids_to_delete)
             return jsonify({'message': '文檔刪除成功'})
         else:
             return jsonify({'error': '找不到指定的文檔'}), 404
@@ -531,25 +786,13 @@ def batch_delete_documents():
         if not filenames:
             return jsonify({'error': '未指定要刪除的文件'}), 400
             
-        all_docs = rag_system.collection.get(include=["ids", "metadatas"])
-        doc_ids_to_delete = []
-        
-        # 遍歷所有文檔，找到匹配的文件
-        for i, metadata in enumerate(all_docs["metadatas"]):
-            source = metadata.get("source", "")
-            original_filename = metadata.get("original_filename", "")
-            
-            # 檢查是否匹配任何要刪除的文件名
-            for filename in filenames:
-                if (os.path.basename(source) == os.path.basename(filename) or 
-                    original_filename == filename or 
-                    os.path.basename(source) == filename):
-                    doc_ids_to_delete.append(all_docs["ids"][i])
-                    break
+        collection = get_rag_system().collection
+        doc_ids_to_delete = collection.find_file_ids(filenames)
         
         if doc_ids_to_delete:
-            # 批量刪除文檔
-            rag_system.collection.delete(ids=doc_ids_to_delete)
+            # 批量刪除文檔（作廢的嵌入行由背景壓縮回收）
+            task_janitor.ensure_started()
+            collection.delete(ids=doc_ids_to_delete)
             return jsonify({
                 'message': f'成功刪除 {len(doc_ids_to_delete)} 個文檔',
                 'deleted_count': len(doc_ids_to_delete)
@@ -563,6 +806,7 @@ def batch_delete_documents():
 
 @app.route('/api/document_content/<path:original_filename>', methods=['GET'])
 def get_document_content(original_filename):
+    """獲取文檔內容：指定 chunk_id 時只讀取該段落，否則可用 offset/limit 分頁"""
     try:
         chunk_id = request.args.get('chunk_id')
         if chunk_id is not None:
@@ -570,50 +814,52 @@ def get_document_content(original_filename):
                 chunk_id = int(chunk_id)
             except ValueError:
                 return jsonify({'error': '無效的段落ID'}), 400
-            
-        all_docs = rag_system.collection.get(include=["ids", "documents", "metadatas"])
-        document_chunks = []
         
-        # 收集所有匹配的文檔片段
-        for i, metadata in enumerate(all_docs["metadatas"]):
-            if metadata.get("original_filename") == original_filename:
-                # 如果指定了 chunk_id，只返回該段落
-                if chunk_id is not None and metadata.get("chunk_id") != chunk_id:
-                    continue
-                    
-                document_chunks.append({
-                    'content': all_docs["documents"][i],
-                    'file_type': metadata.get("file_type", "unknown"),
-                    'chunk_id': metadata.get("chunk_id", 0),
-                    'metadata': metadata
-                })
+        try:
+            offset = max(int(request.args.get('offset', 0)), 0)
+            limit = request.args.get('limit')
+            limit = max(int(limit), 1) if limit is not None else None
+        except ValueError:
+            return jsonify({'error': '無效的分頁參數'}), 400
         
-        if document_chunks:
-            # 按 chunk_id 排序
-            document_chunks.sort(key=lambda x: x['chunk_id'])
-            
-            # 如果指定了 chunk_id，只返回該段落的內容
-            if chunk_id is not None:
-                if not document_chunks:
-                    return jsonify({'error': f'找不到段落 {chunk_id}'}), 404
-                return jsonify({
-                    'content': document_chunks[0]['content'],
-                    'file_type': document_chunks[0]['file_type'],
-                    'chunk_id': document_chunks[0]['chunk_id']
-                })
-            
-            # 否則返回所有段落
+        collection = get_rag_system().collection
+        
+        # 如果指定了 chunk_id，直接定位該段落
+        if chunk_id is not None:
+            chunk = collection.get_chunk(original_filename, chunk_id)
+            if chunk is None:
+                return jsonify({'error': '找不到指定的文檔'}), 404
             return jsonify({
-                'content': "\n\n--- 段落分隔線 ---\n\n".join(
-                    f"段落 {chunk['chunk_id']}:\n{chunk['content']}" 
-                    for chunk in document_chunks
-                ),
-                'file_type': document_chunks[0]['file_type'],
-                'total_chunks': len(document_chunks),
-                'chunks': document_chunks
+                'content': chunk['content'],
+                'file_type': chunk['metadata'].get("file_type", "unknown"),
+                'chunk_id': chunk['metadata'].get("chunk_id", 0)
             })
         
-        return jsonify({'error': '找不到指定的文檔'}), 404
+        chunks, total_chunks = collection.get_file_chunks(original_filename, offset=offset, limit=limit)
+        if not chunks:
+            return jsonify({'error': '找不到指定的文檔'}), 404
+        
+        document_chunks = [
+            {
+                'content': chunk['content'],
+                'file_type': chunk['metadata'].get("file_type", "unknown"),
+                'chunk_id': chunk['metadata'].get("chunk_id", 0),
+                'metadata': chunk['metadata']
+            } for chunk in chunks
+        ]
+        
+        # 返回（該頁的）所有段落
+        return jsonify({
+            'content': "\n\n--- 段落分隔線 ---\n\n".join(
+                f"段落 {chunk['chunk_id']}:\n{chunk['content']}" 
+                for chunk in document_chunks
+            ),
+            'file_type': document_chunks[0]['file_type'],
+            'total_chunks': total_chunks,
+            'offset': offset,
+            'limit': limit,
+            'chunks': document_chunks
+        })
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -642,21 +888,10 @@ def get_filter_interaction(filename):
                     break
         # 如果不在運行中的任務，檢查已完成的任務
         if filter_interactions is None:
-            with completed_task_lock:
-                if task_id in completed_task_interactions:
-                    filter_interactions = completed_task_interactions[task_id]['filter_interactions']
-        # 如果還是沒有，從歷史紀錄檔案讀取
+            filter_interactions = completed_task_interactions.get(task_id)
+        # 如果還是沒有，按 task_id 從歷史紀錄索引讀取（含被淘汰的交互訊息）
         if filter_interactions is None:
-            # 在 history 目錄下尋找對應 task_id 的 json 檔案
-            for f in glob.glob(os.path.join(HISTORY_DIR, '*.json')):
-                try:
-                    with open(f, 'r', encoding='utf-8') as fp:
-                        data = json.load(fp)
-                        if data.get('task_id') == task_id and 'filter_interactions' in data:
-                            filter_interactions = data['filter_interactions']
-                            break
-                except Exception:
-                    continue
+            filter_interactions = get_history_store().get_filter_interactions(task_id)
             if filter_interactions is None:
                 return jsonify({'error': '任務不存在或已過期'}), 404
         # 構建文檔鍵
@@ -691,38 +926,24 @@ def history():
 
 @app.route('/api/history/list', methods=['GET'])
 def history_list():
+    """列出歷史紀錄摘要，可選 limit/cursor 分頁（下一頁游標放在 X-Next-Cursor 標頭）"""
     try:
-        history_files = sorted(glob.glob(os.path.join(HISTORY_DIR, '*.json')), reverse=True)
-        history_list = []
-        for f in history_files:
-            try:
-                with open(f, 'r', encoding='utf-8') as fp:
-                    data = json.load(fp)
-                    history_list.append({
-                        'id': data.get('id', os.path.basename(f)),
-                        'timestamp': data.get('timestamp'),
-                        'question': data.get('question'),
-                        'date_range': data.get('date_range'),
-                        'answer': data.get('steps', {}).get('answer', ''),
-                        'filename': os.path.basename(f),
-                        'task_id': data.get('task_id', None)
-                    })
-            except Exception as e:
-                continue
-        return jsonify(history_list)
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        items, next_cursor = get_history_store().list(limit=limit, cursor=cursor)
+        response = jsonify(items)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/history/<history_id>', methods=['GET'])
 def history_detail(history_id):
     try:
-        file_path = os.path.join(HISTORY_DIR, history_id)
-        if not file_path.endswith('.json'):
-            file_path += '.json'
-        if not os.path.exists(file_path):
+        data = get_history_store().get(history_id)
+        if data is None:
             return jsonify({'error': '找不到歷史紀錄'}), 404
-        with open(file_path, 'r', encoding='utf-8') as fp:
-            data = json.load(fp)
         return jsonify(data)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -734,12 +955,8 @@ def history_detail_page(history_id):
 @app.route('/api/history/<history_id>', methods=['DELETE'])
 def delete_history(history_id):
     try:
-        file_path = os.path.join(HISTORY_DIR, history_id)
-        if not file_path.endswith('.json'):
-            file_path += '.json'
-        if not os.path.exists(file_path):
+        if not get_history_store().delete([history_id]):
             return jsonify({'error': '找不到歷史紀錄'}), 404
-        os.remove(file_path)
         return jsonify({'message': '歷史紀錄刪除成功'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -751,19 +968,30 @@ def batch_delete_history():
         filenames = data.get('filenames', [])
         if not filenames:
             return jsonify({'error': '未指定要刪除的歷史紀錄'}), 400
-        deleted = 0
-        for filename in filenames:
-            file_path = os.path.join(HISTORY_DIR, filename)
-            if not file_path.endswith('.json'):
-                file_path += '.json'
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                deleted += 1
+        deleted = get_history_store().delete(filenames)
         return jsonify({'message': f'成功刪除 {deleted} 筆歷史紀錄', 'deleted_count': deleted})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """就緒檢查：嵌入矩陣載入完成後才返回 200"""
+    if _rag_system is None or not _rag_system.collection.is_loaded():
+        return jsonify({'status': 'loading'}), 503
+    return jsonify({
+        'status': 'ready',
+        'documents': len(_rag_system.collection.index["documents"])
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 格式的指標：各階段延遲直方圖、排隊深度、快取命中率等"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
+    # 在背景線程中預載向量資料庫
+    threading.Thread(target=preload_vector_store, daemon=True).start()
+    
     # 設置 host='0.0.0.0' 使其監聽所有網絡接口
     # port=5000 是默認端口，可以根據需要修改
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
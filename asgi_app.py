@@ -0,0 +1,228 @@
+"""
+ASGI 版本的 TSD AI 助手
+
+/api/query/stream 以協程實現，每個打開的 SSE 連線只佔用一個協程；
+其餘頁面與 API 仍由 Flask 應用處理（透過 WSGIMiddleware 掛載），
+任務表與歷史紀錄與 Flask 版本共用，查詢流程與 SSE 事件由 query_pipeline.query_events 產生，兩個版本只是驅動方式不同。
+
+啟動方式:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as flask_module
+from app import (
+    format_queue_event, format_rejected_response, format_heartbeat,
+    register_task, set_task_interactions, save_history, QueryStreamTask,
+    admission_controller, SSE_HEARTBEAT_SECONDS,
+)
+from admission import QueueFullError
+from cancellation import install_shutdown_handlers
+from async_rag import AsyncRAGAgentSystem, AsyncSpeculativeSynthesis
+from query_pipeline import StageCall, query_events, failure_event, format_step
+
+def get_client_ip(request):
+    """獲取客戶端IP地址"""
+    if request.headers.get('X-Forwarded-For'):
+        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
+    elif request.headers.get('X-Real-IP'):
+        return request.headers.get('X-Real-IP')
+    else:
+        return request.client.host if request.client else None
+
+class TaskStreamingResponse(StreamingResponse):
+    """SSE 響應：響應結束時（包括生成器尚未啟動客戶端就已斷開）執行 on_close，對應 Flask 的 call_on_close"""
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def create_task_rag_system():
+    """創建新的RAG系統實例，共享已載入的向量資料庫（冷啟動時包含載入索引，須在線程中執行）"""
+    return AsyncRAGAgentSystem(
+        reset_db=False, db_path="./custom_json_rag_db", collection=flask_module.get_rag_system().collection
+    )
+
+async def wait_for_admission(ticket, task_rag_system):
+    """等待准入（wait_for_admission 的異步版本）
+
+    獲准入或任務被取消時立即喚醒；每秒檢查一次排隊位置，位置變化時產出 SSE 事件，不變時定期產出心跳。
+    """
+    if ticket.granted:
+        return
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+
+    def wake():
+        loop.call_soon_threadsafe(wakeup.set)
+
+    ticket.on_granted(wake)
+    handle = task_rag_system.cancel_token.register(wake)
+    try:
+        last_position = None
+        last_sent = time.time()
+        while not ticket.granted:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            task_rag_system._check_stop_flag()
+            if ticket.granted:
+                break
+            position = admission_controller.position(ticket)
+            if position != last_position:
+                last_position = position
+                last_sent = time.time()
+                yield format_queue_event(ticket)
+            elif time.time() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                last_sent = time.time()
+                yield format_heartbeat()
+        if last_position is not None:
+            # 通知前端排隊結束
+            yield format_queue_event(ticket)
+    finally:
+        task_rag_system.cancel_token.unregister(handle)
+
+class AsyncQueryStages:
+    """query_events 請求的階段（異步實現）：Ollama 呼叫 await 異步方法，CPU 與磁碟工作放到線程中"""
+
+    def __init__(self, task_rag_system, speculation, task_id):
+        self.rag_system = task_rag_system
+        self.speculation = speculation
+        self.task_id = task_id
+
+    async def search(self, question, n_results, date_range):
+        return await self.rag_system.asearch_documents(question, n_results=n_results, date_range=date_range)
+
+    async def rerank(self, question, documents, n_results):
+        return await asyncio.to_thread(self.rag_system.rerank_documents, question, documents, n_results)
+
+    async def filter(self, question, doc):
+        return await self.rag_system.afilter_documents(question, [doc])
+
+    async def speculative_result(self, relevant_docs):
+        return await self.speculation.result(relevant_docs)
+
+    async def generate(self, question, relevant_docs):
+        return await self.rag_system.agenerate_answer(question, relevant_docs)
+
+    async def save_history(self, question, date_range, steps_data, filter_interactions):
+        await asyncio.to_thread(save_history, question, date_range, steps_data, self.task_id, filter_interactions)
+
+async def drive_query_events(events, stages):
+    """驅動 query_events（drive_query_events 的異步版本）：SSE 事件直接產出，StageCall 以 await 執行"""
+    result = None
+    try:
+        while True:
+            try:
+                item = events.send(result)
+            except StopIteration:
+                return
+            if isinstance(item, StageCall):
+                result = await getattr(stages, item.stage)(*item.args, **item.kwargs)
+            else:
+                result = None
+                yield item
+    finally:
+        events.close()
+
+async def query_stream(request):
+    """處理實時查詢的 SSE 端點（異步版本）"""
+    question = request.query_params.get('question', '')
+    date_range = request.query_params.get('date_range', '').strip()
+
+    if not question:
+        return JSONResponse({'error': '問題不能為空'}, status_code=400)
+
+    client_ip = get_client_ip(request)
+    task_id = str(uuid.uuid4())
+
+    task_rag_system = await asyncio.to_thread(create_task_rag_system)
+
+    # 請求准入，排隊過深時直接拒絕
+    try:
+        ticket = admission_controller.enqueue(client_ip, task_id)
+    except QueueFullError as e:
+        body, headers = format_rejected_response(e)
+        return Response(body, media_type='text/event-stream', headers=headers)
+
+    register_task(client_ip, task_id, task_rag_system)
+    speculation = AsyncSpeculativeSynthesis(task_rag_system, question) if task_rag_system.speculative_synthesis else None
+
+    stream_task = QueryStreamTask(client_ip, task_id, ticket, task_rag_system, speculation)
+
+    async def generate():
+        try:
+            print(f"收到查詢請求: IP={client_ip}, 問題='{question}', 時間區間='{date_range}'")
+
+            yield format_step('task_id', task_id=task_id)
+
+            # 0. 排隊等待 LLM 名額（不佔用線程，釋放名額時立即喚醒）
+            async for event in wait_for_admission(ticket, task_rag_system):
+                yield event
+
+            # 1-3. 搜索 → 重排 → 篩選 → 生成答案
+            async for event in drive_query_events(
+                query_events(task_rag_system, question, date_range, speculation, stream_task,
+                             lambda interactions: set_task_interactions(client_ip, task_id, interactions)),
+                AsyncQueryStages(task_rag_system, speculation, task_id)
+            ):
+                yield event
+
+        except asyncio.CancelledError:
+            # 客戶端斷開連線：協程被取消時進行中的 Ollama 請求已隨之關閉
+            stream_task.outcome = 'cancelled'
+            task_rag_system.stop_current_task('disconnect')
+            raise
+        except Exception as e:
+            # TaskCancelled: 其他途徑的取消（例如同一 IP 重新載入頁面）
+            stream_task.outcome, event = failure_event(e)
+            yield event
+        finally:
+            stream_task.finish()
+
+    return TaskStreamingResponse(generate(), stream_task.close, media_type='text/event-stream')
+
+def preload_if_needed():
+    """gunicorn 未在 fork 前預載時，載入向量資料庫"""
+    if not flask_module.get_rag_system().collection.is_loaded():
+        flask_module.preload_vector_store()
+
+@asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    # 在背景線程載入（冷啟動時讀取索引與嵌入矩陣可能需要數秒，不阻塞事件循環），/api/ready 在載入完成後轉為就緒
+    loop.run_in_executor(None, preload_if_needed)
+    # uvicorn 收到 SIGTERM/SIGINT 後先等所有連線結束，之後才觸發 lifespan shutdown，
+    # 開著的 SSE 串流會讓生成一直持續到優雅關閉逾時。uvicorn 的信號處理器在 startup 之前已安裝，
+    # 這裡包一層：信號到達時先在事件循環中中斷所有任務，串流隨即結束，再交由 uvicorn 關閉
+    if threading.current_thread() is threading.main_thread():
+        install_shutdown_handlers(lambda: loop.call_soon_threadsafe(flask_module.stop_all_tasks))
+    yield
+    flask_module.stop_all_tasks()
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/api/query/stream', query_stream),
+    # 其他頁面與 API 交由 Flask 應用處理
+    Mount('/', app=WSGIMiddleware(flask_module.app)),
+])
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
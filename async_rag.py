@@ -0,0 +1,211 @@
+import asyncio
+import time
+from typing import List, Dict
+
+import numpy as np
+import ollama
+
+from agent_rag import (
+    CustomRAGAgentSystem,
+    DOCUMENT_FILTER_SYSTEM_MESSAGE,
+    ANSWER_SYNTHESIZER_SYSTEM_MESSAGE,
+    convert_to_traditional,
+)
+from query_expansion import QUERY_EXPANSION_SYSTEM_MESSAGE
+from telemetry import span, traced
+from cancellation import TaskCancelled, await_cancellable
+
+class AsyncSpeculativeSynthesis:
+    """SpeculativeSynthesis 的異步版本：投機生成以 asyncio 任務執行，集合變化時可直接取消"""
+
+    def __init__(self, rag_system, question: str):
+        self.rag_system = rag_system
+        self.question = question
+        self.started = 0
+        self._task = None
+        self._keys = None
+
+    def maybe_start(self, relevant_docs: List[Dict]):
+        if self._task is not None and not self._task.done():
+            return
+        keys = [self.rag_system._doc_key(doc) for doc in relevant_docs]
+        if not keys or keys == self._keys:
+            return
+        self._keys = keys
+        self._task = asyncio.create_task(self.rag_system.agenerate_answer(self.question, list(relevant_docs)))
+        self.started += 1
+        print(f"以 {len(keys)} 個已確認的相關文檔開始投機生成答案")
+
+    async def result(self, relevant_docs: List[Dict]):
+        """返回可採用的投機答案；集合不同時取消投機任務並返回 None"""
+        if self._task is None:
+            return None
+        keys = [self.rag_system._doc_key(doc) for doc in relevant_docs]
+        if keys != self._keys:
+            self.cancel()
+            return None
+        try:
+            return await self._task
+        except Exception as e:
+            print(f"投機生成答案失敗: {e}")
+            return None
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+class AsyncRAGAgentSystem(CustomRAGAgentSystem):
+    """以 asyncio 實現的 搜索→篩選→生成 流程
+
+    等待 Ollama 的時間只佔用協程而不是 OS 線程，
+    提示詞、排序與時間區間過濾邏輯都沿用 CustomRAGAgentSystem。
+    """
+
+    def __init__(self, reset_db=False, db_path="./custom_json_rag_db", collection=None):
+        super().__init__(reset_db=reset_db, db_path=db_path, collection=collection)
+        self.async_client = ollama.AsyncClient(host=self.ollama_host)
+
+    async def _chat(self, system_message: str, prompt: str, stage: str, model: str = None) -> str:
+        """直接呼叫 Ollama chat API，與 _ollama_chat 使用相同的系統提示詞與溫度（任務取消時中止）"""
+        response = await await_cancellable(self.cancel_token, self.async_client.chat(
+            model=model or self.llm_model,
+            messages=[
+                {'role': 'system', 'content': system_message},
+                {'role': 'user', 'content': prompt},
+            ],
+            **self._chat_options(),
+        ), stage=stage)
+        self._record_prefill(system_message, prompt, response)
+        return response["message"]["content"]
+
+    async def aexpand_query(self, query: str) -> List[str]:
+        """expand_query 的異步版本"""
+        if self.query_expansion not in ('rules', 'llm'):
+            return [query]
+        llm_output = None
+        if self.query_expansion == 'llm':
+            try:
+                with span('search.expand', log=self.span_log):
+                    llm_output = await self._chat(QUERY_EXPANSION_SYSTEM_MESSAGE, query, stage='search.expand',
+                                                  model=self.query_expansion_model)
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                print(f"LLM 查詢改寫失敗，只使用規則改寫: {e}")
+        return self._merge_expansions(query, llm_output)
+
+    @traced('search')
+    async def asearch_documents(self, query: str, n_results: int = 6, date_range: str = '') -> List[Dict]:
+        """搜索最相關的文檔（異步版本）"""
+        try:
+            print(f"開始搜索，查詢: {query}, 時間區間: {date_range}")
+
+            self._check_stop_flag()
+
+            queries = await self.aexpand_query(query)
+
+            # 原問題與改寫以一次嵌入呼叫批量計算
+            with span('search.embed', log=self.span_log, queries=len(queries)):
+                response = await await_cancellable(
+                    self.cancel_token,
+                    self.async_client.embed(model=self.embedding_model, input=queries, keep_alive=self.keep_alive),
+                    stage='search.embed'
+                )
+            query_embedding = np.array(response["embeddings"])
+            print(f"查詢向量維度: {query_embedding.shape}")
+
+            self._check_stop_flag()
+
+            # 讀盤與矩陣運算放到線程池，避免阻塞事件循環
+            final_results = await asyncio.to_thread(self._rank_documents, query_embedding, n_results, date_range)
+            print(f"返回 {len(final_results)} 個結果")
+
+            self._check_stop_flag()
+
+            return final_results
+
+        except Exception as e:
+            if self._stop_flag:
+                print("搜索任務被用戶中斷")
+                return []
+            print(f"文檔搜索失敗: {str(e)}")
+            return []
+
+    @traced('filter')
+    async def afilter_documents(self, query: str, documents: List[Dict]) -> List[Dict]:
+        """使用第一個LLM篩選文檔（異步版本）"""
+        relevant_docs = []
+        filter_interactions = {}
+
+        for doc in documents:
+            self._check_stop_flag()
+
+            stop_reason = self.early_stop_reason(relevant_docs, doc)
+            if stop_reason:
+                print(stop_reason)
+                break
+
+            filter_prompt = self._build_filter_prompt(query, doc)
+            prompt_time = time.time()
+            content, error = None, None
+            try:
+                with span('filter.llm', log=self.span_log, doc=self._doc_key(doc)):
+                    content = await self._chat(DOCUMENT_FILTER_SYSTEM_MESSAGE, filter_prompt, stage='filter.llm')
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                error = e
+
+            interaction = self._filter_interaction(doc, filter_prompt, prompt_time, content, error)
+            filter_interactions[self._doc_key(doc)] = interaction
+            if interaction['is_relevant']:
+                relevant_docs.append(doc)
+
+            # 每處理完一個文檔後休息一段時間（取消時立即結束）
+            with span('filter.sleep', log=self.span_log):
+                await await_cancellable(self.cancel_token, asyncio.sleep(self.filter_interval),
+                                        stage='filter.sleep', expected_seconds=self.filter_interval)
+
+            self._check_stop_flag()
+
+        for doc in relevant_docs:
+            doc_key = self._doc_key(doc)
+            if doc_key in filter_interactions:
+                doc['filter_interaction'] = filter_interactions[doc_key]
+
+        return relevant_docs, filter_interactions
+
+    @traced('generate')
+    async def agenerate_answer(self, query: str, relevant_docs: List[Dict]) -> str:
+        """使用第二個LLM生成最終答案（異步版本）"""
+        if len(relevant_docs) == 0:
+            return "沒有找到相關文檔來回答您的問題。"
+
+        self._check_stop_flag()
+
+        synthesis_prompt = self._build_synthesis_prompt(query, relevant_docs)
+
+        try:
+            with span('generate.llm', log=self.span_log):
+                content = await self._chat(ANSWER_SYNTHESIZER_SYSTEM_MESSAGE, synthesis_prompt, stage='generate.llm')
+
+            self._check_stop_flag()
+
+            if content:
+                return convert_to_traditional(content)
+            return "生成答案失敗"
+        except Exception as e:
+            if self._stop_flag:
+                return "答案生成被用戶中斷"
+            print(f"獲取答案失敗: {e}")
+            return "生成答案過程中發生錯誤"
+
+    async def aquery(self, question: str) -> str:
+        """完整的RAG查詢流程（異步版本）"""
+        documents = await self.asearch_documents(question, n_results=self.candidate_count(6))
+        # 重排在 CPU 上執行，放到線程中避免阻塞事件循環
+        documents = await asyncio.to_thread(self.rerank_documents, question, documents, 6)
+        if not documents:
+            return "沒有找到相關文檔"
+        relevant_docs, _ = await self.afilter_documents(question, documents)
+        return await self.agenerate_answer(question, relevant_docs)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+批量問題查詢（離線評估、預先計算常見問題）
+
+輸入為 JSONL，每行 {"id": ..., "question": ..., "date_range": ...}（id 與 date_range 可省略）；
+輸出同樣是 JSONL，每個問題完成時寫入一行，含答案、搜索與篩選結果及各階段耗時。
+- 檢索：每 batch_size 個問題以一次 Ollama 呼叫計算嵌入，同一時間區間的問題以一次矩陣–矩陣乘法評分
+- LLM 篩選與答案生成：交給 workers 個工作線程，同時進行的 LLM 任務數受限
+- 可續跑：輸出文件中已成功的問題會被略過，失敗的問題重新執行
+
+用法:
+    python batch_query.py questions.jsonl -o results.jsonl --workers 2
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from agent_rag import CustomRAGAgentSystem
+
+def load_questions(path: str) -> List[Dict]:
+    """讀取 JSONL 問題文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_questions(f)
+
+def parse_questions(lines: Iterable[str]) -> List[Dict]:
+    """解析 JSONL 問題（也接受每行一個純文字問題），未提供 id 時按行號編號"""
+    questions = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = line
+        if isinstance(record, str):
+            record = {'question': record}
+        elif not isinstance(record, dict):
+            # 數字、列表等不是問題記錄的 JSON 值按純文字問題處理
+            record = {'question': line}
+        if not record.get('question'):
+            print(f"第 {line_number} 行沒有問題，已略過")
+            continue
+        record.setdefault('id', f"q{line_number}")
+        questions.append(record)
+    return questions
+
+def completed_ids(output_path: str) -> set:
+    """輸出文件中已成功完成的問題 id（中斷時寫了一半的行與失敗的問題不計）"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if 'error' not in record:
+                done.add(str(record.get('id')))
+    return done
+
+def _format_hit(doc: Dict) -> Dict:
+    return {
+        'filename': doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source'])),
+        'chunk_id': doc['metadata'].get('chunk_id', 0),
+        'similarity': round(1 - doc['distance'], 4),
+        'timestamp': doc.get('timestamp', ''),
+    }
+
+class BatchQueryRunner:
+    """批量執行問題：批量檢索後把 LLM 階段分派到有界的工作線程池
+
+    admit: 可選的上下文管理器工廠，每個問題的 LLM 階段在其中執行（例如 Web 服務的准入控制）
+    """
+
+    def __init__(self, collection, workers: int = 2, batch_size: int = 32, n_results: int = 4,
+                 filter_interval: float = None, admit: Callable = None):
+        self.collection = collection
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.n_results = n_results
+        self.filter_interval = filter_interval
+        self.admit = admit
+        # 用於批量嵌入與排序的實例；各問題的 LLM 階段另建實例（各自的取消令牌與統計）
+        self.retriever = self._new_system()
+        self._systems = set()
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def _new_system(self) -> CustomRAGAgentSystem:
+        system = CustomRAGAgentSystem(reset_db=False, collection=self.collection)
+        if self.filter_interval is not None:
+            system.filter_interval = self.filter_interval
+        return system
+
+    def cancel(self, reason: str = 'stop'):
+        """停止排程新的問題並取消進行中的 LLM 呼叫"""
+        with self._lock:
+            self._cancelled = True
+            systems = list(self._systems)
+        self.retriever.stop_current_task(reason)
+        for system in systems:
+            system.stop_current_task(reason)
+
+    def run(self, questions: List[Dict]) -> Iterator[Dict]:
+        """執行所有問題，按完成順序逐一產出結果"""
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch-query') as pool:
+            try:
+                for start in range(0, len(questions), self.batch_size):
+                    if self._cancelled:
+                        break
+                    batch = questions[start:start + self.batch_size]
+                    for record, documents, retrieve_seconds in self._retrieve(batch):
+                        pending.append(pool.submit(self._answer, record, documents, retrieve_seconds))
+                    # 每批檢索後先送出已完成的結果，再開始下一批
+                    for future in [f for f in pending if f.done()]:
+                        pending.remove(future)
+                        yield future.result()
+                    # 排隊的問題過多時等待，避免檢索遠遠跑在 LLM 前面
+                    while len(pending) > self.workers * 2 and not self._cancelled:
+                        future = pending.pop(0)
+                        yield future.result()
+                while pending:
+                    yield pending.pop(0).result()
+            finally:
+                if pending:
+                    self.cancel('batch closed')
+
+    def _retrieve(self, batch: List[Dict]):
+        """批量嵌入與評分，返回 [(問題, 搜索結果, 攤分的檢索耗時)]"""
+        start_time = time.time()
+        try:
+            embeddings = self.retriever.embed_queries([record['question'] for record in batch])
+        except Exception as e:
+            print(f"批量嵌入失敗: {e}")
+            return [(record, e, 0.0) for record in batch]
+        # 同一時間區間的問題共用候選集合，一起評分
+        groups = {}
+        for i, record in enumerate(batch):
+            groups.setdefault(record.get('date_range') or '', []).append(i)
+        documents = [None] * len(batch)
+        for date_range, members in groups.items():
+            try:
+                ranked = self.retriever.rank_documents_batch(
+                    embeddings[members], self.retriever.candidate_count(self.n_results), date_range
+                )
+                for i, docs in zip(members, ranked):
+                    documents[i] = docs
+            except Exception as e:
+                print(f"批量檢索失敗: {e}")
+                for i in members:
+                    documents[i] = e
+        retrieve_seconds = (time.time() - start_time) / len(batch)
+        print(f"已檢索 {len(batch)} 個問題，耗時 {time.time() - start_time:.2f} 秒")
+        return [(record, docs, retrieve_seconds) for record, docs in zip(batch, documents)]
+
+    def _answer(self, record: Dict, documents, retrieve_seconds: float) -> Dict:
+        """單個問題的重排、LLM 篩選與答案生成"""
+        question = record['question']
+        result = {'id': record['id'], 'question': question, 'date_range': record.get('date_range', '')}
+        timings = {'retrieve': round(retrieve_seconds, 3)}
+        if isinstance(documents, Exception):
+            result['error'] = f"檢索失敗: {documents}"
+            result['timings'] = timings
+            return result
+        queued_at = time.time()
+        system = self._new_system()
+        with self._lock:
+            if self._cancelled:
+                result['error'] = '批量查詢已停止'
+                return result
+            self._systems.add(system)
+        try:
+            if self.admit:
+                with self.admit(record['id'], system):
+                    self._run_llm_stages(system, question, documents, result, timings, queued_at)
+            else:
+                self._run_llm_stages(system, question, documents, result, timings, queued_at)
+        except Exception as e:
+            print(f"問題 {record['id']} 處理失敗: {e}")
+            result['error'] = str(e)
+        finally:
+            with self._lock:
+                self._systems.discard(system)
+        result['timings'] = timings
+        result['prefill'] = dict(system.prefill_stats)
+        return result
+
+    def _run_llm_stages(self, system, question, documents, result, timings, queued_at):
+        timings['queue'] = round(time.time() - queued_at, 3)
+        pipeline_start = time.time()
+        stage_start = time.time()
+        documents = system.rerank_documents(question, documents, self.n_results)
+        timings['rerank'] = round(time.time() - stage_start, 3)
+        result['search'] = [_format_hit(doc) for doc in documents]
+
+        stage_start = time.time()
+        relevant_docs, _ = system.filter_documents(question, documents)
+        timings['filter'] = round(time.time() - stage_start, 3)
+        result['relevant'] = [_format_hit(doc) for doc in relevant_docs]
+
+        stage_start = time.time()
+        result['answer'] = system.generate_answer(question, relevant_docs)
+        timings['generate'] = round(time.time() - stage_start, 3)
+        timings['total'] = round(timings['retrieve'] + time.time() - pipeline_start, 3)
+
+def run_to_file(runner: BatchQueryRunner, questions: List[Dict], output_path: str, resume: bool = True) -> Dict:
+    """執行並把結果逐行追加到 output_path，返回統計"""
+    done = completed_ids(output_path) if resume else set()
+    todo = [record for record in questions if str(record['id']) not in done]
+    print(f"共 {len(questions)} 個問題，已完成 {len(questions) - len(todo)} 個，本次執行 {len(todo)} 個")
+    # 上次中斷在行中間時補上換行，避免新結果接在殘缺的行後
+    if resume and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+        if needs_newline:
+            with open(output_path, 'a', encoding='utf-8') as f:
+                f.write('\n')
+    stats = {'total': len(questions), 'skipped': len(questions) - len(todo), 'answered': 0, 'failed': 0}
+    start_time = time.time()
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as f:
+        for result in runner.run(todo):
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            f.flush()
+            stats['failed' if 'error' in result else 'answered'] += 1
+            print(f"[{stats['answered'] + stats['failed']}/{len(todo)}] {result['id']} "
+                  f"{'失敗' if 'error' in result else '完成'} {result.get('timings', {})}")
+    stats['seconds'] = round(time.time() - start_time, 2)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="批量執行問題查詢，結果輸出為 JSONL")
+    parser.add_argument('questions', help='問題 JSONL 文件（每行 {"id", "question", "date_range"}）')
+    parser.add_argument('-o', '--output', required=True, help='結果 JSONL 文件（已存在時續跑）')
+    parser.add_argument('--db', default='./custom_json_rag_db', help='向量資料庫目錄')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('TSD_MAX_CONCURRENT_TASKS', 2)),
+                        help='同時執行 LLM 階段的問題數')
+    parser.add_argument('--batch-size', type=int, default=32, help='每次嵌入與評分的問題數')
+    parser.add_argument('--n-results', type=int, default=4, help='每個問題交給 LLM 篩選的片段數')
+    parser.add_argument('--filter-interval', type=float, help='篩選呼叫之間的等待秒數（預設沿用 TSD_FILTER_INTERVAL）')
+    parser.add_argument('--no-resume', action='store_true', help='覆寫輸出文件，重新執行所有問題')
+    args = parser.parse_args()
+
+    from vector_db import JSONVectorDB
+
+    questions = load_questions(args.questions)
+    collection = JSONVectorDB(args.db)
+    collection.preload()
+    runner = BatchQueryRunner(collection, workers=args.workers, batch_size=args.batch_size,
+                              n_results=args.n_results, filter_interval=args.filter_interval)
+    try:
+        stats = run_to_file(runner, questions, args.output, resume=not args.no_resume)
+    except KeyboardInterrupt:
+        runner.cancel('interrupted')
+        print("已中斷，再次執行相同命令即可從中斷處繼續")
+        return
+    print(f"批量查詢完成: {stats}")
+
+if __name__ == '__main__':
+    main()
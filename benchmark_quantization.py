@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+嵌入量化評估：比較 float32 / float16 / int8 搜索矩陣的召回率與延遲
+
+以 float32 全量精確搜索的結果為基準，對每種模式計算 recall@k、
+單次搜索延遲（平均 / p95）與記憶體矩陣大小。
+
+查詢向量預設取自語料本身（隨機片段的嵌入加上少量噪聲）；
+提供 --questions 時改用 Ollama 對問題文件逐行計算嵌入。
+
+用法:
+    python benchmark_quantization.py
+    python benchmark_quantization.py --db ./custom_json_rag_db -k 4 --queries 200
+    python benchmark_quantization.py --questions questions.txt --json report.json
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from vector_db import JSONVectorDB, QUANTIZATION_MODES, cosine_scores, top_k_indices
+
+def load_queries(db: JSONVectorDB, args):
+    """生成查詢向量"""
+    if args.questions:
+        import ollama
+        from agent_rag import CustomRAGAgentSystem
+        with open(args.questions, 'r', encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+        rag_system = CustomRAGAgentSystem(db_path=args.db, collection=db)
+        response = ollama.embed(model=rag_system.embedding_model, input=questions)
+        return np.array(response["embeddings"], dtype=np.float32)
+
+    embeddings = db.get(include=["embeddings"])["embeddings"]
+    rng = np.random.default_rng(args.seed)
+    picks = rng.choice(len(embeddings), size=min(args.queries, len(embeddings)), replace=False)
+    queries = np.asarray(embeddings[picks], dtype=np.float32)
+    noise = rng.normal(size=queries.shape).astype(np.float32)
+    noise *= args.noise * np.linalg.norm(queries, axis=1, keepdims=True) / np.sqrt(queries.shape[1])
+    return queries + noise
+
+def exact_top_k(db: JSONVectorDB, queries: np.ndarray, k: int):
+    """以磁碟上的 float32 向量計算精確 top-k，作為基準"""
+    ids = db.get(include=["ids"])["ids"]
+    rows = np.array([db.index["embedding_rows"][doc_id] for doc_id in ids], dtype=np.int64)
+    matrix = db.embeddings.matrix(db.index["embedding_dim"])
+    truth = []
+    for query in queries:
+        scores = cosine_scores(matrix, rows, query / np.linalg.norm(query))
+        truth.append({ids[i] for i in top_k_indices(scores, k)})
+    return truth
+
+def evaluate_mode(db_path: str, mode: str, queries: np.ndarray, truth, k: int):
+    db = JSONVectorDB(db_path, quantization=mode)
+    db.preload()
+    db.search(queries[0], k)  # 預熱
+
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = db.search(query, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found = {doc_id for doc_id, _ in hits}
+        recalls.append(len(found & expected) / max(len(expected), 1))
+
+    return {
+        "mode": mode,
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+        "latency_ms_mean": round(float(np.mean(latencies)), 3),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+        "matrix_mb": round(db._embedding_matrix.nbytes / 1024 / 1024, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="嵌入量化召回率與延遲評估")
+    parser.add_argument('--db', default='./custom_json_rag_db', help='向量資料庫目錄')
+    parser.add_argument('-k', type=int, default=4, help='評估的 top-k')
+    parser.add_argument('--queries', type=int, default=100, help='從語料抽樣的查詢數')
+    parser.add_argument('--noise', type=float, default=0.3, help='抽樣查詢加入的相對噪聲')
+    parser.add_argument('--questions', help='問題文件（每行一個），以 Ollama 計算嵌入')
+    parser.add_argument('--modes', default=','.join(QUANTIZATION_MODES), help='要比較的模式')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='將報告寫入 JSON 文件')
+    args = parser.parse_args()
+
+    base_db = JSONVectorDB(args.db, quantization="float32")
+    if not base_db.index["embedding_rows"]:
+        print("❌ 資料庫中沒有嵌入向量")
+        return
+
+    queries = load_queries(base_db, args)
+    truth = exact_top_k(base_db, queries, args.k)
+
+    report = [evaluate_mode(args.db, mode, queries, truth, args.k) for mode in args.modes.split(',')]
+
+    print("=" * 60)
+    print(f"量化評估: {len(base_db.index['embedding_rows'])} 個向量, {len(queries)} 個查詢, k={args.k}")
+    print("=" * 60)
+    print(f"{'模式':<10}{'recall@' + str(args.k):>10}{'平均(ms)':>12}{'p95(ms)':>12}{'矩陣(MB)':>12}")
+    for row in report:
+        print(f"{row['mode']:<10}{row[f'recall@{args.k}']:>10.4f}{row['latency_ms_mean']:>12.3f}"
+              f"{row['latency_ms_p95']:>12.3f}{row['matrix_mb']:>12.2f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"k": args.k, "queries": len(queries), "results": report}, f, ensure_ascii=False, indent=2)
+        print(f"報告已寫入 {args.json}")
+
+if __name__ == '__main__':
+    main()
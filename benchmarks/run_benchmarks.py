@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""
+離線基準測試套件
+
+以 Ollama 替身服務（stub_ollama.py）與合成工單語料（synthetic_corpus.py）執行以下場景，
+結果寫成 JSON 報告，可與先前的報告比較以發現效能回歸：
+
+- ingest             txt 文件走 add_document 導入（切分 + 嵌入，--chunking 選擇切分方式），量測片段/秒
+- vector_query       JSONVectorDB.query 延遲（按量化模式，分 mmap 與預載兩種狀態）
+- search_date_range  search_documents 在不同時間區間下的延遲（含嵌入呼叫與元數據過濾）
+- search_threads     JSONVectorDB.query 在 1/2/4/8 個評分線程下的延遲與相對單線程的加速比（mmap 與預載）
+- query_stream       /api/query/stream 在不同併發數下的首個事件、答案延遲與准入結果
+
+用法:
+    python benchmarks/run_benchmarks.py --chunks 10000 --output report.json
+    python benchmarks/run_benchmarks.py --chunks 1000000 --scenarios vector_query,search_date_range
+    python benchmarks/run_benchmarks.py --chunks 1000000 --scenarios search_threads --threads 1,2,4,8
+    python benchmarks/run_benchmarks.py --chat-latency-ms 300 --concurrency 1,4,16 --baseline old.json
+    python benchmarks/run_benchmarks.py --ollama-host 127.0.0.1:11434   # 改用真實 Ollama
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from stub_ollama import DEFAULT_DIM, StubBackend, deterministic_embedding, start_stub_server
+from synthetic_corpus import build_vector_db, sample_questions, write_ticket_files
+
+SCENARIOS = ("ingest", "vector_query", "search_date_range", "search_threads", "query_stream")
+
+# 語料日期為 2020-01-01 至 2025-12-31
+DATE_RANGES = {
+    "all": "all time",
+    "year": "20240101 - 20241231",
+    "month": "20240301 - 20240331",
+    "week": "20240301 - 20240307",
+}
+
+def latency_summary(samples):
+    """延遲樣本（毫秒）的統計"""
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=np.float64)
+    return {
+        "count": int(len(values)),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        commit = ''
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "git_commit": commit,
+    }
+
+def prepare_corpus_db(args, db_path: str):
+    """建立（或沿用）合成語料資料庫"""
+    from vector_db import JSONVectorDB
+
+    if args.reuse_db and os.path.exists(os.path.join(db_path, "index.json")):
+        db = JSONVectorDB(db_path)
+        if len(db.index["documents"]) == args.chunks and db.index.get("embedding_dim") == args.dim:
+            print(f"沿用已有的合成資料庫: {db_path}")
+            return 0.0
+    start_time = time.time()
+    build_vector_db(db_path, args.chunks, dim=args.dim, seed=args.seed)
+    return round(time.time() - start_time, 3)
+
+def scenario_ingest(args, workdir: str, backend):
+    from agent_rag import CustomRAGAgentSystem
+
+    source_dir = os.path.join(workdir, "ingest_files")
+    db_path = os.path.join(workdir, "ingest_db")
+    paths = write_ticket_files(source_dir, args.ingest_chunks, args.tickets_per_file, args.seed)
+    rag_system = CustomRAGAgentSystem(reset_db=True, db_path=db_path)
+    rag_system.chunking = args.chunking
+
+    embed_calls = backend.stats['embed_calls'] if backend else None
+    latencies = []
+    failed = 0
+    start_time = time.perf_counter()
+    for path in paths:
+        file_start = time.perf_counter()
+        if not rag_system.add_document(path, "txt"):
+            failed += 1
+        latencies.append((time.perf_counter() - file_start) * 1000)
+    elapsed = time.perf_counter() - start_time
+
+    chunks = len(rag_system.collection.index["documents"])
+    result = {
+        "chunking": args.chunking,
+        "files": len(paths),
+        "failed_files": failed,
+        "tickets": args.ingest_chunks,
+        "chunks": chunks,
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(chunks / elapsed, 2) if elapsed else None,
+        "per_file": latency_summary(latencies),
+    }
+    if backend:
+        result["embed_calls"] = backend.stats['embed_calls'] - embed_calls
+    return result
+
+def scenario_vector_query(args, db_path: str):
+    from vector_db import JSONVectorDB
+
+    questions = sample_questions(args.queries, seed=args.seed + 1)
+    results = {}
+    for mode in args.modes.split(','):
+        start_time = time.perf_counter()
+        db = JSONVectorDB(db_path, quantization=mode)
+        load_seconds = time.perf_counter() - start_time
+        dim = db.index["embedding_dim"]
+        queries = [deterministic_embedding(q, dim) for q in questions]
+
+        def run_queries():
+            db.query(query_embeddings=[queries[0]], n_results=args.k)  # 預熱
+            samples = []
+            for query in queries:
+                query_start = time.perf_counter()
+                db.query(query_embeddings=[query], n_results=args.k)
+                samples.append((time.perf_counter() - query_start) * 1000)
+            return samples
+
+        mmap_samples = run_queries()
+        start_time = time.perf_counter()
+        db.preload()
+        preload_seconds = time.perf_counter() - start_time
+        preloaded_samples = run_queries()
+
+        results[mode] = {
+            "index_load_seconds": round(load_seconds, 3),
+            "preload_seconds": round(preload_seconds, 3),
+            "matrix_mb": round(db._embedding_matrix.nbytes / 1024 / 1024, 2),
+            "mmap": latency_summary(mmap_samples),
+            "preloaded": latency_summary(preloaded_samples),
+        }
+    return {"chunks": args.chunks, "k": args.k, "modes": results}
+
+def scenario_search_date_range(args, db_path: str):
+    from agent_rag import CustomRAGAgentSystem
+    from vector_db import JSONVectorDB
+
+    db = JSONVectorDB(db_path)
+    db.preload()
+    rag_system = CustomRAGAgentSystem(db_path=db_path, collection=db)
+    questions = sample_questions(args.queries, seed=args.seed + 2)
+
+    results = {}
+    for name, date_range in DATE_RANGES.items():
+        rag_system.search_documents(questions[0], n_results=args.k, date_range=date_range)  # 預熱
+        samples = []
+        returned = []
+        for question in questions:
+            start_time = time.perf_counter()
+            docs = rag_system.search_documents(question, n_results=args.k, date_range=date_range)
+            samples.append((time.perf_counter() - start_time) * 1000)
+            returned.append(len(docs))
+        results[name] = dict(latency_summary(samples), date_range=date_range,
+                             mean_results=round(float(np.mean(returned)), 2))
+    return {"chunks": args.chunks, "k": args.k, "ranges": results}
+
+def scenario_search_threads(args, db_path: str):
+    from vector_db import JSONVectorDB
+
+    questions = sample_questions(args.queries, seed=args.seed + 3)
+    db = JSONVectorDB(db_path)
+    dim = db.index["embedding_dim"]
+    queries = [deterministic_embedding(q, dim) for q in questions]
+    thread_counts = [int(t) for t in args.threads.split(',')]
+
+    def run_queries():
+        results = {}
+        for threads in thread_counts:
+            db.search_threads = threads
+            db.query(query_embeddings=[queries[0]], n_results=args.k)  # 預熱（含線程池建立）
+            samples = []
+            for query in queries:
+                query_start = time.perf_counter()
+                db.query(query_embeddings=[query], n_results=args.k)
+                samples.append((time.perf_counter() - query_start) * 1000)
+            results[str(threads)] = latency_summary(samples)
+        baseline = results[str(thread_counts[0])]["mean_ms"]
+        for summary in results.values():
+            summary["speedup"] = round(baseline / summary["mean_ms"], 2) if summary["mean_ms"] else None
+        return results
+
+    mmap_results = run_queries()
+    db.preload()
+    preloaded_results = run_queries()
+    return {"chunks": args.chunks, "k": args.k, "cpu_count": os.cpu_count(),
+            "parallel_min_rows": db.parallel_min_rows,
+            "mmap": mmap_results, "preloaded": preloaded_results}
+
+def _stream_request(base_url: str, question: str, date_range: str, client_ip: str, timeout: float):
+    """發送一個 SSE 查詢並讀到串流結束，返回各時間點（毫秒）與結果"""
+    url = f"{base_url}/api/query/stream?" + urlencode({'question': question, 'date_range': date_range})
+    request = Request(url, headers={'X-Forwarded-For': client_ip, 'Accept': 'text/event-stream'})
+    result = {'outcome': 'incomplete', 'first_event_ms': None, 'answer_ms': None, 'total_ms': None}
+    start_time = time.perf_counter()
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            for raw_line in response:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                elapsed = (time.perf_counter() - start_time) * 1000
+                if result['first_event_ms'] is None:
+                    result['first_event_ms'] = elapsed
+                event = json.loads(line[len('data:'):])
+                if event.get('step') == 'answer':
+                    result['answer_ms'] = elapsed
+                    result['outcome'] = 'answer'
+                elif event.get('step') == 'error':
+                    result['outcome'] = 'rejected' if 'retry_after' in event else 'error'
+    except Exception as e:
+        print(f"串流請求失敗: {e}")
+        result['outcome'] = 'error'
+    result['total_ms'] = (time.perf_counter() - start_time) * 1000
+    return result
+
+def _start_flask_server(workdir: str):
+    """在工作目錄中啟動 app.py 的 Flask 應用（app 以相對路徑讀取資料庫、保存上傳與歷史紀錄）"""
+    os.chdir(workdir)
+    import app as app_module
+    from werkzeug.serving import make_server
+
+    app_module.preload_vector_store()
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+def scenario_query_stream(args, workdir: str):
+    server = None
+    if args.target_url:
+        base_url = args.target_url.rstrip('/')
+    else:
+        server, base_url = _start_flask_server(workdir)
+
+    try:
+        levels = {}
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            questions = sample_questions(concurrency * args.stream_requests, seed=args.seed + 3)
+            results = []
+            results_lock = threading.Lock()
+
+            def client(index: int):
+                # 每個模擬客戶端使用不同的 IP，讓准入控制按 IP 輪詢
+                client_ip = f"10.0.{index // 250}.{index % 250 + 1}"
+                for i in range(args.stream_requests):
+                    result = _stream_request(base_url, questions[index * args.stream_requests + i],
+                                             DATE_RANGES[args.stream_date_range], client_ip, args.stream_timeout)
+                    with results_lock:
+                        results.append(result)
+
+            start_time = time.perf_counter()
+            threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start_time
+
+            outcomes = {}
+            for result in results:
+                outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+            levels[str(concurrency)] = {
+                "requests": len(results),
+                "seconds": round(elapsed, 3),
+                "answers_per_second": round(outcomes.get('answer', 0) / elapsed, 3) if elapsed else None,
+                "outcomes": outcomes,
+                "first_event": latency_summary([r['first_event_ms'] for r in results if r['first_event_ms'] is not None]),
+                "time_to_answer": latency_summary([r['answer_ms'] for r in results if r['answer_ms'] is not None]),
+                "total": latency_summary([r['total_ms'] for r in results]),
+            }
+            print(f"併發 {concurrency}: {outcomes}，耗時 {elapsed:.2f} 秒")
+        return {"target": base_url if args.target_url else "flask (in-process)",
+                "filter_interval": float(os.environ['TSD_FILTER_INTERVAL']), "levels": levels}
+    finally:
+        if server is not None:
+            server.shutdown()
+
+def _flatten(report, prefix=''):
+    values = {}
+    for key, value in report.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            values.update(_flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+def compare_reports(current, baseline):
+    """列出延遲與吞吐指標相對基準報告的變化"""
+    before = _flatten(baseline.get("scenarios", {}))
+    after = _flatten(current.get("scenarios", {}))
+    keys = [k for k in after if k in before and k.endswith(('_ms', '_per_second', '_seconds'))]
+    if not keys:
+        print("沒有可比較的指標")
+        return
+    print("=" * 90)
+    print(f"{'指標':<62}{'基準':>10}{'本次':>10}{'變化':>8}")
+    for key in keys:
+        old, new = before[key], after[key]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "-"
+        print(f"{key:<62}{old:>10.3f}{new:>10.3f}{change:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="離線基準測試（Ollama 替身服務 + 合成語料）")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='要執行的場景')
+    parser.add_argument('--chunks', type=int, default=10000, help='查詢場景的語料片段數（1 萬至 100 萬）')
+    parser.add_argument('--dim', type=int, default=DEFAULT_DIM, help='嵌入向量維度')
+    parser.add_argument('--tickets-per-file', type=int, default=50)
+    parser.add_argument('--ingest-chunks', type=int, default=1000, help='導入場景的工單數')
+    parser.add_argument('--chunking', default='fixed', choices=['fixed', 'records'], help='導入場景的切分方式（TSD_CHUNKING）')
+    parser.add_argument('--queries', type=int, default=200, help='每種設定的查詢數')
+    parser.add_argument('-k', type=int, default=6, help='每次查詢返回的片段數')
+    parser.add_argument('--modes', default='float32,float16,int8', help='vector_query 比較的量化模式')
+    parser.add_argument('--threads', default='1,2,4,8', help='search_threads 比較的評分線程數（第一個為加速比基準）')
+    parser.add_argument('--concurrency', default='1,4,16', help='query_stream 的併發客戶端數')
+    parser.add_argument('--stream-requests', type=int, default=2, help='每個客戶端依序發送的查詢數')
+    parser.add_argument('--stream-date-range', default='year', choices=list(DATE_RANGES))
+    parser.add_argument('--stream-timeout', type=float, default=600)
+    parser.add_argument('--target-url', help='query_stream 改為請求已啟動的服務（例如 ASGI 版本）')
+    parser.add_argument('--filter-interval', type=float, default=0, help='篩選間隔秒數（TSD_FILTER_INTERVAL）')
+    parser.add_argument('--ollama-host', help='不啟動替身服務，改用此 Ollama 地址')
+    parser.add_argument('--embed-latency-ms', type=float, default=5)
+    parser.add_argument('--chat-latency-ms', type=float, default=50)
+    parser.add_argument('--prefill-ms-per-token', type=float, default=0.05)
+    parser.add_argument('--decode-ms-per-token', type=float, default=1)
+    parser.add_argument('--relevant-ratio', type=float, default=0.5)
+    parser.add_argument('--workdir', help='工作目錄（預設為臨時目錄，結束後刪除）')
+    parser.add_argument('--reuse-db', action='store_true', help='工作目錄中已有相同規模的語料時直接沿用')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='將報告寫入 JSON 文件')
+    parser.add_argument('--baseline', help='與先前的 JSON 報告比較')
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知的場景: {', '.join(sorted(unknown))}")
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='tsd_bench_'))
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    original_cwd = os.getcwd()
+
+    # 替身服務需在導入 ollama 之前啟動：ollama 套件導入時即讀取 OLLAMA_HOST
+    backend = None
+    stub_server = None
+    if args.ollama_host:
+        os.environ['OLLAMA_HOST'] = args.ollama_host
+    else:
+        backend = StubBackend(
+            dim=args.dim, embed_latency_ms=args.embed_latency_ms, chat_latency_ms=args.chat_latency_ms,
+            prefill_ms_per_token=args.prefill_ms_per_token, decode_ms_per_token=args.decode_ms_per_token,
+            relevant_ratio=args.relevant_ratio,
+        )
+        stub_server, address = start_stub_server(backend)
+        os.environ['OLLAMA_HOST'] = address
+        print(f"Ollama 替身服務: {address}")
+    os.environ['TSD_FILTER_INTERVAL'] = str(args.filter_interval)
+    os.environ['TSD_WARM_UP'] = '0'
+
+    report = {
+        "suite": "tsd-offline-benchmark",
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "environment": environment_info(),
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        "scenarios": {},
+    }
+
+    try:
+        db_path = os.path.join(workdir, "custom_json_rag_db")
+        if set(scenarios) & {"vector_query", "search_date_range", "search_threads", "query_stream"}:
+            report["corpus_build_seconds"] = prepare_corpus_db(args, db_path)
+
+        for name in scenarios:
+            print(f"\n=== 場景: {name} ===")
+            start_time = time.time()
+            try:
+                if name == "ingest":
+                    result = scenario_ingest(args, workdir, backend)
+                elif name == "vector_query":
+                    result = scenario_vector_query(args, db_path)
+                elif name == "search_date_range":
+                    result = scenario_search_date_range(args, db_path)
+                elif name == "search_threads":
+                    result = scenario_search_threads(args, db_path)
+                else:
+                    result = scenario_query_stream(args, workdir)
+            except Exception as e:
+                print(f"場景 {name} 執行失敗: {e}")
+                result = {"error": str(e)}
+            result["wall_seconds"] = round(time.time() - start_time, 3)
+            report["scenarios"][name] = result
+
+        if backend:
+            report["stub_stats"] = dict(backend.stats)
+    finally:
+        os.chdir(original_cwd)
+        if stub_server is not None:
+            stub_server.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report["scenarios"], ensure_ascii=False, indent=2))
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"報告已寫入 {output}")
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as f:
+            compare_reports(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
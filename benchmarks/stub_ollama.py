@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+離線基準測試用的 Ollama 替身服務
+
+實現本項目用到的 API，不需要 GPU 或真實模型：
+- POST /api/embed                 確定性的嵌入向量（字元二元組特徵雜湊，相似文本得到相近向量）
+- POST /api/chat                  篩選提示詞返回 RELEVANT / NOT_RELEVANT，其他提示詞返回固定格式的答案
+- GET  /api/tags, /api/version    健康檢查
+
+延遲模型：每次呼叫的固定延遲 + prefill（按未命中前綴快取的 token 數）+ 逐 token 生成。
+每個模型只記住上一次的提示詞，與 Ollama 在單一 slot 上重用 KV 快取的行為一致，
+因此 prompt_eval_count 能反映提示詞前綴重用的效果。
+
+用法:
+    python benchmarks/stub_ollama.py --port 11500 --embed-latency-ms 20 --chat-latency-ms 200
+    OLLAMA_HOST=127.0.0.1:11500 python app.py
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_builder import TokenCounter
+
+DEFAULT_DIM = 1024
+
+def deterministic_embedding(text: str, dim: int = DEFAULT_DIM) -> np.ndarray:
+    """文本的確定性嵌入：字元二元組經雜湊映射到 dim 個分量並帶正負號，最後歸一化
+
+    不依賴 PYTHONHASHSEED，跨進程結果一致；共享較多二元組的文本餘弦相似度較高。
+    """
+    codes = np.frombuffer((text or ' ').encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < 2:
+        codes = np.concatenate([codes, np.zeros(2 - len(codes), dtype=np.uint64)])
+    keys = codes[:-1] * np.uint64(0x100000001B3) ^ codes[1:]
+    # splitmix64 混合
+    keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    keys ^= keys >> np.uint64(31)
+    buckets = (keys % np.uint64(dim)).astype(np.int64)
+    signs = np.where(keys >> np.uint64(63), -1.0, 1.0).astype(np.float32)
+    vector = np.zeros(dim, dtype=np.float32)
+    np.add.at(vector, buckets, signs)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+class StubBackend:
+    """替身服務的狀態與延遲模型"""
+
+    def __init__(self, dim: int = DEFAULT_DIM, embed_latency_ms: float = 0, chat_latency_ms: float = 0,
+                 prefill_ms_per_token: float = 0, decode_ms_per_token: float = 0,
+                 relevant_ratio: float = 0.5, answer_tokens: int = 64):
+        self.dim = dim
+        self.embed_latency_ms = embed_latency_ms
+        self.chat_latency_ms = chat_latency_ms
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.decode_ms_per_token = decode_ms_per_token
+        self.relevant_ratio = relevant_ratio
+        self.answer_tokens = answer_tokens
+        self.count_tokens = TokenCounter._estimate  # 按字元估算，不載入分詞器
+        self._last_prompt = {}  # {model: 上一次的完整提示詞}
+        self._lock = threading.Lock()
+        self.stats = {'embed_calls': 0, 'embed_inputs': 0, 'chat_calls': 0,
+                      'prompt_tokens': 0, 'evaluated_tokens': 0}
+
+    def embed(self, inputs):
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        with self._lock:
+            self.stats['embed_calls'] += 1
+            self.stats['embed_inputs'] += len(inputs)
+        time.sleep(self.embed_latency_ms / 1000 * max(len(inputs), 1) ** 0.5)
+        return [deterministic_embedding(text, self.dim).tolist() for text in inputs]
+
+    def _prefill_tokens(self, model: str, prompt: str):
+        """返回 (提示詞 token 數, 實際需要 prefill 的 token 數)"""
+        with self._lock:
+            previous = self._last_prompt.get(model, '')
+            self._last_prompt[model] = prompt
+        common = os.path.commonprefix([previous, prompt])
+        total = self.count_tokens(prompt)
+        return total, total - self.count_tokens(common)
+
+    def chat(self, model: str, messages, num_predict: int = None):
+        system = ''.join(m.get('content', '') for m in messages if m.get('role') == 'system')
+        prompt = ''.join(f"{m.get('role')}:{m.get('content', '')}\n" for m in messages)
+        total, evaluated = self._prefill_tokens(model, prompt)
+
+        if 'NOT_RELEVANT' in system:
+            # 篩選請求：按提示詞雜湊確定性地判斷相關與否
+            relevant = zlib.crc32(prompt.encode('utf-8')) % 1000 < self.relevant_ratio * 1000
+            content = "RELEVANT: 替身服務判定相關" if relevant else "NOT_RELEVANT: 替身服務判定不相關"
+        else:
+            content = "根據相關文檔整理的答案（替身服務）。" + "內容" * max(self.answer_tokens - 16, 0)
+        eval_tokens = self.count_tokens(content)
+        if num_predict is not None and num_predict >= 0:
+            eval_tokens = min(eval_tokens, num_predict)
+
+        with self._lock:
+            self.stats['chat_calls'] += 1
+            self.stats['prompt_tokens'] += total
+            self.stats['evaluated_tokens'] += evaluated
+        time.sleep((self.chat_latency_ms + evaluated * self.prefill_ms_per_token
+                    + eval_tokens * self.decode_ms_per_token) / 1000)
+        return content, evaluated, eval_tokens
+
+class StubHandler(BaseHTTPRequestHandler):
+    backend: StubBackend = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json({'models': []})
+        elif self.path == '/api/version':
+            self._send_json({'version': 'stub'})
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        try:
+            data = self._read_json()
+            model = data.get('model', '')
+            if self.path == '/api/embed':
+                start = time.perf_counter_ns()
+                embeddings = self.backend.embed(data.get('input', ''))
+                self._send_json({'model': model, 'embeddings': embeddings,
+                                 'total_duration': time.perf_counter_ns() - start})
+            elif self.path == '/api/chat':
+                if data.get('stream'):
+                    self._send_json({'error': '替身服務不支援串流'}, 400)
+                    return
+                options = data.get('options') or {}
+                content, evaluated, eval_tokens = self.backend.chat(model, data.get('messages', []), options.get('num_predict'))
+                self._send_json({
+                    'model': model,
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                    'message': {'role': 'assistant', 'content': content},
+                    'done': True,
+                    'done_reason': 'stop',
+                    'prompt_eval_count': evaluated,
+                    'eval_count': eval_tokens,
+                })
+            else:
+                self._send_json({'error': 'not found'}, 404)
+        except Exception as e:
+            self._send_json({'error': str(e)}, 500)
+
+def start_stub_server(backend: StubBackend, host: str = '127.0.0.1', port: int = 0):
+    """在背景線程啟動替身服務，返回 (server, 'host:port')；port 為 0 時自動選擇空閒端口"""
+    handler = type('BoundStubHandler', (StubHandler,), {'backend': backend})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{host}:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description="離線 Ollama 替身服務")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11500)
+    parser.add_argument('--dim', type=int, default=DEFAULT_DIM, help='嵌入向量維度')
+    parser.add_argument('--embed-latency-ms', type=float, default=0)
+    parser.add_argument('--chat-latency-ms', type=float, default=0, help='每次 chat 呼叫的固定延遲')
+    parser.add_argument('--prefill-ms-per-token', type=float, default=0)
+    parser.add_argument('--decode-ms-per-token', type=float, default=0)
+    parser.add_argument('--relevant-ratio', type=float, default=0.5, help='篩選判定為相關的比例')
+    parser.add_argument('--answer-tokens', type=int, default=64)
+    args = parser.parse_args()
+
+    backend = StubBackend(
+        dim=args.dim, embed_latency_ms=args.embed_latency_ms, chat_latency_ms=args.chat_latency_ms,
+        prefill_ms_per_token=args.prefill_ms_per_token, decode_ms_per_token=args.decode_ms_per_token,
+        relevant_ratio=args.relevant_ratio, answer_tokens=args.answer_tokens,
+    )
+    handler = type('BoundStubHandler', (StubHandler,), {'backend': backend})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    print(f"Ollama 替身服務已啟動: http://{args.host}:{args.port}（嵌入維度 {args.dim}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+合成技術支援工單語料
+
+生成與真實工單格式相同的中文紀錄（每筆以「編號與日期: (n) YYYYMMDD」開頭），
+用於在沒有真實資料的環境下評估導入與查詢效能：
+- write_ticket_files(): 寫出 txt 文件，走正常的導入流程（切分 + Ollama 嵌入）
+- build_vector_db(): 每筆工單一個片段直接寫入 JSONVectorDB，嵌入以替身服務相同的確定性函數計算，
+  可快速建立 1 萬到 100 萬個片段的資料庫
+
+用法:
+    python benchmarks/synthetic_corpus.py --db /tmp/tsd_bench_db --chunks 100000
+    python benchmarks/synthetic_corpus.py --files /tmp/tsd_bench_txt --chunks 2000 --tickets-per-file 50
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+from typing import Dict, Iterator, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_ollama import DEFAULT_DIM, deterministic_embedding
+from vector_db import JSONVectorDB
+
+CUSTOMERS = [
+    "研華", "凌華", "新漢", "樺漢", "飛捷", "振樺", "瑞傳", "安勤", "廣積", "友通",
+    "Siemens", "Bosch", "Honeywell", "NCR", "Diebold", "Kontron", "Beckhoff", "Zebra",
+]
+MODELS = [
+    "4x4-7840U", "4x4-7735U", "4x4-6800U", "4x4-5800U", "4x4-4800U", "NUC 125", "NUC 155",
+    "NUC-1245U", "NUCS-1165G7", "iBOX-1340U", "iBOX-N97", "iEP-7020E", "iEP-5000G", "IMB-X1314",
+    "IMB-1222", "SBC-350", "SBC-230", "iEPF-9010S", "4X4 BOX-8840U", "NUC BOX-155H",
+]
+SYMPTOMS = [
+    "開機後無畫面輸出", "HDMI 間歇性黑屏", "進入 BIOS 後自動重啟", "COM 埠無法通訊",
+    "2.5G 網卡掉線", "M.2 SSD 無法辨識", "USB 裝置插拔後失效", "Wake on LAN 無效",
+    "待機後無法喚醒", "風扇轉速異常偏高", "Windows 更新後藍屏", "Linux 下音效無輸出",
+    "TPM 無法啟用", "雙螢幕顯示順序錯亂", "GPIO 輸出電平不正確", "Watchdog 逾時未重啟",
+    "記憶體只辨識一半容量", "PXE 開機失敗", "RTC 時間重開機後重置", "eDP 面板閃爍",
+]
+ACTIONS = [
+    "更新 BIOS 至最新版本後問題解決", "更換電源供應器後恢復正常", "調整 BIOS 中的 CSM 設定",
+    "重新安裝晶片組驅動程式", "確認為客戶端線材問題", "提供客製 BIOS 修正 EC 韌體",
+    "關閉 ASPM 省電設定", "建議客戶改用認證記憶體模組", "更新網卡驅動並關閉節能乙太網路",
+    "由研發確認為已知問題，下一版 BIOS 修正", "調整 GPIO 預設值並提供設定工具",
+    "協助客戶修改 Linux 核心參數", "RMA 更換主板", "重新燒錄 EC 韌體",
+]
+FILLER = [
+    "客戶回報現場共有多台機器出現相同狀況，", "已請客戶提供 BIOS 設定截圖與系統日誌，",
+    "實驗室以相同配置重現問題，", "測試時間約持續七十二小時，", "客戶希望能在下個出貨批次前解決，",
+    "比對不同批次主板後發現差異，", "使用示波器量測訊號後確認，", "與客戶視訊會議討論後，",
+]
+
+def generate_tickets(count: int, seed: int = 0, start: date = date(2020, 1, 1),
+                     end: date = date(2025, 12, 31)) -> Iterator[Dict]:
+    """逐筆生成工單：{'number', 'date', 'customer', 'model', 'symptom', 'text'}，日期隨編號遞增"""
+    rng = random.Random(seed)
+    span_days = (end - start).days
+    for n in range(count):
+        day = start + timedelta(days=span_days * n // max(count - 1, 1))
+        customer = rng.choice(CUSTOMERS)
+        model = rng.choice(MODELS)
+        symptom = rng.choice(SYMPTOMS)
+        detail = ''.join(rng.sample(FILLER, k=rng.randint(2, 4)))
+        text = (
+            f"編號與日期: ({100000 + n}) {day.strftime('%Y%m%d')}\n"
+            f"客戶: {customer}\n"
+            f"產品型號: {model}\n"
+            f"問題描述: {customer} 使用 {model} 時{symptom}。{detail}"
+            f"初步判斷與{rng.choice(['BIOS', '驅動程式', '硬體', '作業系統', '周邊裝置'])}有關。\n"
+            f"處理方式: {rng.choice(ACTIONS)}。\n"
+        )
+        yield {
+            'number': 100000 + n,
+            'date': day.strftime('%Y%m%d'),
+            'customer': customer,
+            'model': model,
+            'symptom': symptom,
+            'text': text,
+        }
+
+def sample_questions(count: int, seed: int = 1) -> List[str]:
+    """生成與語料同分佈的問題"""
+    rng = random.Random(seed)
+    templates = [
+        "{customer} 的 {model} {symptom}，之前怎麼處理？",
+        "{model} {symptom}有什麼解決方法？",
+        "有沒有客戶回報過{symptom}的問題？",
+        "{customer} 反映 {model} {symptom}",
+    ]
+    return [
+        rng.choice(templates).format(customer=rng.choice(CUSTOMERS), model=rng.choice(MODELS),
+                                     symptom=rng.choice(SYMPTOMS))
+        for _ in range(count)
+    ]
+
+def write_ticket_files(directory: str, count: int, tickets_per_file: int = 50, seed: int = 0) -> List[str]:
+    """把 count 筆工單寫成 txt 文件（每個文件 tickets_per_file 筆），返回文件路徑"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    handle = None
+    for i, ticket in enumerate(generate_tickets(count, seed)):
+        if i % tickets_per_file == 0:
+            if handle:
+                handle.close()
+            path = os.path.join(directory, f"tickets_{i // tickets_per_file:05d}.txt")
+            paths.append(path)
+            handle = open(path, 'w', encoding='utf-8')
+        handle.write(ticket['text'] + '\n')
+    if handle:
+        handle.close()
+    return paths
+
+def build_vector_db(db_path: str, count: int, dim: int = DEFAULT_DIM, tickets_per_file: int = 50,
+                    seed: int = 0, batch_size: int = None) -> JSONVectorDB:
+    """直接建立含 count 個片段的向量資料庫（每筆工單一個片段，不經過 Ollama）
+
+    JSONVectorDB.add 每批都會重寫索引，因此大語料使用較大的批次。
+    """
+    db = JSONVectorDB(db_path)
+    if db.index["documents"]:
+        db.delete_collection("rag_docs")
+    batch_size = batch_size or max(5000, count // 20)
+    start_time = time.time()
+
+    ids, embeddings, documents, metadatas = [], [], [], []
+
+    def flush():
+        db.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        for batch in (ids, embeddings, documents, metadatas):
+            batch.clear()
+
+    for i, ticket in enumerate(generate_tickets(count, seed)):
+        filename = f"tickets_{i // tickets_per_file:05d}.txt"
+        ids.append(f"{filename}_{i % tickets_per_file}")
+        embeddings.append(deterministic_embedding(ticket['text'], dim))
+        documents.append(ticket['text'])
+        metadatas.append({
+            "source": os.path.join("uploads", filename),
+            "chunk_id": i % tickets_per_file,
+            "file_type": "txt",
+            "original_filename": filename,
+            "has_timestamp_template": True,
+        })
+        if len(ids) >= batch_size:
+            flush()
+            print(f"已寫入 {i + 1}/{count} 個片段，耗時 {time.time() - start_time:.1f} 秒")
+    if ids:
+        flush()
+    print(f"合成資料庫建立完成: {count} 個片段，耗時 {time.time() - start_time:.1f} 秒")
+    return db
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成技術支援工單語料")
+    parser.add_argument('--chunks', type=int, default=10000, help='工單（片段）數')
+    parser.add_argument('--db', help='直接建立向量資料庫到此目錄')
+    parser.add_argument('--files', help='改為寫出 txt 文件到此目錄')
+    parser.add_argument('--tickets-per-file', type=int, default=50)
+    parser.add_argument('--dim', type=int, default=DEFAULT_DIM, help='嵌入向量維度（需與替身服務一致）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.db and not args.files:
+        parser.error("需要指定 --db 或 --files")
+    if args.files:
+        paths = write_ticket_files(args.files, args.chunks, args.tickets_per_file, args.seed)
+        print(f"已寫出 {len(paths)} 個文件到 {args.files}")
+    if args.db:
+        build_vector_db(args.db, args.chunks, args.dim, args.tickets_per_file, args.seed)
+
+if __name__ == '__main__':
+    main()
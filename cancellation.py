@@ -0,0 +1,177 @@
+"""
+任務取消
+
+CancellationToken 取代只在步驟之間檢查的停止標誌：
+- sleep() 在取消時立即返回並拋出 TaskCancelled
+- run_cancellable() / await_cancellable() 執行 Ollama 呼叫，取消時直接取消協程，
+  底層 HTTP 連線隨之關閉，Ollama 偵測到客戶端斷開後停止生成
+- 取消時中止的呼叫與略過的等待記入 /metrics，估算省下的運算時間
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import signal
+import threading
+import time
+
+from telemetry import metrics, STAGE_LATENCY
+
+CANCELLATIONS = metrics.counter('tsd_cancellations_total', '任務取消次數（按觸發原因）')
+ABORTED_CALLS = metrics.counter('tsd_cancelled_calls_total', '取消時中止的進行中呼叫數（按階段）')
+RECLAIMED_SECONDS = metrics.counter(
+    'tsd_cancel_reclaimed_seconds_total',
+    '取消後省下的估計時間（秒）：中止呼叫按該階段平均耗時估算剩餘部分，等待按剩餘秒數'
+)
+
+class TaskCancelled(Exception):
+    """任務已被取消"""
+
+    def __init__(self, reason: str = None):
+        super().__init__("任務已被用戶中斷" + (f"（{reason}）" if reason else ""))
+        self.reason = reason
+
+class CancellationToken:
+    """跨線程的取消令牌
+
+    cancel() 只生效一次：設置事件並依序執行已註冊的回調（例如取消進行中的 HTTP 請求）。
+    回調在呼叫 cancel() 的線程中執行，應當快速返回。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_handle = 0
+        self.reason = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = 'stop') -> bool:
+        """取消令牌；已取消過時返回 False"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"執行取消回調失敗: {e}")
+        return True
+
+    def register(self, callback):
+        """註冊取消時執行的回調，返回用於 unregister 的句柄；已取消時立即執行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._next_handle += 1
+                self._callbacks[self._next_handle] = callback
+                return self._next_handle
+        callback()
+        return None
+
+    def unregister(self, handle):
+        if handle is not None:
+            with self._lock:
+                self._callbacks.pop(handle, None)
+
+    def child(self) -> 'CancellationToken':
+        """建立子令牌：父令牌取消時子令牌一併取消，子令牌可單獨取消"""
+        token = CancellationToken()
+        handle = self.register(lambda: token.cancel(self.reason))
+        token.register(lambda: self.unregister(handle))
+        return token
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TaskCancelled(self.reason)
+
+    def sleep(self, seconds: float, stage: str = 'sleep'):
+        """可被取消打斷的等待"""
+        start = time.perf_counter()
+        if self._event.wait(seconds):
+            record_aborted(stage, time.perf_counter() - start, expected_seconds=seconds)
+            raise TaskCancelled(self.reason)
+
+def install_shutdown_handlers(stop_all_tasks):
+    """在收到關閉信號時先中斷所有 RAG 任務，再交由原本的信號處理器處理（只能在主線程呼叫）"""
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+        previous_handler = signal.getsignal(sig)
+
+        def handler(signum, frame, previous_handler=previous_handler):
+            stop_all_tasks()
+            if callable(previous_handler):
+                previous_handler(signum, frame)
+            elif previous_handler == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(sig, handler)
+
+def record_aborted(stage: str, elapsed: float, expected_seconds: float = None):
+    """記錄一次被中止的呼叫；未提供預期耗時時以該階段的歷史平均耗時估算"""
+    ABORTED_CALLS.inc(stage=stage)
+    if expected_seconds is None:
+        expected_seconds = STAGE_LATENCY.mean(stage=stage)
+    if expected_seconds:
+        RECLAIMED_SECONDS.inc(round(max(expected_seconds - elapsed, 0), 3), stage=stage)
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    """同步代碼執行可取消呼叫所用的事件循環（首次使用時在背景線程啟動，gunicorn fork 之後才會建立）"""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='cancellable-io', daemon=True).start()
+                _loop = loop
+    return _loop
+
+def run_cancellable(token: CancellationToken, coro, stage: str):
+    """在背景事件循環執行協程並阻塞等待結果
+
+    令牌取消時協程被取消（關閉其 HTTP 連線），呼叫方立即得到 TaskCancelled，不必等待呼叫返回。
+    """
+    if token.cancelled:
+        coro.close()
+        raise TaskCancelled(token.reason)
+    future = asyncio.run_coroutine_threadsafe(coro, background_loop())
+    start = time.perf_counter()
+    handle = token.register(future.cancel)
+    try:
+        return future.result()
+    except concurrent.futures.CancelledError:
+        record_aborted(stage, time.perf_counter() - start)
+        raise TaskCancelled(token.reason)
+    finally:
+        token.unregister(handle)
+
+async def await_cancellable(token: CancellationToken, coro, stage: str, expected_seconds: float = None):
+    """run_cancellable 的異步版本：令牌可在任何線程取消（例如頁面重新載入時由 Flask 線程取消）
+
+    外層協程被取消（客戶端斷開）時 CancelledError 照常向上傳遞。
+    """
+    if token.cancelled:
+        coro.close()
+        raise TaskCancelled(token.reason)
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(coro)
+    start = time.perf_counter()
+    handle = token.register(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        return await task
+    except asyncio.CancelledError:
+        record_aborted(stage, time.perf_counter() - start, expected_seconds)
+        if token.cancelled:
+            raise TaskCancelled(token.reason)
+        raise
+    finally:
+        token.unregister(handle)
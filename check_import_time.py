@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+啟動時間檢查：以 `python -X importtime` 導入應用模組並輸出耗時報告
+
+超過時間預算，或在導入階段載入了應延遲導入的重量級依賴時，以非零狀態碼退出。
+
+用法:
+    python check_import_time.py                      # 檢查 app，預算 1000ms
+    python check_import_time.py --module asgi_app --budget-ms 1500
+    IMPORT_TIME_BUDGET_MS=800 python check_import_time.py --top 30
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# 這些依賴只應在首次使用時導入
+LAZY_MODULES = ['autogen', 'langchain', 'langchain_community', 'pandas', 'docx', 'sklearn', 'opencc', 'sentence_transformers', 'tiktoken', 'transformers', 'opentelemetry']
+
+def run_importtime(module: str):
+    """在子進程中導入模組，返回 (importtime 記錄, 導入後已載入的延遲模組)"""
+    code = (
+        f"import sys, {module}\n"
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        print(proc.stderr)
+        raise RuntimeError(f"導入 {module} 失敗")
+
+    records = []
+    for line in proc.stderr.splitlines():
+        # 格式: import time:   self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            records.append((int(self_us), int(cumulative_us), name.rstrip()))
+        except ValueError:
+            continue
+
+    loaded_lazy = [m for m in proc.stdout.strip().split(',') if m]
+    return records, loaded_lazy
+
+def main():
+    parser = argparse.ArgumentParser(description="應用導入時間檢查")
+    parser.add_argument('--module', default='app', help='要檢查的模組')
+    parser.add_argument('--budget-ms', type=float,
+                        default=float(os.environ.get('IMPORT_TIME_BUDGET_MS', 1000)),
+                        help='導入時間預算（毫秒）')
+    parser.add_argument('--top', type=int, default=20, help='報告中列出的最慢頂層模組數')
+    args = parser.parse_args()
+
+    records, loaded_lazy = run_importtime(args.module)
+
+    # 頂層模組（名稱前沒有縮排）的累計時間
+    top_level = [(cum, name.strip()) for _, cum, name in records if not name.startswith('  ')]
+    total_us = sum(cum for cum, _ in top_level)
+    module_us = next((cum for cum, name in top_level if name == args.module), total_us)
+
+    print("=" * 60)
+    print(f"導入時間報告: {args.module}")
+    print("=" * 60)
+    print(f"{'累計(ms)':>10}  模組")
+    for cum, name in sorted(top_level, reverse=True)[:args.top]:
+        print(f"{cum / 1000:>10.1f}  {name}")
+    print("-" * 60)
+    print(f"{args.module} 累計: {module_us / 1000:.1f} ms")
+    print(f"全部頂層導入: {total_us / 1000:.1f} ms (預算 {args.budget_ms:.0f} ms)")
+
+    failed = False
+    if loaded_lazy:
+        print(f"❌ 導入階段載入了應延遲導入的模組: {', '.join(loaded_lazy)}")
+        failed = True
+    if total_us / 1000 > args.budget_ms:
+        print(f"❌ 導入時間超出預算 {total_us / 1000 - args.budget_ms:.1f} ms")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print("✅ 導入時間在預算內")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+向量資料庫的壓縮與垃圾回收
+
+- 對帳片段文件與索引：移除文件已遺失的索引條目，刪除不在索引中的舊片段文件（上傳失敗、同名重傳留下的）
+- 校驗嵌入向量的維度、行號與數值，不合格的嵌入從索引移除並列出
+- 重寫嵌入文件，回收刪除與重寫片段留下的作廢行
+- 輸出報告：各類問題的數量、回收的空間與耗時
+
+服務運行中也可執行（各 worker 偵測到索引更新後切換到新的嵌入文件）；
+此時保留 --min-age 的預設值，避免刪除其他進程剛寫入、尚未登記到索引的文件。
+
+用法:
+    python compact_db.py --dry-run
+    python compact_db.py --db ./custom_json_rag_db --json compaction_report.json
+    python compact_db.py --min-age 0        # 服務已停止時，立即刪除替換下來的舊文件
+"""
+
+import argparse
+import json
+
+from vector_db import JSONVectorDB
+
+def format_bytes(size: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="向量資料庫的壓縮與垃圾回收")
+    parser.add_argument('--db', default='./custom_json_rag_db', help='向量資料庫目錄')
+    parser.add_argument('--dry-run', action='store_true', help='只檢查並報告，不做任何修改')
+    parser.add_argument('--no-embeddings', action='store_true', help='只對帳片段文件，不重寫嵌入文件')
+    parser.add_argument('--min-age', type=float, default=600,
+                        help='只刪除超過此秒數未修改的文件（服務運行中請保留預設值）')
+    parser.add_argument('--json', help='將報告寫入 JSON 文件')
+    args = parser.parse_args()
+
+    db = JSONVectorDB(args.db)
+    report = db.compact(reclaim_embeddings=not args.no_embeddings, min_age=args.min_age, dry_run=args.dry_run)
+
+    if report['skipped']:
+        print(f"本次未完成: {report['skipped']}")
+    print(f"{'檢查結果（未修改）' if args.dry_run else '壓縮完成'}，耗時 {report['seconds']} 秒")
+    print(f"  文件已遺失的索引條目: {report['missing_files']}")
+    print(f"  不在索引中的片段文件: {report['orphan_files']}")
+    print(f"  殘留的臨時文件與舊嵌入文件: {report['stale_files']}")
+    print(f"  無效的嵌入: {report['invalid_embeddings']}（文件末尾殘缺 {report['partial_row_bytes']} 位元組）")
+    print(f"  嵌入文件: {report['rows_before']} 行 -> {report['rows_after']} 行 "
+          f"({format_bytes(report['embedding_bytes_before'])} -> {format_bytes(report['embedding_bytes_after'])})")
+    print(f"  {'可回收' if args.dry_run else '已回收'}空間: {format_bytes(report['bytes_reclaimed'])}"
+          + (f"，待 {args.min_age:g} 秒後回收: {format_bytes(report['bytes_pending'])}" if report['bytes_pending'] else ''))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"報告已寫入 {args.json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+class TokenCounter:
+    """計算文本的 token 數
+
+    預設使用 tiktoken 的 cl100k_base 編碼；TSD_CONTEXT_TOKENIZER 含 "/" 時
+    視為 Hugging Face 模型名稱（例如 Qwen/Qwen3-30B-A3B），以 transformers 載入對應分詞器。
+    分詞器無法載入（例如離線環境）時，退回按字元估算：中日韓字元各算一個 token，其餘每 4 個字元一個。
+    """
+
+    def __init__(self, name: str = None):
+        self.name = name or os.environ.get('TSD_CONTEXT_TOKENIZER', 'cl100k_base')
+        self._encode = None
+        self._decode = None
+        try:
+            if '/' in self.name:
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(self.name)
+                self._encode = lambda text: tokenizer.encode(text, add_special_tokens=False)
+                self._decode = tokenizer.decode
+            else:
+                import tiktoken
+                encoding = tiktoken.get_encoding(self.name)
+                self._encode = encoding.encode
+                self._decode = encoding.decode
+        except Exception as e:
+            print(f"載入分詞器 {self.name} 失敗，改用字元估算: {e}")
+
+    @staticmethod
+    def _estimate(text: str) -> int:
+        cjk = len(re.findall(r'[　-鿿＀-￯]', text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def count(self, text: str) -> int:
+        if self._encode is not None:
+            return len(self._encode(text))
+        return self._estimate(text)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截斷文本使其不超過 max_tokens"""
+        if max_tokens <= 0:
+            return ''
+        if self._encode is not None:
+            tokens = self._encode(text)
+            return text if len(tokens) <= max_tokens else self._decode(tokens[:max_tokens])
+        if self._estimate(text) <= max_tokens:
+            return text
+        # 二分查找能放入預算的最長前綴
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self._estimate(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low]
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+def get_token_counter() -> TokenCounter:
+    """進程內共享的 token 計數器（分詞器只載入一次）"""
+    global _token_counter
+    if _token_counter is None:
+        with _token_counter_lock:
+            if _token_counter is None:
+                _token_counter = TokenCounter()
+    return _token_counter
+
+def _relevance(doc: Dict) -> float:
+    """文檔的相關度：有重排分數時使用重排分數，否則使用向量相似度"""
+    if 'rerank_score' in doc:
+        return doc['rerank_score']
+    return 1 - doc.get('distance', 1.0)
+
+# 舊資料未記錄 chunk_overlap 時按文件類型推斷（docx / excel 以 chunk_overlap=100 切分，其餘沒有重疊）
+_LEGACY_CHUNK_OVERLAP = {'docx': 100, 'excel': 100}
+# 相同的前後綴短於此長度時視為巧合（例如同一個數字或標點），不當作重疊去除
+MIN_OVERLAP_CHARS = 20
+
+def chunk_overlap(metadata: Dict) -> int:
+    """片段切分時的 chunk_overlap（字元數），0 表示相鄰片段之間沒有重疊"""
+    if 'chunk_overlap' in metadata:
+        return int(metadata['chunk_overlap'] or 0)
+    if metadata.get('chunking') == 'records':
+        return 0
+    return _LEGACY_CHUNK_OVERLAP.get(metadata.get('file_type'), 0)
+
+def _strip_overlap(previous: str, current: str, max_overlap: int) -> str:
+    """去掉 current 開頭與 previous 結尾重疊的部分
+
+    max_overlap 為切分時的 chunk_overlap：分割器的重疊由完整的分隔片段組成，長度不超過 chunk_overlap，
+    因此只在這個範圍內找最長的相同前後綴，且至少 MIN_OVERLAP_CHARS 個字元；max_overlap 為 0 時原樣返回。
+    """
+    limit = min(len(previous), len(current), max_overlap)
+    for size in range(limit, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(current[:size]):
+            return current[size:]
+    return current
+
+def _join_adjacent(previous: str, current: str, max_overlap: int) -> str:
+    """拼接 chunk_id 相鄰的兩個片段：有重疊時去掉重疊部分，否則以換行分隔（分割器去掉了片段邊界的空白）"""
+    rest = _strip_overlap(previous, current, max_overlap)
+    if len(rest) < len(current):
+        return previous + rest
+    return previous + "\n" + current
+
+def _normalize(text: str) -> str:
+    return re.sub(r'\s+', '', text)
+
+def _chunk_id(chunk: Dict) -> int:
+    return chunk['metadata'].get('chunk_id', 0)
+
+def expanded_content(doc: Dict) -> str:
+    """命中片段連同其相鄰片段（doc['neighbors']）按 chunk_id 順序拼接的內容，沒有相鄰片段時即原內容"""
+    neighbors = doc.get('neighbors')
+    if not neighbors:
+        return doc['content']
+    chunks = sorted(neighbors + [doc], key=_chunk_id)
+    content = chunks[0]['content']
+    for previous, chunk in zip(chunks, chunks[1:]):
+        if _chunk_id(chunk) == _chunk_id(previous) + 1:
+            content = _join_adjacent(content, chunk['content'], chunk_overlap(chunk['metadata']))
+        else:
+            content += "\n" + chunk['content']
+    return content
+
+def with_neighbors(documents: List[Dict]) -> List[Dict]:
+    """展開命中片段的相鄰片段，相鄰片段沿用命中片段的相關度"""
+    expanded = []
+    for doc in documents:
+        expanded.append(doc)
+        for neighbor in doc.get('neighbors', []):
+            item = {'content': neighbor['content'], 'metadata': neighbor['metadata'], 'distance': doc.get('distance', 1.0)}
+            if 'rerank_score' in doc:
+                item['rerank_score'] = doc['rerank_score']
+            expanded.append(item)
+    return expanded
+
+def pack_context(documents: List[Dict], token_budget: Optional[int] = None, counter: TokenCounter = None) -> List[Dict]:
+    """將相關文檔打包為上下文段落（token_budget 為 None 時不限制總長度）
+
+    0. 命中片段附帶的相鄰片段（doc['neighbors']）一併加入，與命中片段同一相關度
+    1. 同一文件中 chunk_id 相鄰的片段合併為一段，並去掉切分時的重疊文字
+    2. 內容完全相同或被其他段落包含的段落只保留一份
+    3. 按相關度（段內片段的最高分）排序，依序放入預算；放不下的段落截斷後結束
+
+    返回 [{'content', 'filename', 'chunk_ids', 'relevance', 'tokens'}]，按相關度降序。
+    """
+    counter = counter or get_token_counter()
+
+    # 1. 按文件分組，合併相鄰片段
+    by_file = {}
+    for doc in with_neighbors(documents):
+        metadata = doc['metadata']
+        filename = metadata.get('original_filename', os.path.basename(str(metadata.get('source', ''))))
+        by_file.setdefault(filename, []).append(doc)
+
+    blocks = []
+    for filename, docs in by_file.items():
+        docs = sorted(docs, key=lambda d: d['metadata'].get('chunk_id', 0))
+        current = None
+        for doc in docs:
+            chunk_id = doc['metadata'].get('chunk_id', 0)
+            if current is not None and chunk_id == current['chunk_ids'][-1]:
+                # 同一片段重複出現
+                current['relevance'] = max(current['relevance'], _relevance(doc))
+                continue
+            if current is not None and chunk_id == current['chunk_ids'][-1] + 1:
+                current['content'] = _join_adjacent(current['content'], doc['content'], chunk_overlap(doc['metadata']))
+                current['chunk_ids'].append(chunk_id)
+                current['relevance'] = max(current['relevance'], _relevance(doc))
+                continue
+            current = {
+                'content': doc['content'],
+                'filename': filename,
+                'chunk_ids': [chunk_id],
+                'relevance': _relevance(doc),
+            }
+            blocks.append(current)
+
+    # 2. 按相關度排序後去除重複內容（保留相關度較高的一份）
+    blocks.sort(key=lambda b: b['relevance'], reverse=True)
+    unique_blocks = []
+    normalized = []
+    for block in blocks:
+        text = _normalize(block['content'])
+        if any(text in kept for kept in normalized):
+            continue
+        unique_blocks.append(block)
+        normalized.append(text)
+
+    # 3. 按預算放入
+    packed = []
+    remaining = token_budget
+    for block in unique_blocks:
+        tokens = counter.count(block['content'])
+        if remaining is not None and tokens > remaining:
+            # 剩餘預算太小時不再放入截斷的段落
+            if remaining >= 64:
+                block['content'] = counter.truncate(block['content'], remaining)
+                block['tokens'] = counter.count(block['content'])
+                packed.append(block)
+            break
+        block['tokens'] = tokens
+        packed.append(block)
+        if remaining is not None:
+            remaining -= tokens
+    return packed
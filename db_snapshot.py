@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+向量資料庫快照：匯出為單一 zstd 壓縮檔案，並可整批快速恢復
+
+快照（.tar.zst）依序包含:
+- manifest.json   格式版本、片段數、嵌入維度，以及其餘成員的位元組數與 SHA-256
+- index.json      索引（embedding_rows 改為快照內緊湊的行號，不含已作廢的舊行）
+- embeddings.f32  所有片段的 float32 嵌入向量
+- chunks.jsonl    每行一個片段（內容與元數據），取代數萬個小文件
+
+建立快照時索引副本與嵌入文件的映射在同一時間點取得（嵌入文件只追加、索引原子替換），
+服務運行中、其他 worker 進程寫入時也能得到一致的快照；之後被刪除的片段不寫入快照。
+恢復時直接寫出資料庫的內部格式，不重新計算嵌入；全部校驗通過後才替換目標目錄，
+原目錄改名保留為 <db>.before-restore-<時間>。
+
+用法:
+    python db_snapshot.py create -o tsd_db.tar.zst
+    python db_snapshot.py verify tsd_db.tar.zst
+    python db_snapshot.py restore tsd_db.tar.zst --db ./custom_json_rag_db
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Dict
+
+import numpy as np
+
+SNAPSHOT_FORMAT = 1
+MEMBERS = ("index.json", "embeddings.f32", "chunks.jsonl")
+
+_COPY_BLOCK = 1024 * 1024
+_ROW_BLOCK = 16384
+
+class _HashingWriter:
+    """寫入時同時計算 SHA-256 與位元組數"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.f.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def summary(self) -> Dict:
+        return {"bytes": self.size, "sha256": self.digest.hexdigest()}
+
+def create_snapshot(db, output_path: str, level: int = 3, threads: int = -1) -> Dict:
+    """把 db（JSONVectorDB）寫成快照文件，返回統計"""
+    import zstandard
+
+    start_time = time.time()
+    index, matrix = db.export_state()
+    dim = index.get("embedding_dim") or 0
+    output_path = os.path.abspath(output_path)
+    staging = tempfile.mkdtemp(prefix='.snapshot-', dir=os.path.dirname(output_path))
+    try:
+        members = {}
+        # 片段內容：快照開始後被刪除的片段從快照索引中移除
+        kept = []
+        with open(os.path.join(staging, "chunks.jsonl"), 'wb') as f:
+            writer = _HashingWriter(f)
+            for doc_info in index["documents"]:
+                doc = db.read_document(doc_info["id"])
+                if doc is None:
+                    continue
+                kept.append(doc_info)
+                writer.write((json.dumps(doc, ensure_ascii=False) + '\n').encode('utf-8'))
+            members["chunks.jsonl"] = writer.summary()
+        if len(kept) != len(index["documents"]):
+            print(f"快照期間有 {len(index['documents']) - len(kept)} 個片段已被刪除，不寫入快照")
+            _keep_documents(index, {doc_info["id"] for doc_info in kept})
+        index["documents"] = kept
+
+        # 嵌入向量按索引順序緊湊排列，已作廢的舊行不寫入
+        embedding_rows = index.get("embedding_rows", {})
+        row_ids = [doc_info["id"] for doc_info in kept if doc_info["id"] in embedding_rows]
+        store_rows = [embedding_rows[doc_id] for doc_id in row_ids]
+        index["embedding_rows"] = {doc_id: row for row, doc_id in enumerate(row_ids)}
+        # 快照中的嵌入文件固定為 embeddings.f32，不沿用壓縮後的文件名
+        index.pop("embeddings_file", None)
+        index.pop("retired_embeddings", None)
+        with open(os.path.join(staging, "embeddings.f32"), 'wb') as f:
+            writer = _HashingWriter(f)
+            for start in range(0, len(store_rows), _ROW_BLOCK):
+                block = np.asarray(matrix[store_rows[start:start + _ROW_BLOCK]], dtype=np.float32)
+                writer.write(block.tobytes())
+            members["embeddings.f32"] = writer.summary()
+
+        with open(os.path.join(staging, "index.json"), 'wb') as f:
+            writer = _HashingWriter(f)
+            writer.write(json.dumps(index, ensure_ascii=False).encode('utf-8'))
+            members["index.json"] = writer.summary()
+
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "source": os.path.abspath(db.db_path),
+            "chunks": len(kept),
+            "embeddings": len(row_ids),
+            "embedding_dim": dim,
+            "storage_version": index.get("storage_version"),
+            "members": members,
+        }
+        with open(os.path.join(staging, "manifest.json"), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        # 先寫臨時文件，完成後原子替換，不會留下半個快照
+        temp_output = f"{output_path}.tmp"
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        with open(temp_output, 'wb') as raw:
+            with compressor.stream_writer(raw, closefd=False) as compressed:
+                with tarfile.open(fileobj=compressed, mode='w|') as tar:
+                    for name in ("manifest.json",) + MEMBERS:
+                        tar.add(os.path.join(staging, name), arcname=name)
+        os.replace(temp_output, output_path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        if os.path.exists(f"{output_path}.tmp"):
+            os.remove(f"{output_path}.tmp")
+
+    stats = {
+        "chunks": manifest["chunks"],
+        "embeddings": manifest["embeddings"],
+        "archive_bytes": os.path.getsize(output_path),
+        "raw_bytes": sum(member["bytes"] for member in members.values()),
+        "seconds": round(time.time() - start_time, 2),
+    }
+    print(f"快照已寫入 {output_path}: {stats}")
+    return stats
+
+def _keep_documents(index: Dict, kept_ids: set):
+    """只保留 kept_ids 的元數據、嵌入行與文件目錄條目"""
+    index["metadata"] = {doc_id: metadata for doc_id, metadata in index["metadata"].items() if doc_id in kept_ids}
+    index["embedding_rows"] = {doc_id: row for doc_id, row in index.get("embedding_rows", {}).items() if doc_id in kept_ids}
+    files = {}
+    for source, entry in index.get("files", {}).items():
+        entry["ids"] = [doc_id for doc_id in entry["ids"] if doc_id in kept_ids]
+        if entry["ids"]:
+            files[source] = entry
+    index["files"] = files
+
+def _read_snapshot(archive_path: str, target_dir: str = None) -> Dict:
+    """依序讀取快照成員並校驗；target_dir 不為 None 時同時寫出資料庫的內部格式
+
+    返回 {'manifest', 'index'}；格式、大小或校驗和不符時拋出 ValueError。
+    """
+    import zstandard
+
+    manifest = None
+    index = None
+    members = {}
+    chunk_count = 0
+    with open(archive_path, 'rb') as raw:
+        with zstandard.ZstdDecompressor().stream_reader(raw) as decompressed:
+            with tarfile.open(fileobj=decompressed, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    source = tar.extractfile(member)
+                    if member.name == "manifest.json":
+                        manifest = json.load(source)
+                        if manifest.get("format") != SNAPSHOT_FORMAT:
+                            raise ValueError(f"不支援的快照格式: {manifest.get('format')}")
+                        continue
+                    if manifest is None:
+                        raise ValueError("快照缺少開頭的 manifest.json")
+                    if member.name == "index.json":
+                        writer = _HashingWriter(_NullFile())
+                        data = source.read()
+                        writer.write(data)
+                        index = json.loads(data.decode('utf-8'))
+                    elif member.name == "embeddings.f32":
+                        target = open(os.path.join(target_dir, "embeddings.f32"), 'wb') if target_dir else _NullFile()
+                        with target:
+                            writer = _HashingWriter(target)
+                            for block in iter(lambda: source.read(_COPY_BLOCK), b''):
+                                writer.write(block)
+                    elif member.name == "chunks.jsonl":
+                        writer = _HashingWriter(_NullFile())
+                        for line in source:
+                            writer.write(line)
+                            if target_dir:
+                                _write_chunk(target_dir, json.loads(line))
+                            chunk_count += 1
+                    else:
+                        raise ValueError(f"快照中有未知的成員: {member.name}")
+                    members[member.name] = writer.summary()
+
+    if manifest is None or index is None:
+        raise ValueError("快照不完整")
+    for name in MEMBERS:
+        if members.get(name) != manifest["members"].get(name):
+            raise ValueError(f"{name} 校驗失敗: {members.get(name)} != {manifest['members'].get(name)}")
+    if chunk_count != manifest["chunks"] or len(index["documents"]) != chunk_count:
+        raise ValueError(f"片段數不符: {chunk_count} / {len(index['documents'])} / {manifest['chunks']}")
+    dim = manifest.get("embedding_dim") or 0
+    if members["embeddings.f32"]["bytes"] != len(index.get("embedding_rows", {})) * dim * 4:
+        raise ValueError("嵌入文件大小與索引的嵌入行數或維度不符")
+    return {"manifest": manifest, "index": index}
+
+class _NullFile:
+    """只計算校驗和時的寫入目標"""
+
+    def write(self, data):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def _write_chunk(target_dir: str, doc: Dict):
+    """以資料庫的片段文件格式寫出一個片段"""
+    doc_id = str(doc["id"])
+    if os.path.basename(doc_id) != doc_id or doc_id in ('.', '..'):
+        raise ValueError(f"快照中的片段 id 不合法: {doc_id}")
+    with open(os.path.join(target_dir, f"{doc_id}.json"), 'w', encoding='utf-8') as f:
+        json.dump(doc, f, ensure_ascii=False, indent=2)
+
+def verify_snapshot(archive_path: str) -> Dict:
+    """完整讀取快照並校驗所有成員，返回 manifest"""
+    return _read_snapshot(archive_path)["manifest"]
+
+def restore_snapshot(archive_path: str, db_path: str, keep_old: bool = True) -> Dict:
+    """把快照恢復到 db_path（整個替換），返回統計
+
+    先解到 <db_path>.restoring，校驗全部通過後才替換目標目錄；
+    服務運行中恢復時，各 worker 偵測到索引更新後自動重新載入。
+    """
+    start_time = time.time()
+    db_path = os.path.abspath(db_path).rstrip(os.sep)
+    staging = f"{db_path}.restoring"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    try:
+        snapshot = _read_snapshot(archive_path, staging)
+        index = snapshot["index"]
+        # 片段文件路徑指向恢復後的目錄
+        for doc_info in index["documents"]:
+            doc_info["file_path"] = os.path.join(db_path, f"{doc_info['id']}.json")
+        with open(os.path.join(staging, "index.json"), 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    backup = None
+    if os.path.exists(db_path):
+        backup = base = f"{db_path}.before-restore-{time.strftime('%Y%m%d%H%M%S')}"
+        # 同一秒內多次恢復時加上序號，避免與上一個備份衝突
+        suffix = 1
+        while os.path.exists(backup):
+            backup = f"{base}-{suffix}"
+            suffix += 1
+        os.rename(db_path, backup)
+    os.rename(staging, db_path)
+    if backup and not keep_old:
+        shutil.rmtree(backup, ignore_errors=True)
+        backup = None
+
+    stats = {
+        "chunks": snapshot["manifest"]["chunks"],
+        "embeddings": snapshot["manifest"]["embeddings"],
+        "previous_db": backup,
+        "seconds": round(time.time() - start_time, 2),
+    }
+    print(f"已從 {archive_path} 恢復到 {db_path}: {stats}")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="向量資料庫快照的建立、校驗與恢復")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create_parser = subparsers.add_parser('create', help='建立快照（服務運行中也可執行）')
+    create_parser.add_argument('-o', '--output', required=True, help='快照文件（.tar.zst）')
+    create_parser.add_argument('--db', default='./custom_json_rag_db', help='向量資料庫目錄')
+    create_parser.add_argument('--level', type=int, default=3, help='zstd 壓縮等級')
+    create_parser.add_argument('--threads', type=int, default=-1, help='壓縮線程數（-1 為全部 CPU 核心）')
+
+    verify_parser = subparsers.add_parser('verify', help='校驗快照的完整性')
+    verify_parser.add_argument('archive', help='快照文件')
+
+    restore_parser = subparsers.add_parser('restore', help='從快照恢復資料庫（不重新計算嵌入）')
+    restore_parser.add_argument('archive', help='快照文件')
+    restore_parser.add_argument('--db', default='./custom_json_rag_db', help='恢復到此目錄（已存在時整個替換）')
+    restore_parser.add_argument('--discard-old', action='store_true', help='不保留被替換的原目錄')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'create':
+            from vector_db import JSONVectorDB
+            create_snapshot(JSONVectorDB(args.db), args.output, level=args.level, threads=args.threads)
+        elif args.command == 'verify':
+            manifest = verify_snapshot(args.archive)
+            print(f"快照完整: {manifest['chunks']} 個片段，嵌入維度 {manifest['embedding_dim']}，建立於 {manifest['created_at']}")
+        else:
+            restore_snapshot(args.archive, args.db, keep_old=not args.discard_old)
+    except Exception as e:
+        action = {'create': '建立', 'verify': '校驗', 'restore': '恢復'}[args.command]
+        print(f"快照{action}失敗: {e}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
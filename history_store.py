@@ -0,0 +1,228 @@
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+class HistoryStore:
+    """以 SQLite 索引保存的查詢歷史紀錄
+
+    - history 表只存摘要欄位（問題、時間、答案、task_id 等），列表查詢不需要解析大對象
+    - filter_interactions 等大型交互訊息存在 history_blobs 表，只在需要時讀取
+    - task_id 有索引，可直接定位歷史紀錄
+    - 沒有寫入歷史紀錄的任務（錯誤、取消等），其交互訊息被記憶體快取淘汰時存入 spilled_interactions 表
+    - 舊版 history/*.json 文件會在初始化時自動導入
+    """
+
+    def __init__(self, history_dir: str = "history"):
+        self.history_dir = history_dir
+        self.db_file = os.path.join(history_dir, "history.db")
+        self._lock = threading.Lock()
+        os.makedirs(history_dir, exist_ok=True)
+        self._init_db()
+        self.migrate_json_files()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS history (
+                    id TEXT PRIMARY KEY,
+                    timestamp INTEGER,
+                    question TEXT,
+                    date_range TEXT,
+                    answer TEXT,
+                    task_id TEXT,
+                    steps TEXT,
+                    extra TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_history_task_id ON history(task_id);
+                CREATE TABLE IF NOT EXISTS history_blobs (
+                    id TEXT PRIMARY KEY,
+                    filter_interactions TEXT
+                );
+                CREATE TABLE IF NOT EXISTS spilled_interactions (
+                    task_id TEXT PRIMARY KEY,
+                    timestamp INTEGER,
+                    filter_interactions TEXT
+                );
+            """)
+
+    @staticmethod
+    def normalize_id(history_id: str) -> str:
+        """兼容前端傳入的 <id>.json 文件名"""
+        history_id = os.path.basename(history_id)
+        if history_id.endswith('.json'):
+            history_id = history_id[:-len('.json')]
+        return history_id
+
+    def _row_to_summary(self, row) -> Dict:
+        return {
+            'id': row['id'],
+            'timestamp': row['timestamp'],
+            'question': row['question'],
+            'date_range': row['date_range'],
+            'answer': row['answer'],
+            'filename': f"{row['id']}.json",
+            'task_id': row['task_id']
+        }
+
+    def save(self, record: Dict):
+        """保存一筆歷史紀錄"""
+        steps = record.get('steps') or {}
+        # 除已知欄位外的其他欄位原樣保存
+        known = {'id', 'timestamp', 'question', 'date_range', 'steps', 'task_id', 'filter_interactions'}
+        extra = {k: v for k, v in record.items() if k not in known}
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO history (id, timestamp, question, date_range, answer, task_id, steps, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record['id'],
+                    record.get('timestamp'),
+                    record.get('question'),
+                    record.get('date_range'),
+                    steps.get('answer', '') if isinstance(steps, dict) else '',
+                    record.get('task_id'),
+                    json.dumps(steps, ensure_ascii=False),
+                    json.dumps(extra, ensure_ascii=False) if extra else None,
+                )
+            )
+            if 'filter_interactions' in record:
+                conn.execute(
+                    "INSERT OR REPLACE INTO history_blobs (id, filter_interactions) VALUES (?, ?)",
+                    (record['id'], json.dumps(record['filter_interactions'], ensure_ascii=False))
+                )
+
+    def list(self, limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """按時間倒序列出摘要，返回 (紀錄列表, 下一頁游標)"""
+        sql = "SELECT id, timestamp, question, date_range, answer, task_id FROM history"
+        params = []
+        if cursor:
+            sql += " WHERE id < ?"
+            params.append(self.normalize_id(cursor))
+        sql += " ORDER BY id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1]['id']
+        return [self._row_to_summary(row) for row in rows], next_cursor
+
+    def get(self, history_id: str, include_interactions: bool = True) -> Optional[Dict]:
+        """獲取完整的歷史紀錄，交互訊息按需讀取"""
+        history_id = self.normalize_id(history_id)
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM history WHERE id = ?", (history_id,)).fetchone()
+            if row is None:
+                return None
+            record = json.loads(row['extra']) if row['extra'] else {}
+            record.update({
+                'id': row['id'],
+                'timestamp': row['timestamp'],
+                'question': row['question'],
+                'date_range': row['date_range'],
+                'steps': json.loads(row['steps']) if row['steps'] else {},
+                'task_id': row['task_id']
+            })
+            if include_interactions:
+                blob = conn.execute(
+                    "SELECT filter_interactions FROM history_blobs WHERE id = ?", (history_id,)
+                ).fetchone()
+                if blob is not None and blob['filter_interactions'] is not None:
+                    record['filter_interactions'] = json.loads(blob['filter_interactions'])
+        return record
+
+    def get_filter_interactions(self, task_id: str) -> Optional[Dict]:
+        """按 task_id 直接讀取篩選交互訊息（先查歷史紀錄，再查被淘汰保存的交互訊息）"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT b.filter_interactions FROM history h "
+                "JOIN history_blobs b ON b.id = h.id WHERE h.task_id = ? LIMIT 1",
+                (task_id,)
+            ).fetchone()
+            if row is None or row['filter_interactions'] is None:
+                row = conn.execute(
+                    "SELECT filter_interactions FROM spilled_interactions WHERE task_id = ?", (task_id,)
+                ).fetchone()
+        if row is None or row['filter_interactions'] is None:
+            return None
+        return json.loads(row['filter_interactions'])
+
+    def spill_interactions(self, task_id: str, interactions_json: str) -> bool:
+        """保存從記憶體淘汰的交互訊息（已序列化的 JSON）；該任務已有歷史紀錄時略過，返回是否寫入"""
+        with self._lock, self._connect() as conn:
+            saved = conn.execute(
+                "SELECT 1 FROM history h JOIN history_blobs b ON b.id = h.id WHERE h.task_id = ? LIMIT 1",
+                (task_id,)
+            ).fetchone()
+            if saved is not None:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO spilled_interactions (task_id, timestamp, filter_interactions) VALUES (?, ?, ?)",
+                (task_id, int(time.time()), interactions_json)
+            )
+        return True
+
+    def purge_spilled(self, max_age_seconds: float) -> int:
+        """刪除保存超過 max_age_seconds 的淘汰交互訊息，返回刪除筆數"""
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "DELETE FROM spilled_interactions WHERE timestamp < ?", (int(time.time() - max_age_seconds),)
+            )
+            return cur.rowcount
+
+    def delete(self, history_ids: List[str]) -> int:
+        """刪除歷史紀錄，返回刪除筆數"""
+        ids = [self.normalize_id(h) for h in history_ids]
+        deleted = 0
+        with self._lock, self._connect() as conn:
+            for history_id in ids:
+                cur = conn.execute("DELETE FROM history WHERE id = ?", (history_id,))
+                conn.execute("DELETE FROM history_blobs WHERE id = ?", (history_id,))
+                deleted += cur.rowcount
+        return deleted
+
+    def migrate_json_files(self) -> int:
+        """導入舊版 history/*.json 文件，原文件移到 json_backup/ 目錄，返回導入筆數"""
+        files = glob.glob(os.path.join(self.history_dir, '*.json'))
+        if not files:
+            return 0
+        backup_dir = os.path.join(self.history_dir, 'json_backup')
+        os.makedirs(backup_dir, exist_ok=True)
+        imported = 0
+        for f in files:
+            try:
+                with open(f, 'r', encoding='utf-8') as fp:
+                    data = json.load(fp)
+                data.setdefault('id', os.path.splitext(os.path.basename(f))[0])
+                self.save(data)
+                os.replace(f, os.path.join(backup_dir, os.path.basename(f)))
+                imported += 1
+            except Exception as e:
+                print(f"導入歷史紀錄 {f} 失敗: {e}")
+        print(f"已將 {imported} 筆 JSON 歷史紀錄導入索引資料庫")
+        return imported
+
+if __name__ == '__main__':
+    import sys
+    history_dir = sys.argv[1] if len(sys.argv) > 1 else 'history'
+    # 初始化時即會執行遷移
+    HistoryStore(history_dir)
@@ -0,0 +1,92 @@
+import re
+from typing import List
+
+# 查詢改寫的系統提示詞（llm 模式）：只要求輸出改寫，不需要推理
+QUERY_EXPANSION_SYSTEM_MESSAGE = """您是技術支援工單檢索助手。請把用戶問題改寫成幾種不同的說法，以便檢索歷史工單:
+1. 可替換中英文術語（例如 黑屏 / no display，網卡 / LAN）
+2. 可把產品型號寫成系列（例如 4x4-7840U = 7000系列，NUC MTL = NUC 125 155）
+3. 保留客戶名稱與型號
+每行輸出一個改寫，不要編號，不要添加其他內容。/no_think
+"""
+
+# 中英文術語對照（工程師在工單中常混用）
+TERM_SYNONYMS = [
+    ("黑屏", "no display"),
+    ("無畫面", "no display"),
+    ("藍屏", "BSOD"),
+    ("網卡", "LAN"),
+    ("掉線", "link down"),
+    ("開機", "boot"),
+    ("重啟", "reboot"),
+    ("喚醒", "wake up"),
+    ("待機", "sleep"),
+    ("風扇", "fan"),
+    ("驅動程式", "driver"),
+    ("韌體", "firmware"),
+    ("音效", "audio"),
+    ("記憶體", "memory"),
+    ("螢幕", "monitor"),
+]
+
+_SERIES_MODEL = re.compile(r'4x4[- ]?(\d)\d{3}[a-z]*', re.IGNORECASE)
+_SERIES_NAME = re.compile(r'(\d)000\s*系列')
+_NUC_MTL = re.compile(r'NUC\s*MTL', re.IGNORECASE)
+_NUC_125_155 = re.compile(r'NUC\s*(125|155)', re.IGNORECASE)
+
+def _model_series_variants(query: str) -> List[str]:
+    """按 DocumentFilter 提示詞中的型號識別規則改寫型號（4x4-7XXX = 7000系列，NUC MTL = NUC 125 155）"""
+    variants = []
+    if _SERIES_MODEL.search(query):
+        variants.append(_SERIES_MODEL.sub(lambda m: f"4x4 {m.group(1)}000系列", query))
+    if _SERIES_NAME.search(query):
+        variants.append(_SERIES_NAME.sub(lambda m: f"4x4-{m.group(1)}XXX", query))
+    if _NUC_MTL.search(query):
+        variants.append(_NUC_MTL.sub("NUC 125 155", query))
+    elif _NUC_125_155.search(query):
+        variants.append(_NUC_125_155.sub("NUC MTL", query, count=1))
+    return variants
+
+# 英文術語按完整單詞匹配（boot 不會匹配 reboot 中的部分）
+_ENGLISH_TERMS = [re.compile(r'(?<![a-z0-9])' + re.escape(english) + r'(?![a-z0-9])', re.IGNORECASE)
+                  for _, english in TERM_SYNONYMS]
+
+def _term_variant(query: str) -> str:
+    """中英文術語互換後的問題（沒有可替換的術語時返回原問題）"""
+    original = query
+    for (chinese, english), english_term in zip(TERM_SYNONYMS, _ENGLISH_TERMS):
+        if chinese in query:
+            query = query.replace(chinese, f" {english} ")
+        elif english_term.search(original):
+            query = english_term.sub(chinese, query)
+    return re.sub(r'\s+', ' ', query).strip()
+
+def rule_variants(query: str) -> List[str]:
+    """以型號規則與術語對照生成改寫（不呼叫 LLM）"""
+    variants = _model_series_variants(query)
+    variants.append(_term_variant(query))
+    if variants[:-1]:
+        variants.append(_term_variant(variants[0]))
+    return variants
+
+def parse_llm_variants(text: str, max_length: int = 200) -> List[str]:
+    """解析 LLM 輸出的改寫：每行一個，去除思考區段、編號與項目符號，略過過長的行"""
+    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
+    variants = []
+    for line in text.splitlines():
+        line = re.sub(r'^\s*(?:[-*•]|\d+[.、)])\s*', '', line).strip()
+        if line and len(line) <= max_length:
+            variants.append(line)
+    return variants
+
+def merge_variants(query: str, variants: List[str], limit: int) -> List[str]:
+    """原問題在前，去重後最多保留 limit 個改寫"""
+    queries = [query]
+    seen = {query.strip().lower()}
+    for variant in variants:
+        key = variant.strip().lower()
+        if key and key not in seen:
+            seen.add(key)
+            queries.append(variant.strip())
+        if len(queries) > limit:
+            break
+    return queries
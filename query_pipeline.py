@@ -0,0 +1,188 @@
+"""
+/api/query/stream 的查詢流程（Flask 與 ASGI 版本共用）
+
+query_events() 是與 I/O 方式無關的生成器：按 搜索 → 重排 → 篩選 → 生成 的順序產出 SSE 事件，
+需要執行耗時的階段時改為產出 StageCall，由驅動方執行後以 send() 傳回結果：
+- Flask 版本（app.py）在工作線程中執行同步方法，等待期間產出心跳
+- ASGI 版本（asgi_app.py）await 對應的異步方法
+兩個版本的事件內容、階段順序與歷史紀錄因此只有一份實現。
+"""
+
+import json
+import os
+import time
+from typing import Dict, Tuple
+
+from cancellation import TaskCancelled
+
+NO_RELEVANT_ANSWER = '沒有找到相關文檔來回答您的問題。'
+
+class StageCall:
+    """請求驅動方執行的階段（search、rerank、filter、speculative_result、generate、save_history）"""
+
+    def __init__(self, stage: str, *args, **kwargs):
+        self.stage = stage
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"StageCall({self.stage})"
+
+def format_sse(data: str, event=None) -> str:
+    """格式化 SSE 數據"""
+    msg = f'data: {data}\n\n'
+    if event is not None:
+        msg = f'event: {event}\n{msg}'
+    return msg
+
+def format_step(step: str, **fields) -> str:
+    """格式化流程步驟的 SSE 事件: {'step': step, ...}"""
+    return format_sse(json.dumps(dict(step=step, **fields)))
+
+def _original_filename(doc: Dict) -> str:
+    return doc['metadata'].get('original_filename', os.path.basename(doc['metadata']['source']))
+
+def format_search_result(doc):
+    """搜索結果的 SSE / 歷史紀錄格式"""
+    result = {
+        'filename': os.path.basename(doc['metadata']['source']),
+        'original_filename': _original_filename(doc),
+        'similarity': 1 - doc['distance'],
+        'chunk_id': doc['metadata'].get('chunk_id', 0),
+        'timestamp': doc.get('timestamp', '')
+    }
+    if 'rerank_score' in doc:
+        result['rerank_score'] = doc['rerank_score']
+    if doc.get('neighbors'):
+        result['neighbor_chunk_ids'] = [n['metadata'].get('chunk_id', 0) for n in doc['neighbors']]
+    return result
+
+def format_filtered_result(doc):
+    """篩選結果的 SSE / 歷史紀錄格式"""
+    return {
+        'filename': os.path.basename(doc['metadata']['source']),
+        'original_filename': _original_filename(doc),
+        'relevance_score': doc.get('relevance_score', 1.0),
+        'chunk_id': doc['metadata'].get('chunk_id', 0),
+        'timestamp': doc.get('timestamp', '')
+    }
+
+def failure_event(error: Exception) -> Tuple[str, str]:
+    """把流程中拋出的異常轉為 (查詢結果, SSE 錯誤事件)"""
+    if isinstance(error, TaskCancelled):
+        print(f"查詢已取消: {error}")
+        return 'cancelled', format_step('error', message=str(error))
+    print(f"處理查詢時發生錯誤: {str(error)}")
+    return 'error', format_step('error', message=f'處理查詢時發生錯誤: {str(error)}')
+
+def query_events(task_rag_system, question: str, date_range: str, speculation, stream_task, on_filtered):
+    """查詢流程的 SSE 事件序列（見模組說明），答案送出後 stream_task.outcome 設為 'answered'
+
+    speculation: 投機生成（沒有啟用時為 None），確認相關文檔後以 maybe_start 提前開始生成
+    on_filtered(filter_interactions): 篩選結束後呼叫，讓進行中的任務可以查詢篩選交互訊息
+    """
+    # 各階段耗時（秒），隨歷史紀錄保存
+    timings = {}
+    pipeline_start = time.time()
+
+    # 1. 搜索文檔步驟（啟用重排時先取較多候選）
+    stage_start = time.time()
+    documents = yield StageCall('search', question, n_results=task_rag_system.candidate_count(4),
+                                date_range=date_range if date_range else None)
+    timings['search'] = round(time.time() - stage_start, 3)
+    print(f"搜索到 {len(documents)} 個文檔")
+
+    if not documents:
+        yield format_step('error', message='在指定時間範圍內沒有找到相關文檔')
+        return
+
+    # 重排候選，只讓分數最高的幾個進入 LLM 篩選
+    stage_start = time.time()
+    candidate_count = len(documents)
+    documents = yield StageCall('rerank', question, documents, 4)
+    timings['rerank'] = round(time.time() - stage_start, 3)
+    print(f"重排後保留 {len(documents)}/{candidate_count} 個候選")
+
+    if not documents:
+        yield format_step('error', message='沒有找到與問題足夠相關的文檔')
+        return
+
+    search_results = [format_search_result(doc) for doc in documents]
+    yield format_step('search', results=search_results)
+
+    # 2. 篩選文檔步驟
+    stage_start = time.time()
+    relevant_docs = []
+    all_filter_interactions = {}  # 保存所有文檔的交互訊息
+
+    for i, doc in enumerate(documents):
+        # 提前終止：已確認足夠的相關文檔，或剩餘文檔相似度過低
+        stop_reason = task_rag_system.early_stop_reason(relevant_docs, doc)
+        if stop_reason:
+            print(stop_reason)
+            yield format_step('filter_thought', thought=stop_reason)
+            break
+
+        original_filename = _original_filename(doc)
+        yield format_step('filter_progress', current_doc={
+            'filename': os.path.basename(doc['metadata']['source']),
+            'original_filename': original_filename,
+            'progress': f"正在分析第 {i+1}/{len(documents)} 個文檔",
+            'similarity': 1 - doc['distance'],
+            'status': 'analyzing'
+        })
+        yield format_step('filter_thought', thought=f"正在評估文檔 '{original_filename}' 與問題的相關性...")
+
+        _, filter_interactions = yield StageCall('filter', question, doc)
+        all_filter_interactions.update(filter_interactions)
+        is_relevant = filter_interactions.get(task_rag_system._doc_key(doc), {}).get('is_relevant', False)
+
+        yield format_step('filter_result', result={
+            'filename': original_filename,
+            'is_relevant': is_relevant,
+            'thought': "這個文檔" + ("與問題高度相關" if is_relevant else "與問題關聯度較低")
+        })
+
+        if is_relevant:
+            relevant_docs.append(doc)
+            if speculation:
+                speculation.maybe_start(relevant_docs)
+
+    timings['filter'] = round(time.time() - stage_start, 3)
+    print(f"篩選後剩餘 {len(relevant_docs)} 個文檔")
+    on_filtered(all_filter_interactions)
+
+    if not relevant_docs:
+        # 沒有相關文檔時直接進入答案步驟
+        yield format_step('filter', results=[])
+        yield format_step('answer', answer=NO_RELEVANT_ANSWER)
+        return
+
+    filtered_results = [format_filtered_result(doc) for doc in relevant_docs]
+    yield format_step('filter', results=filtered_results)
+
+    # 3. 生成答案步驟
+    stage_start = time.time()
+    answer = (yield StageCall('speculative_result', relevant_docs)) if speculation else None
+    timings['speculative_hit'] = answer is not None
+    if answer is None:
+        answer = yield StageCall('generate', question, relevant_docs)
+    timings['generate'] = round(time.time() - stage_start, 3)
+    # 從開始搜索到答案送出的時間（不含排隊）
+    timings['time_to_answer'] = round(time.time() - pipeline_start, 3)
+    print(f"各階段耗時: {timings}")
+
+    yield format_step('answer', answer=answer)
+    stream_task.outcome = 'answered'
+
+    steps_data = {
+        'search': search_results,
+        'filter': filtered_results,
+        'answer': answer,
+        'timings': timings,
+        'rerank': {'candidates': candidate_count, 'llm_filter_calls': len(all_filter_interactions)},
+        'prefill': dict(task_rag_system.prefill_stats),
+        'trace': list(task_rag_system.span_log)
+    }
+    print(f"Prefill 統計: {task_rag_system.prefill_stats}")
+    yield StageCall('save_history', question, date_range, steps_data, all_filter_interactions)
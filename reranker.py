@@ -0,0 +1,113 @@
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+class LexicalReranker:
+    """以詞彙重疊度重排候選文檔（純 CPU，無額外依賴）
+
+    中文按字元二元組、英數按單詞計算問題詞彙在文檔中的覆蓋率，
+    再與向量相似度加權合成分數。
+    """
+
+    name = "lexical"
+
+    def __init__(self, lexical_weight: float = 0.5):
+        self.lexical_weight = lexical_weight
+
+    @staticmethod
+    def _terms(text: str) -> set:
+        text = text.lower()
+        terms = set(re.findall(r'[a-z0-9]+', text))
+        for segment in re.findall(r'[一-鿿]+', text):
+            if len(segment) == 1:
+                terms.add(segment)
+            terms.update(segment[i:i + 2] for i in range(len(segment) - 1))
+        return terms
+
+    def score(self, query: str, documents: List[Dict]) -> List[float]:
+        query_terms = self._terms(query)
+        scores = []
+        for doc in documents:
+            coverage = 0.0
+            if query_terms:
+                coverage = len(query_terms & self._terms(doc['content'])) / len(query_terms)
+            similarity = 1 - doc.get('distance', 1.0)
+            scores.append(self.lexical_weight * coverage + (1 - self.lexical_weight) * similarity)
+        return scores
+
+class CrossEncoderReranker:
+    """以小型 cross-encoder 模型為 (問題, 文檔) 對評分
+
+    模型透過 sentence-transformers 載入，backend 可選 torch 或 onnx（onnxruntime）。
+    單輸出模型的分數經 sigmoid 落在 0~1 之間。
+    """
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name: str, backend: str = "torch", max_length: int = 512):
+        # 延遲導入：未啟用重排時不需要安裝 sentence-transformers
+        from sentence_transformers import CrossEncoder
+
+        kwargs = {'max_length': max_length}
+        if backend != "torch":
+            kwargs['backend'] = backend
+        self.model = CrossEncoder(model_name, **kwargs)
+        self._lock = threading.Lock()
+
+    def score(self, query: str, documents: List[Dict]) -> List[float]:
+        pairs = [(query, doc['content']) for doc in documents]
+        with self._lock:
+            scores = self.model.predict(pairs, show_progress_bar=False)
+        return [float(s) for s in scores]
+
+_reranker = None
+_reranker_loaded = False
+_reranker_lock = threading.Lock()
+
+def get_reranker():
+    """按環境變數創建（並在進程內共享）重排器，未啟用時返回 None
+
+    - TSD_RERANKER: none（預設）、lexical 或 cross-encoder
+    - TSD_RERANKER_MODEL: cross-encoder 模型名稱或路徑
+    - TSD_RERANKER_BACKEND: torch（預設）或 onnx
+    - TSD_RERANKER_LEXICAL_WEIGHT: lexical 模式中詞彙覆蓋率的權重
+    """
+    global _reranker, _reranker_loaded
+    if _reranker_loaded:
+        return _reranker
+    with _reranker_lock:
+        if _reranker_loaded:
+            return _reranker
+        kind = os.environ.get('TSD_RERANKER', 'none').lower()
+        try:
+            if kind == 'lexical':
+                _reranker = LexicalReranker(float(os.environ.get('TSD_RERANKER_LEXICAL_WEIGHT', 0.5)))
+            elif kind == 'cross-encoder':
+                _reranker = CrossEncoderReranker(
+                    os.environ.get('TSD_RERANKER_MODEL', 'BAAI/bge-reranker-base'),
+                    backend=os.environ.get('TSD_RERANKER_BACKEND', 'torch')
+                )
+            elif kind != 'none':
+                print(f"未知的重排器類型: {kind}，不進行重排")
+        except Exception as e:
+            # 模型載入失敗時退回純向量排序，不影響查詢
+            print(f"載入重排器失敗，不進行重排: {e}")
+            _reranker = None
+        if _reranker is not None:
+            print(f"已啟用重排器: {_reranker.name}")
+        _reranker_loaded = True
+    return _reranker
+
+def rerank(reranker, query: str, documents: List[Dict], top_n: int,
+           min_score: Optional[float] = None) -> List[Dict]:
+    """重排候選文檔，套用分數門檻後返回前 top_n 個（每個文檔附上 rerank_score）"""
+    if reranker is None or not documents:
+        return documents[:top_n]
+    scores = reranker.score(query, documents)
+    ranked = []
+    for doc, score in sorted(zip(documents, scores), key=lambda x: x[1], reverse=True):
+        if min_score is not None and score < min_score:
+            continue
+        ranked.append(dict(doc, rerank_score=score))
+    return ranked[:top_n]
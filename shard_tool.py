@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+向量資料庫的月份分片管理
+
+片段按時間戳（YYYYMMDD）分到月份分片，時間區間搜索只掃描重疊的分片。
+舊月份可整個歸檔到獨立的資料庫目錄（含嵌入向量，不需重新計算），需要時再恢復。
+服務運行中也可執行：各 worker 偵測到索引更新後自動重新載入。
+
+用法:
+    python shard_tool.py list
+    python shard_tool.py archive 202301 202302 --archive-dir ./custom_json_rag_db_archive
+    python shard_tool.py archive --before 202401
+    python shard_tool.py restore 202301
+"""
+
+import argparse
+import os
+
+from vector_db import JSONVectorDB, UNDATED_SHARD
+
+def main():
+    parser = argparse.ArgumentParser(description="向量資料庫月份分片的列出、歸檔與恢復")
+    parser.add_argument('command', choices=['list', 'archive', 'restore'], help='操作')
+    parser.add_argument('shards', nargs='*', help='月份分片（YYYYMM）')
+    parser.add_argument('--db', default='./custom_json_rag_db', help='向量資料庫目錄')
+    parser.add_argument('--archive-dir', default='./custom_json_rag_db_archive', help='歸檔目錄（每個分片一個子目錄）')
+    parser.add_argument('--before', help='archive: 歸檔早於此月份（YYYYMM，不含）的所有分片')
+    args = parser.parse_args()
+
+    db = JSONVectorDB(args.db)
+
+    if args.command == 'list':
+        for entry in db.list_shards():
+            print(f"{entry['shard'] or '(無日期)'}\t{entry['chunks']}")
+        if os.path.isdir(args.archive_dir):
+            archived = sorted(name for name in os.listdir(args.archive_dir)
+                              if os.path.exists(os.path.join(args.archive_dir, name, 'index.json')))
+            if archived:
+                print(f"已歸檔: {', '.join(archived)}")
+        return
+
+    shards = list(args.shards)
+    if args.command == 'archive' and args.before:
+        shards += [entry['shard'] for entry in db.list_shards()
+                   if entry['shard'] != UNDATED_SHARD and entry['shard'] < args.before]
+    if not shards:
+        parser.error('請指定分片（YYYYMM）或 --before')
+
+    total = 0
+    for shard in sorted(set(shards)):
+        if args.command == 'archive':
+            total += db.archive_shard(shard, args.archive_dir)
+        else:
+            total += db.restore_shard(shard, args.archive_dir)
+    print(f"{'歸檔' if args.command == 'archive' else '恢復'}完成，共 {total} 個片段")
+
+if __name__ == '__main__':
+    main()
@@ -1,74 +1,178 @@
 #!/usr/bin/env python3
 """
 啟動服務器並顯示多IP用戶獨立性信息
+
+開發模式:
+    python start_server.py
+生產模式（gunicorn，fork 前預載向量資料庫）:
+    python start_server.py --production --threads 16
+    python start_server.py --production --asgi
+
+任務表、頁面重新載入時的取消、篩選交互訊息與准入控制都保存在進程內，
+因此生產模式預設只啟動一個 worker（WSGI 以線程、ASGI 以協程處理並發）；
+--workers 大於 1 時這些狀態按 worker 各自獨立，見 warn_multi_worker()。
 """
 
+import argparse
+import importlib.util
 import os
 import sys
-from app import app
+import threading
 
-def print_banner():
+def print_banner(host='0.0.0.0', port=5000):
     """打印啟動橫幅"""
     print("=" * 60)
     print("🚀 TSD AI 助手")
     print("=" * 60)
-    print("🌐 服務器將在 http://0.0.0.0:5000 啟動")
+    print(f"🌐 服務器將在 http://{host}:{port} 啟動")
     print("📝 測試多IP功能: python test_multi_ip.py")
     print("=" * 60)
 
-def check_dependencies():
-    """檢查依賴項"""
+def check_dependencies(production=False, asgi=False):
+    """檢查依賴項（只查找模組，不實際導入）"""
     required_modules = [
-        'flask', 'ollama', 'autogen', 'langchain', 
+        'flask', 'ollama', 'langchain',
         'pandas', 'docx', 'numpy', 'sklearn', 'opencc'
     ]
-    
+    if production:
+        required_modules.append('gunicorn')
+    if asgi:
+        required_modules.extend(['starlette', 'uvicorn'])
+
     missing_modules = []
     for module in required_modules:
-        try:
-            __import__(module)
-        except ImportError:
+        if importlib.util.find_spec(module) is None:
             missing_modules.append(module)
-    
+
     if missing_modules:
         print("❌ 缺少以下依賴項:")
         for module in missing_modules:
             print(f"   - {module}")
         print("\n請安裝缺少的依賴項:")
-        print("pip install flask ollama autogen langchain pandas python-docx numpy scikit-learn opencc-python-reimplemented")
+        print("pip install -r requirements.txt")
         return False
-    
+
     print("✅ 所有依賴項檢查通過")
     return True
 
+def parse_args():
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description="TSD AI 助手服務器")
+    parser.add_argument('--host', default=os.environ.get('TSD_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('TSD_PORT', 5000)))
+    parser.add_argument('--production', action='store_true',
+                        help='使用 gunicorn 啟動')
+    parser.add_argument('--asgi', action='store_true',
+                        help='生產模式下使用 ASGI 應用 (asgi_app:app) 與 uvicorn worker')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('TSD_WORKERS', 1)),
+                        help='worker 進程數（任務與排隊狀態是進程內的，多於 1 個時見啟動時的提示）')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('TSD_THREADS', 8)),
+                        help='每個 worker 的線程數（僅 WSGI 模式）')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('TSD_GRACEFUL_TIMEOUT', 30)),
+                        help='關閉時等待正在處理的請求結束的秒數')
+    return parser.parse_args()
+
+def warn_multi_worker(workers, max_concurrent):
+    """多 worker 時提示進程內狀態的限制"""
+    print(f"⚠️  {workers} 個 worker 各自保存任務與排隊狀態:")
+    print("   - 重新載入頁面只會取消由同一個 worker 處理的任務")
+    print("   - /api/filter_interaction 只在處理該查詢的 worker 上找得到進行中的任務")
+    print(f"   - 同時執行的 LLM 任務上限為 {workers} × TSD_MAX_CONCURRENT_TASKS = {workers * max_concurrent}")
+    print("   單台 Ollama 伺服器建議使用 1 個 worker，以 --threads（WSGI）或 --asgi 提高並發")
+
+def run_production(args):
+    """以 gunicorn 多 worker 模式啟動"""
+    from gunicorn.app.base import BaseApplication
+
+    import app as app_module
+    from cancellation import install_shutdown_handlers
+
+    if args.workers > 1:
+        warn_multi_worker(args.workers, app_module.admission_controller.max_concurrent)
+
+    # fork 前預載向量資料庫，worker 透過寫時複製共享嵌入矩陣
+    app_module.preload_vector_store()
+
+    if args.asgi:
+        import asgi_app
+        application = asgi_app.app
+        worker_class = 'uvicorn.workers.UvicornWorker'
+    else:
+        application = app_module.app
+        worker_class = 'gthread'
+
+    def post_worker_init(worker):
+        # ASGI 模式下 uvicorn 在此之後才安裝自己的信號處理器，改由 asgi_app 的 lifespan 安裝
+        if not args.asgi:
+            install_shutdown_handlers(app_module.stop_all_tasks)
+
+    class StandaloneApplication(BaseApplication):
+        def __init__(self, application, options=None):
+            self.options = options or {}
+            self.application = application
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if key in self.cfg.settings and value is not None:
+                    self.cfg.set(key.lower(), value)
+
+        def load(self):
+            return self.application
+
+    options = {
+        'bind': f"{args.host}:{args.port}",
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': worker_class,
+        'preload_app': True,
+        'timeout': 300,
+        'graceful_timeout': args.graceful_timeout,
+        'post_worker_init': post_worker_init,
+    }
+    print(f"🚀 生產模式: {worker_class}, workers={args.workers}, threads={args.threads}")
+    StandaloneApplication(application, options).run()
+
+def run_development(args):
+    """以 Flask 開發服務器啟動"""
+    import app as app_module
+
+    # 在背景線程中預載向量資料庫，/api/ready 在載入完成後轉為就緒
+    threading.Thread(target=app_module.preload_vector_store, daemon=True).start()
+
+    app_module.app.run(
+        host=args.host,
+        port=args.port,
+        debug=True,
+        use_reloader=False  # 避免重複啟動
+    )
+
 def main():
     """主函數"""
-    print_banner()
-    
+    args = parse_args()
+    print_banner(args.host, args.port)
+
     # 檢查依賴項
-    if not check_dependencies():
+    if not check_dependencies(production=args.production, asgi=args.asgi):
         sys.exit(1)
-    
+
     # 檢查必要的目錄和文件
     if not os.path.exists('templates'):
         print("❌ 缺少 templates 目錄")
         sys.exit(1)
-    
+
     if not os.path.exists('static'):
         print("❌ 缺少 static 目錄")
         sys.exit(1)
-    
+
     print("✅ 環境檢查完成")
     print("\n🚀 啟動服務器...")
-    
+
     try:
-        # 啟動Flask應用
-        app.run(
-            host='0.0.0.0', 
-            port=5000, 
-            debug=True,
-            use_reloader=False  # 避免重複啟動
-        )
+        if args.production:
+            run_production(args)
+        else:
+            run_development(args)
     except KeyboardInterrupt:
         print("\n👋 服務器已停止")
     except Exception as e:
@@ -76,4 +180,4 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
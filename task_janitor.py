@@ -0,0 +1,126 @@
+"""
+任務狀態的記憶體上限與背景清理
+
+- InteractionCache: 已完成任務的篩選交互訊息，以 JSON 字串保存（大小可準確計算），
+  超過 TTL 或總位元組預算時按 LRU 淘汰，淘汰的內容交給 spill 回調（寫入歷史紀錄庫）
+- Janitor: 背景線程，定期執行清理工作，不再依賴頁面載入觸發
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+class InteractionCache:
+    """按 task_id 保存的交互訊息 LRU 快取（線程安全）"""
+
+    def __init__(self, ttl_seconds: float = 3600, max_bytes: int = 64 * 1024 * 1024,
+                 spill: Optional[Callable[[str, str], None]] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self._entries = OrderedDict()  # {task_id: (JSON 字串, 位元組數, 完成時間)}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'evicted_ttl': 0, 'evicted_budget': 0, 'spilled': 0, 'spill_errors': 0}
+
+    def put(self, task_id: str, interactions: Dict):
+        payload = json.dumps(interactions, ensure_ascii=False)
+        size = len(payload.encode('utf-8'))
+        with self._lock:
+            old = self._entries.pop(task_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[task_id] = (payload, size, time.time())
+            self._bytes += size
+            evicted = self._evict_over_budget()
+        self._spill(evicted)
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(task_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(task_id)
+        return json.loads(entry[0])
+
+    def __contains__(self, task_id: str) -> bool:
+        with self._lock:
+            return task_id in self._entries
+
+    def _evict_over_budget(self) -> List:
+        """淘汰最久未使用的條目直到不超過預算（呼叫時需持有鎖）"""
+        evicted = []
+        while self._bytes > self.max_bytes and self._entries:
+            task_id, (payload, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.stats['evicted_budget'] += 1
+            evicted.append((task_id, payload))
+        return evicted
+
+    def expire(self, now: float = None) -> int:
+        """淘汰超過 TTL 的條目，返回淘汰數"""
+        now = now or time.time()
+        with self._lock:
+            expired = [task_id for task_id, (_, _, completed) in self._entries.items()
+                       if now - completed > self.ttl_seconds]
+            evicted = []
+            for task_id in expired:
+                payload, size, _ = self._entries.pop(task_id)
+                self._bytes -= size
+                evicted.append((task_id, payload))
+            self.stats['evicted_ttl'] += len(evicted)
+        self._spill(evicted)
+        return len(evicted)
+
+    def _spill(self, evicted: List):
+        if not self.spill:
+            return
+        for task_id, payload in evicted:
+            try:
+                self.spill(task_id, payload)
+                self.stats['spilled'] += 1
+            except Exception as e:
+                self.stats['spill_errors'] += 1
+                print(f"保存被淘汰的交互訊息 {task_id} 失敗: {e}")
+
+    def size(self) -> Dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes}
+
+class Janitor:
+    """定期執行清理工作的背景線程
+
+    ensure_started() 可重複呼叫；gunicorn fork 後的 worker 首次呼叫時會在本進程重新啟動線程。
+    """
+
+    def __init__(self, interval_seconds: float, jobs: List[Callable]):
+        self.interval_seconds = interval_seconds
+        self.jobs = jobs
+        self.runs = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name='task-janitor', daemon=True).start()
+
+    def run_once(self):
+        for job in self.jobs:
+            try:
+                job()
+            except Exception as e:
+                print(f"背景清理 {getattr(job, '__name__', job)} 失敗: {e}")
+        self.runs += 1
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval_seconds)
+            self.run_once()
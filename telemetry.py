@@ -0,0 +1,214 @@
+"""
+追蹤與指標
+
+- span(): 以 OpenTelemetry 記錄追蹤區段（未安裝時為空操作），並把耗時記入階段延遲直方圖
+- metrics: 進程內指標登錄表，/metrics 以 Prometheus 文本格式輸出
+
+設置 OTEL_EXPORTER_OTLP_ENDPOINT 且已安裝 opentelemetry-sdk 時，追蹤資料以 OTLP 導出。
+"""
+
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Tuple
+
+class Counter:
+    """單調遞增計數器"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    """固定分桶的直方圖"""
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # {labels: [各分桶計數..., 總和, 次數]}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def mean(self, **labels):
+        """某組標籤的平均觀測值，沒有觀測時返回 None"""
+        with self._lock:
+            series = self._series.get(tuple(sorted(labels.items())))
+            if not series or not series[-1]:
+                return None
+            return series[-2] / series[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+class Gauge:
+    """讀取時才計算的量測值；callback 返回數值，或 {標籤字典的 tuple: 數值}"""
+
+    def __init__(self, name: str, help_text: str, callback: Callable):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.callback()
+        except Exception as e:
+            print(f"讀取指標 {self.name} 失敗: {e}")
+            return lines
+        if isinstance(value, dict):
+            for key, v in value.items():
+                lines.append(f"{self.name}{_format_labels(key)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+def _format_labels(key) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in key) + '}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...]) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, callback: Callable) -> Gauge:
+        gauge = Gauge(name, help_text, callback)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+STAGE_LATENCY = metrics.histogram(
+    'tsd_stage_latency_seconds', '查詢與導入各階段耗時（秒）',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+)
+
+_tracer = None
+_tracer_loaded = False
+_tracer_lock = threading.Lock()
+
+def _get_tracer():
+    """延遲載入 OpenTelemetry tracer；未安裝時返回 None"""
+    global _tracer, _tracer_loaded
+    if _tracer_loaded:
+        return _tracer
+    with _tracer_lock:
+        if _tracer_loaded:
+            return _tracer
+        try:
+            from opentelemetry import trace
+            if os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT'):
+                try:
+                    from opentelemetry.sdk.resources import Resource
+                    from opentelemetry.sdk.trace import TracerProvider
+                    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+                    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+                    provider = TracerProvider(resource=Resource.create({
+                        'service.name': os.environ.get('OTEL_SERVICE_NAME', 'tsd-ai-assistant')
+                    }))
+                    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+                    trace.set_tracer_provider(provider)
+                except Exception as e:
+                    print(f"配置 OpenTelemetry 導出失敗，只記錄本地指標: {e}")
+            _tracer = trace.get_tracer('tsd.rag')
+        except ImportError:
+            _tracer = None
+        _tracer_loaded = True
+    return _tracer
+
+@contextmanager
+def span(name: str, log=None, **attributes):
+    """記錄一個追蹤區段
+
+    耗時記入 tsd_stage_latency_seconds{stage=name}；
+    提供 log（list 或 deque）時，另外追加 {'stage', 'seconds', ...屬性} 供保存到歷史紀錄。
+    """
+    tracer = _get_tracer()
+    start = time.perf_counter()
+    context = tracer.start_as_current_span(name, attributes=attributes) if tracer is not None else nullcontext()
+    try:
+        with context:
+            yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_LATENCY.observe(duration, stage=name)
+        if log is not None:
+            entry = {'stage': name, 'seconds': round(duration, 4)}
+            entry.update(attributes)
+            log.append(entry)
+
+def traced(name: str):
+    """方法裝飾器：以 span 包住整個方法（支援協程），記錄到實例的 span_log（如有）"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                with span(name, log=getattr(self, 'span_log', None)):
+                    return await func(self, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with span(name, log=getattr(self, 'span_log', None)):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+@pytest.fixture
+def add_chunks():
+    """向資料庫加入片段，返回 {id: 嵌入向量}；dates 為各片段的 YYYYMMDD"""
+    def add(db, ids, dates=None, dim=8, seed=0, source="tickets.txt"):
+        rng = np.random.default_rng(seed)
+        vectors = rng.random((len(ids), dim)).astype(np.float32)
+        metadatas = []
+        for i, doc_id in enumerate(ids):
+            metadata = {"source": source, "original_filename": source, "chunk_id": i}
+            if dates:
+                metadata["ticket_date"] = dates[i]
+            metadatas.append(metadata)
+        db.add(ids, vectors.tolist(), [f"內容 {doc_id}" for doc_id in ids], metadatas)
+        return dict(zip(ids, vectors))
+    return add
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+from admission import AdmissionController, QueueFullError
+
+def _enqueue(controller, *requests):
+    return [controller.enqueue(ip, task_id) for ip, task_id in requests]
+
+def test_global_cap():
+    controller = AdmissionController(max_concurrent=2)
+    first, second, third = _enqueue(controller, ("a", "1"), ("b", "2"), ("c", "3"))
+    assert first.granted and second.granted and not third.granted
+    assert controller.stats()["active"] == 2
+    assert controller.position(third) == 1
+    assert not controller.wait(third, timeout=0.01)
+
+    controller.release(first)
+    assert third.granted
+    assert controller.wait(third, timeout=0)
+    assert controller.stats()["active"] == 2
+    # 重複釋放不會多放出名額
+    controller.release(first)
+    assert controller.stats()["active"] == 2
+
+def test_round_robin_between_ips():
+    controller = AdmissionController(max_concurrent=1)
+    running, = _enqueue(controller, ("a", "run"))
+    queued = _enqueue(controller, ("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1"))
+    # 同一 IP 的多個分頁不會擋住其他 IP
+    assert [controller.position(ticket) for ticket in queued] == [1, 4, 5, 2, 3]
+
+    granted_order = []
+    current = running
+    for _ in queued:
+        controller.release(current)
+        current = next(ticket for ticket in queued if ticket.granted and ticket.task_id not in granted_order)
+        granted_order.append(current.task_id)
+    assert granted_order == ["a1", "b1", "c1", "a2", "a3"]
+
+def test_cancel_while_queued():
+    controller = AdmissionController(max_concurrent=1)
+    running, queued, later = _enqueue(controller, ("a", "1"), ("b", "2"), ("c", "3"))
+    controller.release(queued)
+    assert controller.position(later) == 1
+    controller.release(running)
+    assert later.granted and not queued.granted
+    assert controller.stats()["queued"] == 0
+
+def test_queue_limits_and_retry_after():
+    controller = AdmissionController(max_concurrent=1, max_queue_depth=3, max_queue_per_ip=2,
+                                     default_task_seconds=30)
+    _enqueue(controller, ("a", "run"), ("a", "a1"), ("a", "a2"))
+    with pytest.raises(QueueFullError) as error:
+        controller.enqueue("a", "a3")
+    # 兩個排隊中的任務，名額為 1：需等待 3 輪
+    assert error.value.retry_after == 90
+
+    controller.enqueue("b", "b1")
+    with pytest.raises(QueueFullError) as error:
+        controller.enqueue("c", "c1")
+    assert error.value.retry_after == 120
+    assert controller.stats()["rejected"] == 2
+
+def test_on_granted_callback_runs_in_releasing_thread():
+    controller = AdmissionController(max_concurrent=1)
+    running, queued = _enqueue(controller, ("a", "1"), ("b", "2"))
+    threads = []
+    queued.on_granted(lambda: threads.append(threading.current_thread().name))
+    assert threads == []
+
+    releaser = threading.Thread(target=controller.release, args=(running,), name="releaser")
+    releaser.start()
+    releaser.join()
+    assert threads == ["releaser"]
+    # 已獲准入時立即執行
+    queued.on_granted(lambda: threads.append("now"))
+    assert threads == ["releaser", "now"]
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+from batch_query import BatchQueryRunner, completed_ids, parse_questions, run_to_file
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from stub_ollama import StubBackend, start_stub_server
+from synthetic_corpus import build_vector_db, sample_questions
+
+def test_parse_records_and_plain_text():
+    questions = parse_questions([
+        json.dumps({"id": "a", "question": "設備無法開機", "date_range": "2024-01-01,2024-12-31"}),
+        "",
+        "電壓過低怎麼處理",
+        json.dumps("以 JSON 字串寫的問題"),
+        json.dumps({"question": "沒有 id 的問題"}),
+    ])
+    assert questions == [
+        {"id": "a", "question": "設備無法開機", "date_range": "2024-01-01,2024-12-31"},
+        {"id": "q3", "question": "電壓過低怎麼處理"},
+        {"id": "q4", "question": "以 JSON 字串寫的問題"},
+        {"id": "q5", "question": "沒有 id 的問題"},
+    ]
+
+def test_non_object_json_is_plain_text():
+    assert parse_questions(["[1,2]", "2024", "null"]) == [
+        {"question": "[1,2]", "id": "q1"},
+        {"question": "2024", "id": "q2"},
+        {"question": "null", "id": "q3"},
+    ]
+
+def test_records_without_question_are_skipped(capsys):
+    assert parse_questions([json.dumps({"id": "x"}), json.dumps({"question": ""}), '""']) == []
+    assert capsys.readouterr().out.count("略過") == 3
+
+def test_completed_ids_ignores_failures_and_partial_lines(tmp_path):
+    path = tmp_path / "results.jsonl"
+    path.write_text("\n".join([
+        json.dumps({"id": "q1", "answer": "答案"}),
+        json.dumps({"id": 2, "answer": "答案"}),
+        json.dumps({"id": "q3", "error": "逾時"}),
+        '{"id": "q4", "ans',
+    ]), encoding="utf-8")
+    assert completed_ids(str(path)) == {"q1", "2"}
+    assert completed_ids(str(tmp_path / "missing.jsonl")) == set()
+
+def test_runner_against_stub_ollama(tmp_path, monkeypatch):
+    server, address = start_stub_server(StubBackend(dim=64, relevant_ratio=1.0))
+    try:
+        monkeypatch.setenv("OLLAMA_HOST", address)
+        monkeypatch.setattr("agent_rag.convert_to_traditional", lambda text: text)
+        db = build_vector_db(str(tmp_path / "db"), 20, dim=64, tickets_per_file=10)
+        questions = parse_questions(sample_questions(5) + [json.dumps({"id": "ranged", "question": "風扇異音",
+                                                                       "date_range": "20240101 - 20241231"})])
+        output = str(tmp_path / "results.jsonl")
+        runner = BatchQueryRunner(db, workers=2, batch_size=4, n_results=2, filter_interval=0)
+        stats = run_to_file(runner, questions, output)
+        assert (stats["answered"], stats["failed"], stats["skipped"]) == (6, 0, 0)
+        with open(output, encoding="utf-8") as f:
+            results = {record["id"]: record for record in map(json.loads, f)}
+        assert set(results) == {record["id"] for record in questions}
+        assert all(len(record["search"]) == 2 and record["answer"] for record in results.values())
+        assert all(hit["timestamp"].startswith("2024") for hit in results["ranged"]["search"])
+
+        # 再次執行時略過已完成的問題
+        stats = run_to_file(BatchQueryRunner(db, workers=1, filter_interval=0), questions, output)
+        assert (stats["answered"], stats["skipped"]) == (0, 6)
+    finally:
+        server.shutdown()
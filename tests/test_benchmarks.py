@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from run_benchmarks import _flatten
+from stub_ollama import StubBackend, deterministic_embedding, start_stub_server
+from synthetic_corpus import build_vector_db, generate_tickets
+
+FILTER_SYSTEM = "回答 RELEVANT 或 NOT_RELEVANT"
+
+@pytest.fixture
+def stub():
+    backend = StubBackend(dim=64)
+    server, address = start_stub_server(backend)
+    yield backend, f"http://{address}"
+    server.shutdown()
+
+def _post(url, payload):
+    request = Request(url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+def test_deterministic_embedding():
+    a = deterministic_embedding("UPS 電壓過低告警", 64)
+    assert np.allclose(a, deterministic_embedding("UPS 電壓過低告警", 64))
+    assert np.linalg.norm(a) == pytest.approx(1.0)
+    similar = deterministic_embedding("UPS 電壓過低", 64)
+    different = deterministic_embedding("印表機卡紙無法列印", 64)
+    assert a @ similar > a @ different
+
+def test_stub_embed_and_prefix_reuse(stub):
+    backend, url = stub
+    response = _post(f"{url}/api/embed", {"model": "m", "input": ["甲", "乙"]})
+    assert np.array(response["embeddings"]).shape == (2, 64)
+
+    def filter_call(document):
+        return _post(f"{url}/api/chat", {"model": "m", "messages": [
+            {"role": "system", "content": FILTER_SYSTEM},
+            {"role": "user", "content": "用戶問題: 電壓過低\n文檔內容:\n" + document}]})
+    first = filter_call("第一份文檔")
+    second = filter_call("第二份文檔")
+    assert first["message"]["content"].split(":")[0] in ("RELEVANT", "NOT_RELEVANT")
+    # 第二次呼叫只需 prefill 與上一次不同的部分
+    assert 0 < second["prompt_eval_count"] < first["prompt_eval_count"]
+    assert backend.stats["chat_calls"] == 2 and backend.stats["embed_inputs"] == 2
+
+def test_rag_system_against_stub(stub, tmp_path, monkeypatch):
+    from agent_rag import CustomRAGAgentSystem
+    from vector_db import JSONVectorDB
+
+    _, url = stub
+    monkeypatch.setenv("OLLAMA_HOST", url)
+    system = CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+    reply = system._ollama_chat(FILTER_SYSTEM, "用戶問題: 測試", stage="filter.llm")
+    assert reply.startswith(("RELEVANT", "NOT_RELEVANT"))
+    assert system.prefill_stats["calls"] == 1
+
+def test_synthetic_corpus(tmp_path):
+    tickets = list(generate_tickets(5, seed=3))
+    assert tickets == list(generate_tickets(5, seed=3))
+    assert [ticket["date"] for ticket in tickets] == sorted(ticket["date"] for ticket in tickets)
+    assert tickets[0]["text"].startswith(f"編號與日期: (100000) {tickets[0]['date']}")
+
+    db = build_vector_db(str(tmp_path / "db"), 12, dim=16, tickets_per_file=5)
+    assert len(db.get(include=["ids"])["ids"]) == 12
+    assert [entry["chunks"] for entry in db.list_files()] == [5, 5, 2]
+
+def test_flatten_report():
+    report = {"vector_query": {"float32": {"p50_ms": 1.5, "ok": True}}, "chunks": 10}
+    assert _flatten(report) == {"vector_query.float32.p50_ms": 1.5, "chunks": 10}
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cancellation import (ABORTED_CALLS, CancellationToken, TaskCancelled, await_cancellable,
+                          run_cancellable)
+
+def _aborted(stage):
+    return ABORTED_CALLS._values.get((("stage", stage),), 0)
+
+def test_cancel_runs_callbacks_once():
+    token = CancellationToken()
+    calls = []
+    token.register(lambda: calls.append("a"))
+    handle = token.register(lambda: calls.append("b"))
+    token.unregister(handle)
+    assert token.cancel("disconnect") is True
+    assert token.cancel("shutdown") is False
+    assert (token.cancelled, token.reason, calls) == (True, "disconnect", ["a"])
+    # 已取消時註冊的回調立即執行
+    assert token.register(lambda: calls.append("late")) is None
+    assert calls == ["a", "late"]
+    with pytest.raises(TaskCancelled, match="disconnect"):
+        token.raise_if_cancelled()
+
+def test_child_token():
+    parent = CancellationToken()
+    child = parent.child()
+    child.cancel("speculation discarded")
+    assert not parent.cancelled
+    # 子令牌取消後不再留在父令牌的回調中
+    assert parent._callbacks == {}
+
+    other = parent.child()
+    parent.cancel("page_reload")
+    assert other.cancelled and other.reason == "page_reload"
+
+def test_sleep_is_interrupted():
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel, args=("disconnect",)).start()
+    before = _aborted("test.sleep")
+    start = time.perf_counter()
+    with pytest.raises(TaskCancelled):
+        token.sleep(30, stage="test.sleep")
+    assert time.perf_counter() - start < 5
+    assert _aborted("test.sleep") == before + 1
+    # 沒有取消時正常返回
+    CancellationToken().sleep(0)
+
+def test_run_cancellable_aborts_mid_call():
+    token = CancellationToken()
+    observed = []
+
+    async def slow_call():
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            observed.append("cancelled")
+            raise
+        return "done"
+
+    assert run_cancellable(CancellationToken(), asyncio.sleep(0, result="ok"), stage="test.call") == "ok"
+    threading.Timer(0.05, token.cancel, args=("disconnect",)).start()
+    before = _aborted("test.call")
+    start = time.perf_counter()
+    with pytest.raises(TaskCancelled):
+        run_cancellable(token, slow_call(), stage="test.call")
+    assert time.perf_counter() - start < 5
+    assert _aborted("test.call") == before + 1
+    for _ in range(100):
+        if observed:
+            break
+        time.sleep(0.01)
+    assert observed == ["cancelled"]
+
+def test_run_cancellable_skips_when_already_cancelled():
+    token = CancellationToken()
+    token.cancel()
+    started = []
+
+    async def call():
+        started.append(True)
+    with pytest.raises(TaskCancelled):
+        run_cancellable(token, call(), stage="test.call")
+    assert started == []
+
+def test_await_cancellable_aborts_from_another_thread():
+    async def main():
+        token = CancellationToken()
+        threading.Timer(0.05, token.cancel, args=("page_reload",)).start()
+        with pytest.raises(TaskCancelled, match="page_reload"):
+            await await_cancellable(token, asyncio.sleep(30), stage="test.async")
+        assert await await_cancellable(CancellationToken(), asyncio.sleep(0, result=1), stage="test.async") == 1
+
+        # 外層任務被取消（客戶端斷開）時照常拋出 CancelledError
+        outer = asyncio.ensure_future(await_cancellable(CancellationToken(), asyncio.sleep(30), stage="test.async"))
+        await asyncio.sleep(0.01)
+        outer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await outer
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+def test_stop_current_task_aborts_filter_stage(tmp_path, monkeypatch):
+    from agent_rag import CustomRAGAgentSystem
+    from cancellation import CANCELLATIONS
+    from vector_db import JSONVectorDB
+
+    monkeypatch.setattr("agent_rag.convert_to_traditional", lambda text: text)
+    system = CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+    system.filter_interval = 30
+    system._ollama_chat = lambda *args, **kwargs: "RELEVANT: 相符"
+    docs = [{"content": f"{name} 的內容", "metadata": {"source": name, "chunk_id": 0}, "distance": 0.2}
+            for name in ("a.txt", "b.txt")]
+    before = CANCELLATIONS._values.get((("trigger", "page_reload"),), 0)
+    threading.Timer(0.05, system.stop_current_task, args=("page_reload",)).start()
+    start = time.perf_counter()
+    with pytest.raises(TaskCancelled):
+        system.filter_documents("問題", docs)
+    assert time.perf_counter() - start < 5
+    system.stop_current_task("page_reload")
+    assert CANCELLATIONS._values[(("trigger", "page_reload"),)] == before + 1
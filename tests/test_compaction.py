@@ -0,0 +1,133 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+from vector_db import JSONVectorDB
+
+IDS = [f"chunk-{i}" for i in range(6)]
+DIM = 8
+
+@pytest.fixture
+def db(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    db.vectors = add_chunks(db, IDS, dim=DIM)
+    return db
+
+def _age(path, seconds=3600):
+    """把文件的修改時間往前調，模擬早已留下的文件"""
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+def _write_orphan(db, doc_id):
+    path = os.path.join(db.db_path, f"{doc_id}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"id": doc_id, "content": "孤立的片段"}, f)
+    return path
+
+def _embeddings(db, ids):
+    return np.array(db.get(ids=ids, include=["embeddings"])["embeddings"])
+
+def test_compact_reclaims_dead_rows(db):
+    db.delete(["chunk-1", "chunk-4"])
+    live = [doc_id for doc_id in IDS if doc_id not in ("chunk-1", "chunk-4")]
+    assert db.storage_stats() == {"rows": 6, "live_rows": 4, "dead_rows": 2}
+    old_path = db.embeddings.path
+
+    report = db.compact()
+    assert report["skipped"] is None
+    assert (report["rows_before"], report["rows_after"]) == (6, 4)
+    assert report["embedding_bytes_after"] == 4 * DIM * 4
+    assert report["bytes_pending"] == 6 * DIM * 4
+    assert db.storage_stats() == {"rows": 4, "live_rows": 4, "dead_rows": 0}
+    assert db.embeddings.path != old_path
+    np.testing.assert_array_equal(_embeddings(db, live), np.array([db.vectors[doc_id] for doc_id in live]))
+    assert db.search(db.vectors["chunk-5"], n_results=1)[0][0] == "chunk-5"
+
+    # 其他進程重新載入後使用新的嵌入文件
+    other = JSONVectorDB(db.db_path)
+    assert other.embeddings.path == db.embeddings.path
+    np.testing.assert_array_equal(_embeddings(other, live), _embeddings(db, live))
+
+    # 舊文件保留 min_age 秒後才刪除
+    assert os.path.exists(old_path)
+    report = db.compact(min_age=0)
+    assert report["stale_files"] == 1
+    assert not os.path.exists(old_path)
+
+def test_compact_removes_old_orphans_only(db):
+    old_orphan = _write_orphan(db, "orphan-old")
+    _age(old_orphan)
+    new_orphan = _write_orphan(db, "orphan-new")
+
+    report = db.compact()
+    assert report["orphan_files"] == 1
+    assert not os.path.exists(old_orphan)
+    assert os.path.exists(new_orphan)
+    assert db.storage_stats()["dead_rows"] == 0
+
+def test_compact_drops_missing_chunk_files(db):
+    os.remove(os.path.join(db.db_path, "chunk-2.json"))
+
+    report = db.compact()
+    assert report["missing_files"] == 1
+    assert "chunk-2" not in db.index["metadata"]
+    assert "chunk-2" not in db.index["embedding_rows"]
+    assert all(doc_id != "chunk-2" for doc_id, _ in db.search(db.vectors["chunk-2"], n_results=10))
+    assert db.storage_stats() == {"rows": 5, "live_rows": 5, "dead_rows": 0}
+
+def test_compact_truncates_partial_trailing_row(db):
+    with open(db.embeddings.path, 'ab') as f:
+        f.write(b"\x00" * 5)
+
+    report = db.compact()
+    assert report["partial_row_bytes"] == 5
+    assert report["rows_after"] == len(IDS)
+    assert os.path.getsize(db.embeddings.path) == len(IDS) * DIM * 4
+    np.testing.assert_array_equal(_embeddings(db, IDS), np.array([db.vectors[doc_id] for doc_id in IDS]))
+
+def test_compact_drops_invalid_embeddings(db):
+    row = db.index["embedding_rows"]["chunk-3"]
+    with open(db.embeddings.path, 'r+b') as f:
+        f.seek(row * DIM * 4)
+        f.write(np.full(DIM, np.nan, dtype=np.float32).tobytes())
+
+    report = db.compact()
+    assert report["invalid_embeddings"] == 1
+    assert "chunk-3" not in db.index["embedding_rows"]
+    assert db.read_document("chunk-3") is not None
+    # 移出索引的行成為作廢行，下一次壓縮時回收
+    assert db.storage_stats() == {"rows": 6, "live_rows": 5, "dead_rows": 1}
+    db.compact()
+    assert db.storage_stats() == {"rows": 5, "live_rows": 5, "dead_rows": 0}
+
+def test_dry_run_changes_nothing(db):
+    db.delete(["chunk-0"])
+    orphan = _write_orphan(db, "orphan")
+    _age(orphan)
+    with open(db.embeddings.path, 'ab') as f:
+        f.write(b"\x00" * 3)
+    with open(db.index_file, 'rb') as f:
+        index_before = f.read()
+    embeddings_before = os.path.getsize(db.embeddings.path)
+
+    report = db.compact(dry_run=True)
+    assert report["dry_run"]
+    assert report["orphan_files"] == 1
+    assert report["partial_row_bytes"] == 3
+    assert (report["rows_before"], report["rows_after"]) == (6, 5)
+    assert os.path.exists(orphan)
+    assert os.path.getsize(db.embeddings.path) == embeddings_before
+    with open(db.index_file, 'rb') as f:
+        assert f.read() == index_before
+
+def test_compact_without_reclaim_keeps_embedding_file(db):
+    db.delete(["chunk-0"])
+    path = db.embeddings.path
+
+    report = db.compact(reclaim_embeddings=False)
+    assert report["rows_after"] == report["rows_before"] == 6
+    assert db.embeddings.path == path
+    assert db.storage_stats()["dead_rows"] == 1
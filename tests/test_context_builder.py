@@ -0,0 +1,99 @@
+import pytest
+
+from context_builder import _strip_overlap, chunk_overlap, expanded_content, pack_context
+
+class CharCounter:
+    """每個字元算一個 token，測試不依賴分詞器"""
+
+    def count(self, text):
+        return len(text)
+
+    def truncate(self, text, max_tokens):
+        return text[:max(max_tokens, 0)]
+
+TEXT = ("第一段說明設備的安裝步驟與注意事項。" * 3 + "\n"
+        + "第二段記錄故障現象與量測到的電壓數值。" * 3 + "\n"
+        + "第三段是處理結果與後續追蹤的負責人。" * 3)
+OVERLAP = 40
+
+def _split(text, size, overlap):
+    """按固定長度切分，相鄰片段重疊 overlap 個字元（與分割器的 chunk_overlap 相同的效果）"""
+    chunks, start = [], 0
+    while start < len(text):
+        chunks.append(text[start:start + size])
+        if start + size >= len(text):
+            break
+        start += size - overlap
+    return chunks
+
+def _doc(content, chunk_id, filename="a.docx", distance=0.5, **metadata):
+    metadata = dict({"chunk_id": chunk_id, "original_filename": filename, "source": filename}, **metadata)
+    return {"content": content, "metadata": metadata, "distance": distance}
+
+@pytest.mark.parametrize("previous, current", [
+    ("The total is 5", "5 units shipped"),
+    ("abc.", ".def"),
+])
+def test_short_coincidental_match_is_kept(previous, current):
+    assert _strip_overlap(previous, current, 0) == current
+    assert _strip_overlap(previous, current, 100) == current
+
+def test_chunk_overlap_from_metadata():
+    assert chunk_overlap({"chunk_overlap": 100}) == 100
+    assert chunk_overlap({"chunk_overlap": 0, "file_type": "docx"}) == 0
+    # 舊資料沒有記錄 chunk_overlap 時按文件類型推斷
+    assert chunk_overlap({"file_type": "docx"}) == 100
+    assert chunk_overlap({"file_type": "excel"}) == 100
+    assert chunk_overlap({"file_type": "txt"}) == 0
+    assert chunk_overlap({"file_type": "txt", "chunking": "records"}) == 0
+
+def test_merge_with_overlap_restores_text():
+    chunks = _split(TEXT, 60, OVERLAP)
+    docs = [_doc(chunk, i, chunk_overlap=OVERLAP) for i, chunk in enumerate(chunks)]
+    blocks = pack_context(docs, counter=CharCounter())
+    assert len(blocks) == 1
+    assert blocks[0]["content"] == TEXT
+    assert blocks[0]["chunk_ids"] == list(range(len(chunks)))
+
+def test_merge_without_overlap_keeps_all_text():
+    chunks = ["本月總數為 5", "5 台已出貨。", ".def 檔案已上傳"]
+    docs = [_doc(chunk, i, filename="a.txt", file_type="txt", chunk_overlap=0) for i, chunk in enumerate(chunks)]
+    blocks = pack_context(docs, counter=CharCounter())
+    assert len(blocks) == 1
+    assert blocks[0]["content"] == "\n".join(chunks)
+
+def test_ordering_and_dedup():
+    docs = [
+        _doc("低相關的片段內容", 0, filename="b.txt", distance=0.9, chunk_overlap=0),
+        _doc("高相關的片段內容", 5, filename="a.txt", distance=0.1, chunk_overlap=0),
+        _doc("高相關的片段內容", 0, filename="c.txt", distance=0.3, chunk_overlap=0),
+        {**_doc("中相關", 8, filename="a.txt", chunk_overlap=0), "rerank_score": 0.6},
+    ]
+    blocks = pack_context(docs, counter=CharCounter())
+    assert [(block["filename"], block["chunk_ids"]) for block in blocks] == [
+        ("a.txt", [5]), ("a.txt", [8]), ("b.txt", [0])]
+    assert blocks[0]["relevance"] == pytest.approx(0.9)
+
+def test_budget_off_by_default_and_truncates_last_block():
+    docs = [_doc("甲" * 100, 0, filename="a.txt", distance=0.1, chunk_overlap=0),
+            _doc("乙" * 100, 0, filename="b.txt", distance=0.2, chunk_overlap=0),
+            _doc("丙" * 100, 0, filename="c.txt", distance=0.3, chunk_overlap=0)]
+    assert [block["tokens"] for block in pack_context(docs, counter=CharCounter())] == [100, 100, 100]
+
+    blocks = pack_context(docs, 180, counter=CharCounter())
+    assert [block["content"] for block in blocks] == ["甲" * 100, "乙" * 80]
+    # 剩餘預算不足 64 時不放入截斷的段落
+    blocks = pack_context(docs, 150, counter=CharCounter())
+    assert [block["content"] for block in blocks] == ["甲" * 100]
+
+def test_expanded_content_with_neighbors():
+    chunks = _split(TEXT, 60, OVERLAP)
+    hit = _doc(chunks[2], 2, chunk_overlap=OVERLAP)
+    hit["neighbors"] = [_doc(chunks[1], 1, chunk_overlap=OVERLAP), _doc(chunks[3], 3, chunk_overlap=OVERLAP)]
+    assert expanded_content(hit) == TEXT[20:120]
+
+    hit = _doc("總數為 5", 4, filename="a.txt", chunk_overlap=0)
+    hit["neighbors"] = [_doc("5 台已出貨", 5, filename="a.txt", chunk_overlap=0),
+                        _doc("另一筆紀錄", 7, filename="a.txt", chunk_overlap=0)]
+    assert expanded_content(hit) == "總數為 5\n5 台已出貨\n另一筆紀錄"
+    assert expanded_content(_doc("單獨", 0)) == "單獨"
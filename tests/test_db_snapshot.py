@@ -0,0 +1,115 @@
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+import pytest
+
+zstandard = pytest.importorskip("zstandard")
+
+from db_snapshot import create_snapshot, restore_snapshot, verify_snapshot
+from vector_db import JSONVectorDB
+
+IDS = ["a-1", "a-2", "a-3", "b-1", "b-2"]
+DATES = ["20230105", "20230120", "20230214", "20230301", "20230302"]
+
+@pytest.fixture
+def db(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    db.vectors = add_chunks(db, IDS, dates=DATES)
+    # 刪除後嵌入文件中留下作廢的行，快照不應包含
+    db.delete(["a-2"])
+    return db
+
+@pytest.fixture
+def archive(db, tmp_path):
+    path = str(tmp_path / "db.tar.zst")
+    create_snapshot(db, path)
+    return path
+
+def _rewrite_member(archive_path, name, transform):
+    """解開快照、以 transform 改寫一個成員（manifest 不變），再壓縮回原路徑"""
+    with open(archive_path, 'rb') as raw:
+        data = zstandard.ZstdDecompressor().stream_reader(raw).read()
+    output = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r') as source, \
+            tarfile.open(fileobj=output, mode='w') as target:
+        for member in source:
+            content = source.extractfile(member).read()
+            if member.name == name:
+                content = transform(content)
+                member.size = len(content)
+            target.addfile(member, io.BytesIO(content))
+    with open(archive_path, 'wb') as f:
+        f.write(zstandard.ZstdCompressor().compress(output.getvalue()))
+
+def test_create_verify_restore_round_trip(db, archive, tmp_path):
+    live = [doc_id for doc_id in IDS if doc_id != "a-2"]
+    manifest = verify_snapshot(archive)
+    assert manifest["chunks"] == len(live)
+    assert manifest["embeddings"] == len(live)
+    assert manifest["embedding_dim"] == 8
+    assert manifest["members"]["embeddings.f32"]["bytes"] == len(live) * 8 * 4
+
+    target = str(tmp_path / "restored")
+    stats = restore_snapshot(archive, target)
+    assert stats["chunks"] == len(live)
+    assert stats["previous_db"] is None
+
+    restored = JSONVectorDB(target)
+    assert restored.storage_stats() == {"rows": len(live), "live_rows": len(live), "dead_rows": 0}
+    before = db.get(ids=live, include=["ids", "documents", "metadatas", "embeddings"])
+    after = restored.get(ids=live, include=["ids", "documents", "metadatas", "embeddings"])
+    assert after["ids"] == before["ids"]
+    assert after["documents"] == before["documents"]
+    assert after["metadatas"] == before["metadatas"]
+    np.testing.assert_array_equal(np.array(after["embeddings"]), np.array(before["embeddings"]))
+    assert restored.read_document("a-2") is None
+    assert restored.search(db.vectors["b-1"], n_results=1)[0][0] == "b-1"
+
+def test_restore_keeps_previous_db(db, archive, tmp_path, add_chunks):
+    target = str(tmp_path / "restored")
+    add_chunks(JSONVectorDB(target), ["old-1"], seed=1)
+
+    stats = restore_snapshot(archive, target)
+    assert stats["previous_db"] and os.path.exists(os.path.join(stats["previous_db"], "old-1.json"))
+    assert JSONVectorDB(target).read_document("old-1") is None
+
+    stats = restore_snapshot(archive, target, keep_old=False)
+    assert stats["previous_db"] is None
+
+@pytest.mark.parametrize("name", ["chunks.jsonl", "embeddings.f32", "index.json"])
+def test_checksum_mismatch_is_rejected(db, archive, tmp_path, add_chunks, name):
+    def tamper(content):
+        if name == "index.json":
+            index = json.loads(content)
+            index["embedding_dim"] = 4
+            return json.dumps(index).encode('utf-8')
+        return content[:-1] + bytes([content[-1] ^ 0xFF])
+    _rewrite_member(archive, name, tamper)
+
+    with pytest.raises(ValueError, match=name):
+        verify_snapshot(archive)
+
+    target = str(tmp_path / "restored")
+    add_chunks(JSONVectorDB(target), ["old-1"], seed=1)
+    with pytest.raises(ValueError):
+        restore_snapshot(archive, target)
+    # 校驗失敗時目標目錄保持原樣，臨時目錄已清理
+    assert not os.path.exists(f"{target}.restoring")
+    assert JSONVectorDB(target).read_document("old-1") is not None
+    assert [path for path in os.listdir(tmp_path) if ".before-restore-" in path] == []
+
+def test_unsafe_chunk_id_is_rejected(db, archive, tmp_path):
+    def tamper(content):
+        lines = content.decode('utf-8').splitlines(keepends=True)
+        doc = json.loads(lines[0])
+        doc["id"] = "../escape"
+        lines[0] = json.dumps(doc, ensure_ascii=False) + "\n"
+        return "".join(lines).encode('utf-8')
+    _rewrite_member(archive, "chunks.jsonl", tamper)
+
+    with pytest.raises(ValueError):
+        restore_snapshot(archive, str(tmp_path / "restored"))
+    assert not os.path.exists(tmp_path / "escape.json")
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from agent_rag import CustomRAGAgentSystem
+from async_rag import AsyncRAGAgentSystem
+from cancellation import TaskCancelled
+from vector_db import JSONVectorDB
+
+def _doc(name):
+    return {"content": f"{name} 的內容", "metadata": {"source": f"/data/{name}", "original_filename": name, "chunk_id": 0},
+            "distance": 0.2}
+
+DOCS = [_doc("a.txt"), _doc("b.txt"), _doc("c.txt")]
+
+def _reply(prompt):
+    """a.txt 相關、b.txt 呼叫失敗、c.txt 不相關"""
+    if "a.txt" in prompt:
+        return "RELEVANT: 內容相符"
+    if "b.txt" in prompt:
+        raise ConnectionError("ollama 無法連線")
+    return "NOT_RELEVANT: 內容無關"
+
+@pytest.fixture
+def convert(monkeypatch):
+    monkeypatch.setattr("agent_rag.convert_to_traditional", lambda text: text)
+
+def _make(cls, tmp_path):
+    system = cls(collection=JSONVectorDB(str(tmp_path / "db")))
+    system.filter_interval = 0
+    system._build_filter_prompt = lambda query, doc: f"{query} / {doc['metadata']['original_filename']}"
+    return system
+
+def _check(relevant, interactions):
+    assert [doc["metadata"]["original_filename"] for doc in relevant] == ["a.txt", "b.txt"]
+    assert interactions["a.txt_0"]["is_relevant"] is True
+    assert "error" not in interactions["a.txt_0"]
+    # 呼叫失敗時默認為相關並記錄錯誤，不中斷整個查詢
+    assert interactions["b.txt_0"]["is_relevant"] is True
+    assert interactions["b.txt_0"]["error"] == "ollama 無法連線"
+    assert [m["role"] for m in interactions["b.txt_0"]["messages"]] == ["user"]
+    assert interactions["c.txt_0"]["is_relevant"] is False
+    assert relevant[0]["filter_interaction"] is interactions["a.txt_0"]
+
+def test_sync_filter_failure_marks_relevant(tmp_path, convert):
+    system = _make(CustomRAGAgentSystem, tmp_path)
+    system._ollama_chat = lambda system_message, prompt, stage, **kwargs: _reply(prompt)
+    _check(*system.filter_documents("問題", DOCS))
+
+def test_async_filter_failure_marks_relevant(tmp_path, convert):
+    system = _make(AsyncRAGAgentSystem, tmp_path)
+
+    async def chat(system_message, prompt, stage, model=None):
+        return _reply(prompt)
+    system._chat = chat
+    _check(*asyncio.run(system.afilter_documents("問題", DOCS)))
+
+def test_empty_reply_is_treated_as_failure(tmp_path, convert):
+    system = _make(CustomRAGAgentSystem, tmp_path)
+    system._ollama_chat = lambda system_message, prompt, stage, **kwargs: ""
+    relevant, interactions = system.filter_documents("問題", DOCS[:1])
+    assert relevant == DOCS[:1]
+    assert interactions["a.txt_0"]["error"] == "模型沒有返回內容"
+
+@pytest.mark.parametrize("cls", [CustomRAGAgentSystem, AsyncRAGAgentSystem])
+def test_cancellation_is_not_swallowed(tmp_path, convert, cls):
+    system = _make(cls, tmp_path)
+
+    def cancelled(*args, **kwargs):
+        raise TaskCancelled("disconnect")
+
+    async def acancelled(*args, **kwargs):
+        cancelled()
+    system._ollama_chat = cancelled
+    system._chat = acancelled
+    with pytest.raises(TaskCancelled):
+        if cls is AsyncRAGAgentSystem:
+            asyncio.run(system.afilter_documents("問題", DOCS))
+        else:
+            system.filter_documents("問題", DOCS)
+
+class CharCounter:
+    def count(self, text):
+        return len(text)
+
+def test_filter_prompts_share_prefix(tmp_path):
+    system = CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+    prompts = [system._build_filter_prompt("印表機卡紙", doc) for doc in DOCS]
+    prefix = prompts[0][:prompts[0].index("a.txt 的內容")]
+    assert prefix.startswith("用戶問題: 印表機卡紙")
+    # 只有結尾的文檔內容不同，Ollama 可重用前綴的 KV 快取
+    assert all(prompt.startswith(prefix) for prompt in prompts)
+    assert [prompt[len(prefix):].strip() for prompt in prompts] == [doc["content"] for doc in DOCS]
+
+def test_chat_options_are_stable(tmp_path, monkeypatch):
+    monkeypatch.setenv("TSD_OLLAMA_KEEP_ALIVE", "1h")
+    monkeypatch.setenv("TSD_OLLAMA_NUM_CTX", "8192")
+    system = CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+    assert system._chat_options() == {"options": {"temperature": 0.0, "num_ctx": 8192}, "keep_alive": "1h"}
+    assert system._chat_options() == system._chat_options()
+
+def test_prefill_stats(tmp_path, monkeypatch):
+    monkeypatch.setattr("agent_rag.get_token_counter", lambda: CharCounter())
+    system = CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+    system._record_prefill("系統" * 10, "問題" * 20, {"prompt_eval_count": 60})
+    # 命中前綴快取時 Ollama 只計算新的部分
+    system._record_prefill("系統" * 10, "問題" * 20, {"prompt_eval_count": 15})
+    stats = system._record_prefill("系統", "問題", {})
+    assert stats == {"calls": 3, "prompt_tokens": 124, "evaluated_tokens": 75, "avoided_tokens": 49}
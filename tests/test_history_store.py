@@ -0,0 +1,69 @@
+import json
+import os
+
+from history_store import HistoryStore
+
+def _record(history_id, task_id=None, answer="答案"):
+    return {
+        'id': history_id,
+        'timestamp': int(history_id.split('_')[0]),
+        'question': f"問題 {history_id}",
+        'date_range': '',
+        'steps': {'answer': answer},
+        'task_id': task_id or f"task-{history_id}",
+        'filter_interactions': {'doc_0': {'is_relevant': True}},
+    }
+
+def test_migrates_legacy_json_files(tmp_path):
+    legacy = _record('1700000000_a', task_id='t-legacy')
+    legacy['source'] = 'legacy'
+    with open(tmp_path / '1700000000_a.json', 'w', encoding='utf-8') as f:
+        json.dump(legacy, f, ensure_ascii=False)
+
+    store = HistoryStore(str(tmp_path))
+
+    assert not os.path.exists(tmp_path / '1700000000_a.json')
+    assert os.path.exists(tmp_path / 'json_backup' / '1700000000_a.json')
+    record = store.get('1700000000_a.json')
+    assert record['question'] == legacy['question']
+    assert record['steps'] == {'answer': '答案'}
+    assert record['source'] == 'legacy'
+    assert record['filter_interactions'] == legacy['filter_interactions']
+    assert store.get_filter_interactions('t-legacy') == legacy['filter_interactions']
+    # 再次初始化不會重複導入
+    assert HistoryStore(str(tmp_path)).migrate_json_files() == 0
+
+def test_cursor_pagination_newest_first(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    ids = [f"{1700000000 + i}_{i:02d}" for i in range(7)]
+    for history_id in ids:
+        store.save(_record(history_id))
+
+    pages = []
+    cursor = None
+    while True:
+        items, cursor = store.list(limit=3, cursor=cursor)
+        pages.append([item['id'] for item in items])
+        if cursor is None:
+            break
+
+    assert pages == [ids[6:3:-1], ids[3:0:-1], ids[0:1]]
+    assert store.list()[0][0]['filename'] == f"{ids[6]}.json"
+    # 游標可帶 .json 後綴（前端以文件名表示紀錄）
+    assert [item['id'] for item in store.list(limit=2, cursor=f"{ids[2]}.json")[0]] == [ids[1], ids[0]]
+
+def test_spilled_interactions_and_delete(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.save(_record('1700000000_a', task_id='saved'))
+
+    # 已有歷史紀錄的任務不重複保存
+    assert not store.spill_interactions('saved', json.dumps({'x': 1}))
+    assert store.spill_interactions('cancelled', json.dumps({'doc': {'is_relevant': False}}))
+    assert store.get_filter_interactions('cancelled') == {'doc': {'is_relevant': False}}
+    assert store.purge_spilled(3600) == 0
+    assert store.purge_spilled(-1) == 1
+    assert store.get_filter_interactions('cancelled') is None
+
+    assert store.delete(['1700000000_a.json']) == 1
+    assert store.get('1700000000_a') is None
+    assert store.get_filter_interactions('saved') is None
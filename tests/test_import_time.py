@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from check_import_time import run_importtime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.mark.parametrize("module", ["app", "asgi_app", "agent_rag", "batch_query"])
+def test_import_does_not_load_heavy_dependencies(module):
+    records, loaded_lazy = run_importtime(module)
+    assert records
+    assert loaded_lazy == []
+
+def test_import_does_not_build_rag_system():
+    # 向量庫在首次請求（或 start_server 預載）時才建立
+    code = "import app, asgi_app; print(app._rag_system is None)"
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=REPO_ROOT, check=True)
+    assert proc.stdout.split()[-1] == "True"
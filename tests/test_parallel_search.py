@@ -0,0 +1,103 @@
+import threading
+
+import numpy as np
+import pytest
+
+from vector_db import JSONVectorDB, batch_top_k, cosine_scores, parallel_map, top_k_indices
+
+DATES = [f"2023{month:02d}{day:02d}" for month in (1, 2, 3) for day in range(1, 21)]
+IDS = [f"chunk-{i}" for i in range(len(DATES))]
+DIM = 16
+
+@pytest.fixture
+def db(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    db.vectors = add_chunks(db, IDS, dates=DATES, dim=DIM)
+    return db
+
+def _queries(count, seed=1):
+    return np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+
+def _unit(queries):
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def _ids(hits):
+    return [doc_id for doc_id, _ in hits]
+
+def test_parallel_map_keeps_input_order():
+    threads = set()
+
+    def work(item):
+        threads.add(threading.current_thread().name)
+        return item * item
+
+    assert parallel_map(work, list(range(50)), threads=4) == [i * i for i in range(50)]
+    assert all(name.startswith("vector-search") for name in threads)
+    # 只有一項或單線程時直接在呼叫的線程中執行
+    assert parallel_map(lambda item: threading.current_thread().name, [0], threads=4) == [
+        threading.current_thread().name]
+    assert parallel_map(work, [1, 2, 3], threads=1) == [1, 4, 9]
+
+@pytest.mark.parametrize("block_size", [7, 8192])
+@pytest.mark.parametrize("rows", [range(5, 55), np.array([0, 3, 8, 13, 21, 34, 40, 41, 50, 59])])
+def test_batch_top_k_matches_single_query_scan(block_size, rows):
+    matrix = np.random.default_rng(0).random((60, DIM)).astype(np.float32)
+    queries = _unit(_queries(3))
+    positions, scores = batch_top_k(matrix, rows, queries, 5, block_size=block_size)
+    assert positions.shape == scores.shape == (3, 5)
+    for j, query in enumerate(queries):
+        expected = cosine_scores(matrix, rows, query)
+        top = top_k_indices(expected, 5)
+        np.testing.assert_array_equal(positions[j], top)
+        np.testing.assert_allclose(scores[j], expected[top], rtol=1e-5)
+
+def test_batch_top_k_with_k_larger_than_rows():
+    matrix = np.random.default_rng(0).random((4, DIM)).astype(np.float32)
+    positions, scores = batch_top_k(matrix, range(4), _unit(_queries(2)), 10, block_size=3)
+    assert positions.shape == (2, 4)
+    assert all(sorted(row) == [0, 1, 2, 3] for row in positions.tolist())
+    assert np.all(np.diff(scores, axis=1) <= 0)
+    assert batch_top_k(matrix, range(4), _unit(_queries(2)), 0)[0].shape == (2, 0)
+
+@pytest.mark.parametrize("preload", [False, True])
+@pytest.mark.parametrize("date_range", [None, (20230110, 20230315)])
+def test_parallel_search_matches_serial(db, preload, date_range):
+    if preload:
+        db.preload()
+    queries = _queries(5)
+    db.search_threads = 1
+    serial = [db.search(query, n_results=8, date_range=date_range) for query in queries]
+
+    # 每個分組按行切成多個工作單元，在線程池中並行評分後合併
+    db.search_threads, db.parallel_min_rows = 4, 5
+    assert len(db._work_units([(IDS, range(len(IDS)))])) == 4
+    for query, expected in zip(queries, serial):
+        hits = db.search(query, n_results=8, date_range=date_range)
+        assert _ids(hits) == _ids(expected)
+        np.testing.assert_allclose([s for _, s in hits], [s for _, s in expected], rtol=1e-5)
+
+@pytest.mark.parametrize("preload", [False, True])
+def test_search_batch_matches_per_query_search(db, preload):
+    if preload:
+        db.preload()
+    db.search_threads, db.parallel_min_rows = 4, 5
+    queries = _queries(6)
+    queries[2] = 0  # 零向量沒有結果，不影響其他問題
+    batch = db.search_batch(queries, n_results=5)
+    assert len(batch) == len(queries)
+    assert batch[2] == []
+    for i, query in enumerate(queries):
+        if i == 2:
+            continue
+        expected = db.search(query, n_results=5)
+        assert _ids(batch[i]) == _ids(expected)
+        np.testing.assert_allclose([s for _, s in batch[i]], [s for _, s in expected], rtol=1e-5)
+
+def test_search_batch_with_ids_and_date_range(db):
+    db.search_threads, db.parallel_min_rows = 4, 5
+    queries = _queries(3)
+    subset = IDS[::3]
+    batch = db.search_batch(queries, n_results=4, ids=subset, date_range=(20230201, 20230331))
+    for query, hits in zip(queries, batch):
+        assert _ids(hits) == _ids(db.search(query, n_results=4, ids=subset, date_range=(20230201, 20230331)))
+        assert all(doc_id in subset and IDS.index(doc_id) >= 20 for doc_id in _ids(hits))
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from vector_db import JSONVectorDB, quantize_embeddings
+
+N, DIM, K = 400, 32, 5
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    rng = np.random.default_rng(7)
+    vectors = rng.normal(size=(N, DIM)).astype(np.float32)
+    path = str(tmp_path_factory.mktemp("db"))
+    db = JSONVectorDB(path)
+    ids = [f"chunk-{i}" for i in range(N)]
+    db.add(ids, vectors.tolist(), [f"內容 {i}" for i in range(N)],
+           [{"source": "a.txt", "original_filename": "a.txt", "chunk_id": i} for i in range(N)])
+    queries = vectors[rng.choice(N, size=20, replace=False)] + 0.3 * rng.normal(size=(20, DIM)).astype(np.float32)
+    return path, queries
+
+def _exact(path, queries):
+    db = JSONVectorDB(path, quantization="float32")
+    return [db.search(query, K) for query in queries]
+
+@pytest.mark.parametrize("mode", ["float16", "int8"])
+def test_quantize_round_trip(mode):
+    vectors = np.random.default_rng(1).normal(size=(10, DIM)).astype(np.float32)
+    data, scales, norms = quantize_embeddings(vectors, mode)
+    assert data.dtype == np.dtype(mode)
+    restored = data.astype(np.float32) * scales[:, None]
+    tolerance = 1e-2 if mode == "float16" else np.abs(vectors).max(axis=1, keepdims=True) / 127
+    assert np.all(np.abs(restored - vectors) <= tolerance)
+    np.testing.assert_allclose(norms, np.linalg.norm(data.astype(np.float32), axis=1), rtol=1e-6)
+
+def test_zero_vector_int8():
+    data, scales, _ = quantize_embeddings(np.zeros((1, DIM), dtype=np.float32), "int8")
+    assert scales[0] == 1.0 and not data.any()
+
+@pytest.mark.parametrize("mode", ["float16", "int8"])
+def test_quantized_search_keeps_recall_and_exact_scores(corpus, mode):
+    path, queries = corpus
+    expected = _exact(path, queries)
+    db = JSONVectorDB(path, quantization=mode)
+    db.preload()
+    assert db._embedding_matrix.dtype == np.dtype(mode)
+
+    recalled = 0
+    for query, truth in zip(queries, expected):
+        hits = db.search(query, K)
+        recalled += len({doc_id for doc_id, _ in hits} & {doc_id for doc_id, _ in truth})
+        # 粗排後以磁碟上的 float32 向量精排：分數與精確搜索相同
+        exact_scores = dict(truth)
+        for doc_id, score in hits:
+            if doc_id in exact_scores:
+                assert score == pytest.approx(exact_scores[doc_id], abs=1e-5)
+    assert recalled / (len(queries) * K) >= 0.98
+
+@pytest.mark.parametrize("mode", ["float16", "int8"])
+def test_quantized_batch_search_matches_single(corpus, mode):
+    path, queries = corpus
+    db = JSONVectorDB(path, quantization=mode)
+    db.preload()
+    batch = db.search_batch(queries, K)
+    assert [[doc_id for doc_id, _ in hits] for hits in batch] == \
+        [[doc_id for doc_id, _ in db.search(query, K)] for query in queries]
+
+def test_unknown_mode_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        JSONVectorDB(str(tmp_path / "db"), quantization="int4")
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from agent_rag import CustomRAGAgentSystem
+from query_expansion import merge_variants, parse_llm_variants, rule_variants
+from vector_db import JSONVectorDB
+
+@pytest.mark.parametrize("query, expected", [
+    ("4x4-7840U 黑屏", ["4x4 7000系列 黑屏", "4x4-7840U no display", "4x4 7000系列 no display"]),
+    ("NUC MTL 網卡掉線", ["NUC 125 155 網卡掉線", "NUC MTL LAN link down", "NUC 125 155 LAN link down"]),
+    ("7000系列 無法開機", ["4x4-7XXX 無法開機", "7000系列 無法 boot", "4x4-7XXX 無法 boot"]),
+    # 英文術語按完整單詞替換
+    ("BSOD after reboot", ["藍屏 after 重啟"]),
+    ("印表機卡紙", ["印表機卡紙"]),
+])
+def test_rule_variants(query, expected):
+    assert rule_variants(query) == expected
+
+def test_parse_llm_variants():
+    text = "<think>先想一想</think>\n1. 4x4 7000系列 黑屏\n- NUC no display\n\n• " + "長" * 300 + "\n2、網卡掉線"
+    assert parse_llm_variants(text) == ["4x4 7000系列 黑屏", "NUC no display", "網卡掉線"]
+
+def test_merge_variants_dedups_and_limits():
+    assert merge_variants("黑屏", ["黑屏", " No Display ", "no display", "", "藍屏", "BSOD"], limit=2) == \
+        ["黑屏", "No Display", "藍屏"]
+    assert merge_variants("黑屏", [], limit=3) == ["黑屏"]
+
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    monkeypatch.setenv("TSD_QUERY_EXPANSION", "llm")
+    monkeypatch.setenv("TSD_QUERY_EXPANSION_MAX", "3")
+    return CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+
+def test_llm_variants_come_first(system):
+    system._ollama_chat = lambda *args, **kwargs: "4x4 7000系列 無畫面\n4x4-7840U 黑屏"
+    assert system.expand_query("4x4-7840U 黑屏") == [
+        "4x4-7840U 黑屏", "4x4 7000系列 無畫面", "4x4 7000系列 黑屏", "4x4-7840U no display"]
+
+def test_llm_failure_falls_back_to_rules(system):
+    def fail(*args, **kwargs):
+        raise ConnectionError("ollama 無法連線")
+    system._ollama_chat = fail
+    assert system.expand_query("BSOD after reboot") == ["BSOD after reboot", "藍屏 after 重啟"]
+    system.query_expansion = "none"
+    assert system.expand_query("BSOD after reboot") == ["BSOD after reboot"]
+
+def test_multi_query_search_takes_best_score_per_chunk(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    vectors = add_chunks(db, [f"chunk-{i}" for i in range(6)], dim=8, seed=3)
+    queries = np.array([vectors["chunk-1"], vectors["chunk-4"]])
+    merged = db.search(queries, n_results=6)
+    single = [dict(db.search(query, n_results=6)) for query in queries]
+    assert [doc_id for doc_id, _ in merged][:2] in (["chunk-1", "chunk-4"], ["chunk-4", "chunk-1"])
+    for doc_id, score in merged:
+        assert score == pytest.approx(max(hits[doc_id] for hits in single), abs=1e-6)
+    # 每個片段只出現一次
+    assert len({doc_id for doc_id, _ in merged}) == len(merged)
@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from admission import AdmissionController
+from agent_rag import CustomRAGAgentSystem
+from async_rag import AsyncRAGAgentSystem
+from vector_db import JSONVectorDB
+
+DOCS = [
+    {"content": f"{name} 的內容", "metadata": {"source": f"/data/{name}", "original_filename": name, "chunk_id": 0},
+     "distance": 0.2}
+    for name in ("a.txt", "b.txt")
+]
+
+class ScriptedRAGSystem(CustomRAGAgentSystem):
+    """搜索返回固定文檔、a.txt 相關；search_blocks 時搜索一直等到任務被取消"""
+    instances = []
+    search_blocks = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        ScriptedRAGSystem.instances.append(self)
+
+    def search_documents(self, query, n_results=6, date_range=''):
+        if self.search_blocks:
+            self.cancel_token.sleep(30, stage='search')
+        return [dict(doc) for doc in DOCS]
+
+    def _ollama_chat(self, system_message, prompt, stage, cancel_token=None, model=None):
+        if stage == 'generate.llm':
+            return "答案"
+        return "RELEVANT: 相符" if "a.txt 的內容" in prompt else "NOT_RELEVANT: 無關"
+
+class ScriptedAsyncRAGSystem(AsyncRAGAgentSystem):
+    async def asearch_documents(self, query, n_results=6, date_range=''):
+        return [dict(doc) for doc in DOCS]
+
+    async def _chat(self, system_message, prompt, stage, model=None):
+        return ScriptedRAGSystem._ollama_chat(self, system_message, prompt, stage)
+
+@pytest.fixture
+def flask_app(monkeypatch, tmp_path):
+    collection = JSONVectorDB(str(tmp_path / "db"))
+    ScriptedRAGSystem.instances = []
+    monkeypatch.setenv("TSD_FILTER_INTERVAL", "0")
+    monkeypatch.setattr(ScriptedRAGSystem, "search_blocks", False)
+    monkeypatch.setattr(app_module, "_rag_system", CustomRAGAgentSystem(collection=collection))
+    monkeypatch.setattr(app_module, "CustomRAGAgentSystem", ScriptedRAGSystem)
+    monkeypatch.setattr(app_module, "admission_controller", AdmissionController(max_concurrent=1))
+    monkeypatch.setattr(app_module, "SSE_HEARTBEAT_SECONDS", 0.05)
+    monkeypatch.setattr(app_module, "save_history", lambda *args: None)
+    monkeypatch.setattr("agent_rag.convert_to_traditional", lambda text: text)
+    return app_module
+
+def _events(body):
+    return [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+
+def _steps(events):
+    return [event["step"] for event in events]
+
+def _cancelled_count():
+    return app_module.QUERY_COUNT._values.get((("outcome", "cancelled"),), 0)
+
+def _assert_released(flask_app):
+    assert flask_app.admission_controller.stats()["active"] == 0
+    assert flask_app.admission_controller.stats()["queued"] == 0
+    assert flask_app.running_tasks_by_ip == {}
+
+EXPECTED_STEPS = ["task_id", "search", "filter_progress", "filter_thought", "filter_result",
+                  "filter_progress", "filter_thought", "filter_result", "filter", "answer"]
+
+def test_flask_stream_events(flask_app):
+    body = flask_app.app.test_client().get("/api/query/stream", query_string={"question": "問題"}).get_data(as_text=True)
+    events = _events(body)
+    assert _steps(events) == EXPECTED_STEPS
+    assert [e["result"]["is_relevant"] for e in events if e["step"] == "filter_result"] == [True, False]
+    assert events[-1]["answer"] == "答案"
+    _assert_released(flask_app)
+
+def test_asgi_stream_matches_flask(flask_app, monkeypatch):
+    pytest.importorskip("httpx")
+    asgi_app = pytest.importorskip("asgi_app")
+    from starlette.testclient import TestClient
+
+    monkeypatch.setattr(asgi_app, "create_task_rag_system",
+                        lambda: ScriptedAsyncRAGSystem(collection=flask_app._rag_system.collection))
+    monkeypatch.setattr(asgi_app, "save_history", lambda *args: None)
+    client = TestClient(asgi_app.app)
+    events = _events(client.get("/api/query/stream", params={"question": "問題"}).text)
+    assert _steps(events) == EXPECTED_STEPS
+    assert [e["result"]["is_relevant"] for e in events if e["step"] == "filter_result"] == [True, False]
+    _assert_released(flask_app)
+
+def test_flask_disconnect_mid_stream_cancels_task(flask_app, monkeypatch):
+    monkeypatch.setattr(ScriptedRAGSystem, "search_blocks", True)
+    before = _cancelled_count()
+    response = flask_app.app.test_client().get("/api/query/stream", query_string={"question": "問題"}, buffered=False)
+    chunks = iter(response.response)
+    assert "task_id" in next(chunks).decode()
+    # 搜索進行中只有心跳
+    assert next(chunks).decode().startswith(":")
+    response.close()
+
+    rag_system = ScriptedRAGSystem.instances[-1]
+    assert rag_system.cancel_token.reason == "disconnect"
+    assert _cancelled_count() == before + 1
+    _assert_released(flask_app)
+
+def test_flask_close_before_first_event_cancels_task(flask_app, monkeypatch):
+    monkeypatch.setattr(ScriptedRAGSystem, "search_blocks", True)
+    before = _cancelled_count()
+    response = flask_app.app.test_client().get("/api/query/stream", query_string={"question": "問題"}, buffered=False)
+    response.close()
+
+    rag_system = ScriptedRAGSystem.instances[-1]
+    assert rag_system.cancel_token.reason == "disconnect"
+    assert _cancelled_count() == before + 1
+    _assert_released(flask_app)
+
+def test_flask_error_cancels_speculation(flask_app, monkeypatch):
+    cancelled = []
+    monkeypatch.setattr("agent_rag.SpeculativeSynthesis.cancel", lambda self: cancelled.append(self))
+    monkeypatch.setenv("TSD_SPECULATIVE_SYNTHESIS", "1")
+
+    def fail(self, query, relevant_docs, cancel_token=None):
+        time.sleep(0.01)
+        raise RuntimeError("生成失敗")
+    monkeypatch.setattr(ScriptedRAGSystem, "generate_answer", fail)
+    body = flask_app.app.test_client().get("/api/query/stream", query_string={"question": "問題"}).get_data(as_text=True)
+    events = _events(body)
+    assert events[-1]["step"] == "error"
+    assert len(cancelled) == 1
+    assert cancelled[0].started == 1
+    _assert_released(flask_app)
+
+def _run(generator):
+    """執行 run_with_heartbeat 生成器，返回 (產出的事件, 返回值)"""
+    events = []
+    while True:
+        try:
+            events.append(next(generator))
+        except StopIteration as stop:
+            return events, stop.value
+
+def test_run_with_heartbeat_reuses_stage_threads(monkeypatch):
+    monkeypatch.setattr(app_module, "SSE_HEARTBEAT_SECONDS", 0.02)
+    threads = set()
+
+    def stage(value, delay=0.0):
+        threads.add(threading.current_thread().name)
+        time.sleep(delay)
+        return value * 2
+
+    events, result = _run(app_module.run_with_heartbeat(stage, 21, delay=0.1))
+    assert result == 42
+    assert events and all(event == app_module.format_heartbeat() for event in events)
+    for i in range(20):
+        assert _run(app_module.run_with_heartbeat(stage, i))[1] == i * 2
+    assert len(threads) <= app_module.STAGE_WORKERS
+    assert all(name.startswith("query-stage") for name in threads)
+
+def test_run_with_heartbeat_raises_stage_error():
+    def stage():
+        raise ValueError("失敗")
+
+    with pytest.raises(ValueError, match="失敗"):
+        _run(app_module.run_with_heartbeat(stage))
+
+def test_flask_stream_waits_in_queue(flask_app):
+    holder = flask_app.admission_controller.enqueue("10.0.0.9", "holder")
+    # 每等待 1 秒檢查一次排隊位置
+    threading.Timer(1.2, flask_app.admission_controller.release, args=(holder,)).start()
+    body = flask_app.app.test_client().get("/api/query/stream", query_string={"question": "問題"}).get_data(as_text=True)
+    events = _events(body)
+    assert _steps(events) == ["task_id", "queue", "queue"] + EXPECTED_STEPS[1:]
+    assert (events[1]["position"], events[1]["active"]) == (1, 1)
+    assert events[2]["position"] == 0
+    _assert_released(flask_app)
+
+def test_flask_stream_rejects_when_queue_full(flask_app, monkeypatch):
+    controller = AdmissionController(max_concurrent=1, max_queue_depth=1, default_task_seconds=30)
+    monkeypatch.setattr(flask_app, "admission_controller", controller)
+    controller.enqueue("10.0.0.8", "running")
+    controller.enqueue("10.0.0.9", "queued")
+    response = flask_app.app.test_client().get("/api/query/stream", query_string={"question": "問題"})
+    assert response.headers["Retry-After"] == "60"
+    events = _events(response.get_data(as_text=True))
+    assert _steps(events) == ["error"]
+    assert events[0]["retry_after"] == 60
+    assert flask_app.running_tasks_by_ip == {}
@@ -0,0 +1,49 @@
+import pytest
+
+import reranker
+from reranker import LexicalReranker, get_reranker, rerank
+
+def _doc(content, distance):
+    return {"content": content, "metadata": {"source": "a.txt"}, "distance": distance}
+
+DOCS = [
+    _doc("印表機卡紙，更換滾輪後恢復", 0.30),
+    _doc("伺服器 UPS 電壓過低告警，更換電池", 0.25),
+    _doc("UPS 電池老化導致電壓過低，已安排更換", 0.40),
+]
+
+def test_lexical_terms():
+    assert LexicalReranker._terms("UPS 電壓") == {"ups", "電壓"}
+    assert LexicalReranker._terms("電壓過低") == {"電壓", "壓過", "過低"}
+    assert LexicalReranker._terms("燈") == {"燈"}
+
+def test_lexical_ordering_blends_coverage_and_similarity():
+    scorer = LexicalReranker(lexical_weight=0.5)
+    ranked = rerank(scorer, "UPS 電壓過低", DOCS, top_n=3)
+    assert [doc["content"] for doc in ranked] == [DOCS[1]["content"], DOCS[2]["content"], DOCS[0]["content"]]
+    assert ranked[0]["rerank_score"] == pytest.approx(0.5 * 1.0 + 0.5 * 0.75)
+    assert "rerank_score" not in DOCS[0]
+
+    # 權重為 0 時只看向量相似度
+    ranked = rerank(LexicalReranker(lexical_weight=0.0), "UPS 電壓過低", DOCS, top_n=3)
+    assert [doc["distance"] for doc in ranked] == [0.25, 0.30, 0.40]
+
+def test_rerank_top_n_and_min_score():
+    scorer = LexicalReranker(lexical_weight=1.0)
+    ranked = rerank(scorer, "UPS 電壓過低", DOCS, top_n=1)
+    assert len(ranked) == 1
+    ranked = rerank(scorer, "印表機卡紙", DOCS, top_n=3, min_score=0.5)
+    assert [doc["content"] for doc in ranked] == [DOCS[0]["content"]]
+
+def test_without_reranker_keeps_vector_order():
+    assert rerank(None, "問題", DOCS, top_n=2) == DOCS[:2]
+    assert rerank(LexicalReranker(), "問題", [], top_n=2) == []
+
+@pytest.mark.parametrize("kind, expected", [("none", None), ("lexical", "lexical"), ("unknown", None)])
+def test_get_reranker_from_environment(monkeypatch, kind, expected):
+    monkeypatch.setattr(reranker, "_reranker", None)
+    monkeypatch.setattr(reranker, "_reranker_loaded", False)
+    monkeypatch.setenv("TSD_RERANKER", kind)
+    scorer = get_reranker()
+    assert (scorer.name if scorer else None) == expected
+    assert get_reranker() is scorer
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+from vector_db import JSONVectorDB, UNDATED_SHARD, shard_key, shard_overlap
+
+DATES = ["20230105", "20230120", "20230214", "20230301", "20230302"]
+IDS = ["jan-1", "jan-2", "feb-1", "mar-1", "mar-2"]
+
+@pytest.fixture
+def db(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    db.vectors = add_chunks(db, IDS, dates=DATES)
+    return db
+
+def test_shard_key():
+    assert shard_key("20230105") == "202301"
+    assert shard_key(None) == UNDATED_SHARD
+    assert shard_key("2023") == UNDATED_SHARD
+
+def test_shard_overlap():
+    assert shard_overlap("202302", 20230101, 20230131) == "none"
+    assert shard_overlap("202302", 20230215, 20230310) == "partial"
+    assert shard_overlap("202302", 20230201, 20230228) == "full"
+    assert shard_overlap("202402", 20240201, 20240228) == "partial"
+    assert shard_overlap("202404", 20240401, 20240430) == "full"
+    assert shard_overlap("202302", 20230101, 20231231) == "full"
+    assert shard_overlap(UNDATED_SHARD, 19000101, 29991231) == "none"
+
+def test_date_range_search_skips_other_shards(db, monkeypatch):
+    scanned = []
+    target_rows = db._target_rows
+    monkeypatch.setattr(db, "_target_rows", lambda key, ids: scanned.append(list(ids)) or target_rows(key, ids))
+    db.search(db.vectors["jan-1"], n_results=10, date_range=(20230101, 20230131))
+    # 只掃描一月分片，其他月份不參與評分
+    assert sorted(doc_id for ids in scanned for doc_id in ids) == ["jan-1", "jan-2"]
+
+def test_list_shards(db):
+    assert db.list_shards() == [
+        {"shard": "202301", "chunks": 2},
+        {"shard": "202302", "chunks": 1},
+        {"shard": "202303", "chunks": 2},
+    ]
+
+@pytest.mark.parametrize("preload", [False, True])
+def test_date_range_search_matches_brute_force(db, preload):
+    if preload:
+        db.preload()
+    query = db.vectors["feb-1"] + 0.01
+    hits = db.search(query, n_results=10, date_range=(20230115, 20230301))
+    assert {doc_id for doc_id, _ in hits} == {"jan-2", "feb-1", "mar-1"}
+    assert hits[0][0] == "feb-1"
+    assert len(db.search(query, n_results=10)) == len(IDS)
+
+def test_archive_restore_round_trip(db, tmp_path):
+    archive_root = str(tmp_path / "archive")
+    before = db.get(ids=["jan-1", "jan-2"], include=["ids", "documents", "metadatas", "embeddings"])
+
+    assert db.archive_shard("202301", archive_root) == 2
+    assert os.path.exists(os.path.join(archive_root, "202301", "index.json"))
+    assert "202301" not in [entry["shard"] for entry in db.list_shards()]
+    assert db.search(db.vectors["jan-1"], n_results=10, date_range=(20230101, 20230131)) == []
+    assert db.archive_shard(UNDATED_SHARD, archive_root) == 0
+
+    # 其他進程（例如運行中的服務）看到歸檔後的索引
+    other = JSONVectorDB(db.db_path)
+    assert "jan-1" not in other.index["metadata"]
+
+    assert db.restore_shard("202301", archive_root) == 2
+    assert not os.path.exists(os.path.join(archive_root, "202301"))
+    after = db.get(ids=["jan-1", "jan-2"], include=["ids", "documents", "metadatas", "embeddings"])
+    assert after["documents"] == before["documents"]
+    assert [m["timestamp"] for m in after["metadatas"]] == ["20230105", "20230120"]
+    np.testing.assert_array_equal(np.array(after["embeddings"]), np.array(before["embeddings"]))
+    assert db.search(db.vectors["jan-1"], n_results=1, date_range=(20230101, 20230131))[0][0] == "jan-1"
+
+def test_restore_missing_archive(db, tmp_path):
+    assert db.restore_shard("201901", str(tmp_path / "archive")) == 0
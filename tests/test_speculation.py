@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+from agent_rag import CustomRAGAgentSystem, SpeculativeSynthesis
+from cancellation import TaskCancelled
+from vector_db import JSONVectorDB
+
+def _doc(name, distance=0.2):
+    return {"content": f"{name} 的內容", "metadata": {"source": f"/data/{name}", "original_filename": name, "chunk_id": 0},
+            "distance": distance}
+
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    monkeypatch.setenv("TSD_FILTER_INTERVAL", "0")
+    monkeypatch.setattr("agent_rag.convert_to_traditional", lambda text: text)
+    return CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+
+def test_early_stop_reason(system):
+    doc = _doc("a.txt", distance=0.6)
+    assert system.early_stop_reason([doc] * 5, doc) is None
+    system.early_stop_relevant = 2
+    assert "已確認 2 個相關文檔" in system.early_stop_reason([doc, doc], doc)
+    assert system.early_stop_reason([doc], doc) is None
+    system.similarity_floor = 0.5
+    assert "低於 0.5" in system.early_stop_reason([], doc)
+    assert system.early_stop_reason([], _doc("b.txt", distance=0.4)) is None
+
+def test_filter_stops_after_enough_relevant(system):
+    prompts = []
+
+    def chat(system_message, prompt, stage, **kwargs):
+        prompts.append(prompt)
+        return "RELEVANT: 相符"
+    system._ollama_chat = chat
+    system.early_stop_relevant = 2
+    relevant, interactions = system.filter_documents("問題", [_doc("a.txt"), _doc("b.txt"), _doc("c.txt")])
+    assert len(relevant) == 2 and len(prompts) == 2
+    assert "c.txt_0" not in interactions
+
+def test_speculative_answer_used_when_set_unchanged(system):
+    calls = []
+
+    def generate(question, docs, cancel_token=None):
+        calls.append([doc["metadata"]["original_filename"] for doc in docs])
+        return "投機答案"
+    system.generate_answer = generate
+    docs = [_doc("a.txt")]
+    speculation = SpeculativeSynthesis(system, "問題")
+    speculation.maybe_start(docs)
+    # 集合沒有變化時不重複啟動
+    speculation.maybe_start(list(docs))
+    assert speculation.result(docs) == "投機答案"
+    assert (speculation.started, calls) == (1, [["a.txt"]])
+
+def test_speculation_discarded_when_set_changes(system):
+    started = threading.Event()
+    tokens = []
+
+    def generate(question, docs, cancel_token=None):
+        tokens.append(cancel_token)
+        started.set()
+        cancel_token.sleep(30, stage='generate')
+    system.generate_answer = generate
+    speculation = SpeculativeSynthesis(system, "問題")
+    speculation.maybe_start([_doc("a.txt")])
+    assert started.wait(5)
+    # 生成進行中不會以新的集合再啟動
+    speculation.maybe_start([_doc("a.txt"), _doc("b.txt")])
+    assert speculation.started == 1
+
+    assert speculation.result([_doc("a.txt"), _doc("b.txt")]) is None
+    assert tokens[0].reason == "speculation discarded"
+    # 只取消投機生成，任務本身不受影響
+    assert not system.cancel_token.cancelled
+    speculation._thread.join(5)
+
+def test_task_cancel_stops_speculation(system):
+    started = threading.Event()
+
+    def generate(question, docs, cancel_token=None):
+        started.set()
+        cancel_token.sleep(30, stage='generate')
+    system.generate_answer = generate
+    speculation = SpeculativeSynthesis(system, "問題")
+    speculation.maybe_start([_doc("a.txt")])
+    assert started.wait(5)
+    system.stop_current_task("disconnect")
+    speculation._thread.join(5)
+    assert not speculation._thread.is_alive()
+    with pytest.raises(TaskCancelled):
+        system.cancel_token.sleep(0)
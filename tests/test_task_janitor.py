@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+
+import app as app_module
+from history_store import HistoryStore
+from task_janitor import InteractionCache, Janitor
+
+def _interactions(doc, size=100):
+    return {doc: {"is_relevant": True, "response": "甲" * size}}
+
+def _size(interactions):
+    return len(json.dumps(interactions, ensure_ascii=False).encode("utf-8"))
+
+def test_byte_budget_evicts_least_recently_used():
+    spilled = []
+    budget = 2 * _size(_interactions("doc"))
+    cache = InteractionCache(max_bytes=budget, spill=lambda task_id, payload: spilled.append(task_id))
+    cache.put("t1", _interactions("doc"))
+    cache.put("t2", _interactions("doc"))
+    assert cache.get("t1") == _interactions("doc")  # t1 變為最近使用
+    cache.put("t3", _interactions("doc"))
+    assert spilled == ["t2"]
+    assert "t2" not in cache and "t1" in cache and "t3" in cache
+    assert cache.size() == {"entries": 2, "bytes": budget}
+    assert cache.stats["evicted_budget"] == 1
+
+    # 同一任務重寫時不重複計算大小
+    cache.put("t3", _interactions("doc"))
+    assert cache.size()["bytes"] == budget
+
+def test_ttl_expiry():
+    spilled = []
+    cache = InteractionCache(ttl_seconds=60, spill=lambda task_id, payload: spilled.append(json.loads(payload)))
+    cache.put("old", _interactions("a"))
+    cache.put("new", _interactions("b"))
+    cache._entries["old"] = cache._entries["old"][:2] + (cache._entries["old"][2] - 120,)
+    assert cache.expire() == 1
+    assert spilled == [_interactions("a")]
+    assert cache.get("old") is None and cache.get("new") == _interactions("b")
+    assert cache.stats["evicted_ttl"] == 1
+
+def test_spill_to_history_store(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    cache = InteractionCache(max_bytes=1, spill=store.spill_interactions)
+    cache.put("cancelled-task", _interactions("a.txt_0"))
+    assert cache.size()["entries"] == 0
+    assert cache.stats["spilled"] == 1
+    assert store.get_filter_interactions("cancelled-task") == _interactions("a.txt_0")
+
+def test_spill_errors_are_counted():
+    def fail(task_id, payload):
+        raise OSError("磁碟已滿")
+    cache = InteractionCache(max_bytes=1, spill=fail)
+    cache.put("t1", _interactions("a"))
+    assert cache.stats == {"evicted_ttl": 0, "evicted_budget": 1, "spilled": 0, "spill_errors": 1}
+
+def test_janitor_runs_all_jobs():
+    calls = []
+
+    def broken():
+        raise RuntimeError("失敗")
+    janitor = Janitor(0.01, [lambda: calls.append("a"), broken, lambda: calls.append("b")])
+    janitor.run_once()
+    assert calls == ["a", "b"] and janitor.runs == 1
+
+    ran = threading.Event()
+    janitor = Janitor(0.05, [ran.set])
+    before = [t.name for t in threading.enumerate()].count("task-janitor")
+    janitor.ensure_started()
+    janitor.ensure_started()
+    assert ran.wait(5)
+    # 同一進程只啟動一個線程
+    assert [t.name for t in threading.enumerate()].count("task-janitor") == before + 1
+
+def test_reap_stale_tasks(monkeypatch):
+    stopped = []
+
+    class Task:
+        def stop_current_task(self, reason):
+            stopped.append(reason)
+    monkeypatch.setattr(app_module, "running_tasks_by_ip", {
+        "10.0.0.1": {"old": {"start_time": 0, "rag_system": Task()}},
+        "10.0.0.2": {"new": {"start_time": time.time(), "rag_system": Task()}},
+    })
+    app_module.reap_stale_tasks()
+    assert stopped == ["expired"]
+    assert list(app_module.running_tasks_by_ip) == ["10.0.0.2"]
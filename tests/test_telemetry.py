@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from telemetry import MetricsRegistry, STAGE_LATENCY, span, traced
+
+def test_counter_and_histogram_render():
+    registry = MetricsRegistry()
+    counter = registry.counter("t_queries_total", "查詢次數")
+    counter.inc(outcome="answered")
+    counter.inc(2, outcome="answered")
+    counter.inc(outcome="error")
+    histogram = registry.histogram("t_latency_seconds", "延遲", buckets=(1, 0.1))
+    histogram.observe(0.05, stage="search")
+    histogram.observe(0.5, stage="search")
+    assert histogram.mean(stage="search") == pytest.approx(0.275)
+    assert histogram.mean(stage="filter") is None
+    # 同名指標只登錄一次
+    assert registry.counter("t_queries_total", "查詢次數") is counter
+
+    lines = registry.render().splitlines()
+    assert 't_queries_total{outcome="answered"} 3' in lines
+    assert 't_queries_total{outcome="error"} 1' in lines
+    assert 't_latency_seconds_bucket{stage="search",le="0.1"} 1' in lines
+    assert 't_latency_seconds_bucket{stage="search",le="1"} 2' in lines
+    assert 't_latency_seconds_bucket{stage="search",le="+Inf"} 2' in lines
+    assert 't_latency_seconds_count{stage="search"} 2' in lines
+
+def test_gauge_callback_and_failure():
+    registry = MetricsRegistry()
+    registry.gauge("t_active", "任務數", lambda: 3)
+    registry.gauge("t_cache", "快取", lambda: {(("kind", "hit"),): 5})
+    registry.gauge("t_broken", "讀取失敗", lambda: 1 / 0)
+    lines = registry.render().splitlines()
+    assert "t_active 3" in lines
+    assert 't_cache{kind="hit"} 5' in lines
+    assert "# TYPE t_broken gauge" in lines
+    assert not any(line.startswith("t_broken ") for line in lines)
+
+def test_span_records_latency_and_log():
+    log = []
+    before = STAGE_LATENCY._series.get((("stage", "test.span"),), [0])[-1]
+    with pytest.raises(ValueError):
+        with span("test.span", log=log, doc="a.txt_0"):
+            raise ValueError("失敗")
+    assert STAGE_LATENCY._series[(("stage", "test.span"),)][-1] == before + 1
+    assert log[0]["stage"] == "test.span" and log[0]["doc"] == "a.txt_0"
+    assert log[0]["seconds"] >= 0
+
+def test_traced_sync_and_async_methods():
+    class Pipeline:
+        def __init__(self):
+            self.span_log = []
+
+        @traced("test.sync")
+        def run(self, value):
+            return value + 1
+
+        @traced("test.async")
+        async def arun(self, value):
+            return value * 2
+
+    pipeline = Pipeline()
+    assert pipeline.run(1) == 2
+    assert asyncio.run(pipeline.arun(3)) == 6
+    assert [entry["stage"] for entry in pipeline.span_log] == ["test.sync", "test.async"]
+
+def test_metrics_endpoint():
+    import app as app_module
+
+    response = app_module.app.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    for name in ("tsd_stage_latency_seconds", "tsd_queries_total", "tsd_admission_active", "tsd_running_tasks"):
+        assert f"# TYPE {name} " in body
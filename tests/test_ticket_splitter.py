@@ -0,0 +1,98 @@
+from agent_rag import CustomRAGAgentSystem
+from ticket_splitter import iter_records, iter_ticket_chunks, split_record
+from vector_db import JSONVectorDB
+
+EXPORT = (
+    "工單匯出 2024 年第一季\n"
+    "編號與日期: (101) 20240105\n"
+    "印表機卡紙，已清除。\n"
+    "\n"
+    "編號與日期: (102) 20240212\n"
+    "網路斷線，重新設定交換器。\n"
+    "  編號與日期: (103) 20240301\n"
+    "系統藍屏，更新驅動程式"
+)
+
+def test_iter_records_splits_on_headers():
+    records = list(iter_records(EXPORT.splitlines(keepends=True)))
+    assert [(r["ticket_number"], r["ticket_date"]) for r in records] == [
+        (None, None), (101, "20240105"), (102, "20240212"), (103, "20240301")]
+    # 第一個紀錄之前的文字單獨成為一筆
+    assert records[0]["text"] == "工單匯出 2024 年第一季"
+    assert records[1]["text"] == "編號與日期: (101) 20240105\n印表機卡紙，已清除。"
+    assert records[3]["text"].endswith("系統藍屏，更新驅動程式")
+
+def test_iter_records_accepts_lines_without_newlines():
+    # PDF 頁面或 splitlines() 產出的行沒有換行符
+    with_newlines = list(iter_records(EXPORT.splitlines(keepends=True)))
+    assert list(iter_records(EXPORT.splitlines())) == with_newlines
+
+def test_iter_records_skips_blank_text():
+    assert list(iter_records(["\n", "   \n"])) == []
+    assert list(iter_records(["編號與日期: (7) 20240101"])) == [
+        {"text": "編號與日期: (7) 20240101", "ticket_number": 7, "ticket_date": "20240101"}]
+
+def test_split_record_by_lines_and_characters():
+    assert split_record("短紀錄", 10) == ["短紀錄"]
+    assert split_record("aaaa\nbbbb\ncccc", 10) == ["aaaa\nbbbb", "cccc"]
+    # 單行過長時先填滿當前部分，再按字元切開
+    parts = split_record("ab\n" + "x" * 25 + "\ncd", 10)
+    assert parts == ["ab\nxxxxxxx", "x" * 10, "x" * 8, "cd"]
+    assert all(len(part) <= 10 for part in parts)
+
+def test_ticket_chunks_prefix_continuation_header():
+    lines = ["編號與日期: (55) 20240610\n"] + [f"處理紀錄第 {i} 行\n" for i in range(20)]
+    chunks = list(iter_ticket_chunks(lines, max_chars=80))
+    header = "編號與日期: (55) 20240610（續）\n"
+    assert len(chunks) > 1
+    assert all(len(chunk["text"]) <= 80 for chunk in chunks)
+    assert [chunk["record_part"] for chunk in chunks] == list(range(len(chunks)))
+    assert {chunk["record_parts"] for chunk in chunks} == {len(chunks)}
+    assert {(chunk["ticket_number"], chunk["ticket_date"]) for chunk in chunks} == {(55, "20240610")}
+    assert chunks[0]["text"].startswith("編號與日期: (55) 20240610\n")
+    assert all(chunk["text"].startswith(header) for chunk in chunks[1:])
+    # 去掉續接行後按順序接回原來的紀錄
+    body = [chunks[0]["text"]] + [chunk["text"][len(header):] for chunk in chunks[1:]]
+    assert "\n".join(body) == "".join(lines).strip()
+
+def test_ticket_chunks_one_per_short_record():
+    chunks = list(iter_ticket_chunks(EXPORT.splitlines(keepends=True)))
+    assert [chunk["ticket_number"] for chunk in chunks] == [None, 101, 102, 103]
+    assert all((chunk["record_part"], chunk["record_parts"]) == (0, 1) for chunk in chunks)
+
+class FakeEmbed:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, model, input):
+        self.calls.append(len(input))
+        return {"embeddings": [[float(len(text)), 1.0, 0.0, 0.5] for text in input]}
+
+def test_records_chunking_ingestion(tmp_path, monkeypatch):
+    monkeypatch.setenv("TSD_CHUNKING", "records")
+    monkeypatch.setenv("TSD_RECORD_MAX_CHARS", "1500")
+    embed = FakeEmbed()
+    monkeypatch.setattr("agent_rag.ollama.embed", embed)
+    path = tmp_path / "tickets.txt"
+    path.write_text(EXPORT, encoding="utf-8")
+
+    db = JSONVectorDB(str(tmp_path / "db"))
+    system = CustomRAGAgentSystem(collection=db)
+    assert system.add_document(str(path), "txt")
+    assert sum(embed.calls) == 4
+
+    metadatas = db.get(include=["metadatas"])["metadatas"]
+    metadatas.sort(key=lambda metadata: metadata["chunk_id"])
+    assert all(m["chunking"] == "records" and m["chunk_overlap"] == 0 for m in metadatas)
+    assert [m.get("ticket_number") for m in metadatas] == [None, 101, 102, 103]
+    assert [m.get("ticket_date") for m in metadatas] == [None, "20240105", "20240212", "20240301"]
+    assert [m["has_timestamp_template"] for m in metadatas] == [False, True, True, True]
+    assert metadatas[1]["original_filename"] == "tickets.txt"
+
+def test_records_ingestion_rejects_empty_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("TSD_CHUNKING", "records")
+    monkeypatch.setattr("agent_rag.ollama.embed", FakeEmbed())
+    path = tmp_path / "empty.txt"
+    path.write_text("\n\n", encoding="utf-8")
+    system = CustomRAGAgentSystem(collection=JSONVectorDB(str(tmp_path / "db")))
+    assert system.add_document(str(path), "txt") is False
@@ -0,0 +1,167 @@
+import json
+
+import numpy as np
+import pytest
+
+from vector_db import JSONVectorDB
+
+IDS = [f"chunk-{i}" for i in range(5)]
+
+@pytest.fixture(params=[False, True], ids=["disk", "preloaded"])
+def db(request, tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    db.vectors = add_chunks(db, IDS)
+    if request.param:
+        db.preload()
+    return db
+
+@pytest.mark.parametrize("include", [
+    None,
+    ["ids"],
+    ["metadatas"],
+    ["documents"],
+    ["embeddings"],
+    ["ids", "embeddings"],
+    ["ids", "documents", "metadatas", "embeddings"],
+])
+def test_get_returns_only_requested_fields(db, include):
+    result = db.get(ids=["chunk-3", "missing", "chunk-1"], include=include)
+    expected = set(include or ["ids", "documents", "metadatas"])
+    assert set(result) == expected
+    if "ids" in expected:
+        assert result["ids"] == ["chunk-3", "chunk-1"]
+    if "documents" in expected:
+        assert result["documents"] == ["內容 chunk-3", "內容 chunk-1"]
+    if "metadatas" in expected:
+        assert [m["chunk_id"] for m in result["metadatas"]] == [3, 1]
+        assert all("timestamp" in m for m in result["metadatas"])
+    if "embeddings" in expected:
+        assert isinstance(result["embeddings"], np.ndarray)
+        np.testing.assert_array_equal(result["embeddings"], np.array([db.vectors["chunk-3"], db.vectors["chunk-1"]]))
+
+def test_get_where_and_paging(db):
+    assert db.get(include=["ids"])["ids"] == IDS
+    assert db.get(where={"chunk_id": {"$in": [0, 4]}}, include=["ids"])["ids"] == ["chunk-0", "chunk-4"]
+    assert db.get(include=["ids"], limit=2, offset=1)["ids"] == ["chunk-1", "chunk-2"]
+    assert db.get(include=["embeddings"], limit=2, offset=4)["embeddings"].shape == (1, 8)
+    assert db.get(ids=[], include=["embeddings"])["embeddings"].shape == (0, 8)
+
+def test_get_results_do_not_alias_index(db):
+    result = db.get(ids=["chunk-2"], include=["metadatas", "embeddings"])
+    result["metadatas"][0]["original_filename"] = "changed.txt"
+    result["metadatas"][0].pop("timestamp")
+    result["embeddings"][:] = 0
+
+    again = db.get(ids=["chunk-2"], include=["metadatas", "embeddings"])
+    assert again["metadatas"][0]["original_filename"] == "tickets.txt"
+    assert "timestamp" in again["metadatas"][0]
+    np.testing.assert_array_equal(again["embeddings"][0], db.vectors["chunk-2"])
+    assert db.find_file_ids(["tickets.txt"]) == IDS
+    assert db.search(db.vectors["chunk-2"], n_results=1)[0][0] == "chunk-2"
+
+def test_overwrite_moves_chunk_to_new_file(db):
+    vector = np.full(8, 0.5, dtype=np.float32)
+    db.add(["chunk-1"], [vector.tolist()], ["改寫後的內容"],
+           [{"source": "other.txt", "original_filename": "other.txt", "chunk_id": 7, "ticket_date": "20240301"}])
+
+    assert db.find_file_ids(["tickets.txt"]) == ["chunk-0", "chunk-2", "chunk-3", "chunk-4"]
+    assert db.find_file_ids(["other.txt"]) == ["chunk-1"]
+    chunks, total = db.get_file_chunks("tickets.txt")
+    assert total == 4
+    assert [chunk["id"] for chunk in chunks] == ["chunk-0", "chunk-2", "chunk-3", "chunk-4"]
+    chunks, total = db.get_file_chunks("other.txt")
+    assert (total, chunks[0]["content"], chunks[0]["metadata"]["chunk_id"]) == (1, "改寫後的內容", 7)
+    assert db.get_chunk("tickets.txt", 1) is None
+    assert db.neighbor_ids("chunk-2", 1) == ["chunk-0", "chunk-3"]
+    assert {entry["original_filename"]: entry["chunks"] for entry in db.list_files()} == {"tickets.txt": 4, "other.txt": 1}
+    assert {shard["shard"] for shard in db.list_shards()} >= {"202403"}
+    assert db.get(include=["ids"])["ids"] == IDS
+    np.testing.assert_array_equal(db.get(ids=["chunk-1"], include=["embeddings"])["embeddings"][0], vector)
+
+    # 其他進程重新載入索引後結果相同
+    other = JSONVectorDB(db.db_path)
+    assert other.find_file_ids(["tickets.txt"]) == ["chunk-0", "chunk-2", "chunk-3", "chunk-4"]
+    assert other.get_file_chunks("other.txt")[1] == 1
+    assert other.index["documents"][1]["original_filename"] == "other.txt"
+
+def test_overwrite_in_same_file_keeps_catalog(db):
+    db.add(["chunk-3"], [db.vectors["chunk-3"].tolist()], ["新內容"],
+           [{"source": "tickets.txt", "original_filename": "tickets.txt", "chunk_id": 3}])
+    assert sorted(db.find_file_ids(["tickets.txt"])) == IDS
+    chunks, total = db.get_file_chunks("tickets.txt")
+    assert total == len(IDS)
+    assert chunks[3]["content"] == "新內容"
+
+def test_file_catalog_add_and_delete(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    add_chunks(db, ["a-0", "a-1"], source="a.docx")
+    add_chunks(db, ["b-0"], source="b.txt")
+    assert [(entry["original_filename"], entry["chunks"]) for entry in db.list_files()] == [("a.docx", 2), ("b.txt", 1)]
+    assert db.find_file_ids(["/uploads/a.docx"]) == ["a-0", "a-1"]
+
+    db.delete(["a-0"])
+    assert db.find_file_ids(["a.docx"]) == ["a-1"]
+    db.delete(["a-1"])
+    assert [entry["original_filename"] for entry in db.list_files()] == ["b.txt"]
+    assert db.find_file_ids(["a.docx"]) == []
+
+def test_catalog_rebuilt_for_legacy_index(db):
+    with open(db.index_file, encoding="utf-8") as f:
+        index = json.load(f)
+    del index["files"]
+    with open(db.index_file, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    assert JSONVectorDB(db.db_path).find_file_ids(["tickets.txt"]) == IDS
+
+def test_chunk_lookup_uses_lru_cache(db):
+    db.cache_stats.update(chunk_cache_hits=0, chunk_cache_misses=0)
+    assert db.get_chunk("tickets.txt", 2)["content"] == "內容 chunk-2"
+    assert db.get_chunk("tickets.txt", 2)["metadata"]["chunk_id"] == 2
+    assert (db.cache_stats["chunk_cache_misses"], db.cache_stats["chunk_cache_hits"]) == (1, 1)
+    assert db.get_chunk("tickets.txt", 99) is None
+    assert db.get_chunk("missing.txt", 0) is None
+
+    # 同 id 重寫後不返回快取中的舊內容
+    db.add(["chunk-2"], [db.vectors["chunk-2"].tolist()], ["新內容"],
+           [{"source": "tickets.txt", "original_filename": "tickets.txt", "chunk_id": 2}])
+    assert db.get_chunk("tickets.txt", 2)["content"] == "新內容"
+
+    db.chunk_cache_size = 2
+    for chunk_id in range(5):
+        db.get_chunk("tickets.txt", chunk_id)
+    assert list(db._chunk_cache) == ["chunk-3", "chunk-4"]
+
+def test_file_chunks_paging(db):
+    chunks, total = db.get_file_chunks("tickets.txt", offset=1, limit=2)
+    assert total == len(IDS)
+    assert [chunk["metadata"]["chunk_id"] for chunk in chunks] == [1, 2]
+    chunks, total = db.get_file_chunks("tickets.txt", offset=4)
+    assert [chunk["id"] for chunk in chunks] == ["chunk-4"]
+    assert db.get_file_chunks("missing.txt") == ([], 0)
+
+def test_neighbors_follow_chunk_order(tmp_path, add_chunks):
+    db = JSONVectorDB(str(tmp_path / "db"))
+    add_chunks(db, ["a-0", "a-1", "a-2", "a-3"], source="a.txt")
+    add_chunks(db, ["b-0", "b-1"], source="b.txt")
+    assert db.neighbor_ids("a-1", 1) == ["a-0", "a-2"]
+    assert db.neighbor_ids("a-0", 2) == ["a-1", "a-2"]
+    assert db.neighbor_ids("b-1", 5) == ["b-0"]
+    assert db.neighbor_ids("a-1", 0) == [] and db.neighbor_ids("missing", 1) == []
+    neighbors = db.get_neighbors("a-2", 1, exclude={"a-3"})
+    assert [(chunk["id"], chunk["content"]) for chunk in neighbors] == [("a-1", "內容 a-1")]
+
+    # 刪除片段後順序索引隨之更新
+    db.delete(["a-2"])
+    assert db.neighbor_ids("a-1", 1) == ["a-0", "a-3"]
+
+def test_search_hits_get_neighbors(tmp_path, add_chunks, monkeypatch):
+    from agent_rag import CustomRAGAgentSystem
+
+    db = JSONVectorDB(str(tmp_path / "db"))
+    add_chunks(db, [f"a-{i}" for i in range(5)], source="a.txt")
+    monkeypatch.setenv("TSD_NEIGHBOR_CHUNKS", "1")
+    system = CustomRAGAgentSystem(collection=db)
+    results = system._fetch_hits([("a-1", 0.9), ("a-2", 0.8), ("a-4", 0.7)])
+    # 本身也是命中結果的片段不重複附加
+    assert {doc["id"]: [n["id"] for n in doc["neighbors"]] for doc in results} == {
+        "a-1": ["a-0"], "a-2": ["a-3"], "a-4": ["a-3"]}
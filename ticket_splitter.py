@@ -0,0 +1,69 @@
+import re
+from typing import Dict, Iterable, Iterator, List
+
+# 工單紀錄的開頭: 編號與日期: (編號) YYYYMMDD
+RECORD_HEADER = re.compile(r'^\s*編號與日期:\s*\((\d+)\)\s*(\d{8})')
+
+def iter_records(lines: Iterable[str]) -> Iterator[Dict]:
+    """逐行掃描文本，每遇到一個紀錄開頭就產出上一筆紀錄
+
+    產出 {'text', 'ticket_number', 'ticket_date'}；第一個紀錄之前的文字單獨成為一筆（編號與日期為 None）。
+    只保留當前紀錄的內容，可直接傳入文件對象串流處理大文件。
+    """
+    buffer = []
+    number = date = None
+    for line in lines:
+        match = RECORD_HEADER.match(line)
+        if match:
+            text = ''.join(buffer).strip()
+            if text:
+                yield {'text': text, 'ticket_number': number, 'ticket_date': date}
+            buffer = []
+            number, date = int(match.group(1)), match.group(2)
+        buffer.append(line if line.endswith('\n') else line + '\n')
+    text = ''.join(buffer).strip()
+    if text:
+        yield {'text': text, 'ticket_number': number, 'ticket_date': date}
+
+def split_record(text: str, max_chars: int) -> List[str]:
+    """把過長的紀錄按行切成不超過 max_chars 的部分，單行過長時按字元切開"""
+    if len(text) <= max_chars:
+        return [text]
+    parts = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        if len(current) + len(line) <= max_chars:
+            current += line
+        elif len(line) <= max_chars:
+            parts.append(current)
+            current = line
+        else:
+            # 單行過長：先填滿當前部分，其餘按 max_chars 切開
+            while len(current) + len(line) > max_chars:
+                room = max_chars - len(current)
+                parts.append(current + line[:room])
+                current, line = '', line[room:]
+            current = line
+    if current.strip():
+        parts.append(current)
+    return [part.strip() for part in parts if part.strip()]
+
+def iter_ticket_chunks(lines: Iterable[str], max_chars: int = 1500) -> Iterator[Dict]:
+    """每筆工單一個片段，超過 max_chars 時切成多個部分
+
+    產出 {'text', 'ticket_number', 'ticket_date', 'record_part', 'record_parts'}；
+    續接的部分開頭補上紀錄的編號與日期行，單獨閱讀時也能辨認屬於哪一筆工單。
+    """
+    for record in iter_records(lines):
+        header = ''
+        if record['ticket_number'] is not None:
+            header = f"編號與日期: ({record['ticket_number']}) {record['ticket_date']}（續）\n"
+        parts = split_record(record['text'], max_chars - len(header))
+        for i, part in enumerate(parts):
+            yield {
+                'text': part if i == 0 else header + part,
+                'ticket_number': record['ticket_number'],
+                'ticket_date': record['ticket_date'],
+                'record_part': i,
+                'record_parts': len(parts),
+            }
@@ -2,24 +2,346 @@
 import json
 import os
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import re
+import heapq
+import shutil
+import threading
+import time
+from bisect import bisect_left
+from calendar import monthrange
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import chain
+
+try:
+    import fcntl
+except ImportError:  # 沒有 fcntl 的平台（Windows）只在本進程內互斥
+    fcntl = None
+
+# 2: 嵌入向量存於 embeddings.f32，片段文件只保存內容與元數據
+STORAGE_VERSION = 2
+
+# 預設的嵌入文件名；壓縮後改用新的文件，文件名記錄在索引的 embeddings_file 中
+EMBEDDINGS_FILE = "embeddings.f32"
+
+# 寫入鎖文件：各進程修改索引前以文件鎖互斥，文件內容是最後一次寫入的標記，用於判斷本進程的索引是否過期
+WRITE_LOCK_FILE = "write.lock"
+
+# 記憶體中搜索矩陣的表示方式；磁碟上的 embeddings.f32 始終保留完整精度供精排使用
+QUANTIZATION_MODES = ("float32", "float16", "int8")
+
+# 沒有有效日期（YYYYMMDD）的片段歸入此分片，只在不限時間區間的搜索中出現
+UNDATED_SHARD = ""
+
+# 並行評分的線程數（numpy 矩陣乘法期間釋放 GIL）；候選超過 SEARCH_PARALLEL_ROWS 行時按行切分給各線程
+SEARCH_THREADS = max(1, int(os.environ.get("TSD_SEARCH_THREADS", min(8, os.cpu_count() or 1))))
+SEARCH_PARALLEL_ROWS = max(1, int(os.environ.get("TSD_SEARCH_PARALLEL_ROWS", 32768)))
+_search_pool = None
+_search_pool_size = 0
+_search_pool_pid = None
+_search_pool_lock = threading.Lock()
+
+def shard_key(timestamp) -> str:
+    """片段所屬的時間分片（按月，YYYYMM）"""
+    timestamp = str(timestamp or "")
+    if len(timestamp) == 8 and timestamp.isdigit():
+        return timestamp[:6]
+    return UNDATED_SHARD
+
+def shard_overlap(shard: str, start: int, end: int) -> str:
+    """分片與時間區間 [start, end]（YYYYMMDD）的關係: none（不重疊）、partial（部分重疊）或 full（整月在區間內）"""
+    if shard == UNDATED_SHARD:
+        return "none"
+    year, month = int(shard[:4]), int(shard[4:])
+    first, last = int(shard) * 100 + 1, int(shard) * 100 + monthrange(year, month)[1]
+    if last < start or first > end:
+        return "none"
+    return "full" if start <= first and last <= end else "partial"
+
+def parallel_map(func, items: List, threads: int = SEARCH_THREADS) -> List:
+    """在共享的搜索線程池中以最多 threads 個線程執行 func(item)，按輸入順序返回結果；只有一項時直接執行"""
+    global _search_pool, _search_pool_size, _search_pool_pid
+    if len(items) <= 1 or threads <= 1:
+        return [func(item) for item in items]
+    # gunicorn fork 後的 worker 不能沿用父進程的線程池；需要更多線程時換成較大的線程池
+    if _search_pool_pid != os.getpid() or _search_pool_size < threads:
+        with _search_pool_lock:
+            if _search_pool_pid != os.getpid() or _search_pool_size < threads:
+                old_pool = _search_pool if _search_pool_pid == os.getpid() else None
+                _search_pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="vector-search")
+                _search_pool_size, _search_pool_pid = threads, os.getpid()
+                if old_pool is not None:
+                    old_pool.shutdown(wait=False)
+    return list(_search_pool.map(func, items))
+
+def _take(array: np.ndarray, rows):
+    """取出 array 的指定行；rows 為 range 時以切片返回視圖，不複製"""
+    if isinstance(rows, range):
+        return array[rows.start:rows.stop]
+    return array[rows]
+
+def quantize_embeddings(vectors: np.ndarray, mode: str):
+    """將 float32 向量壓縮，返回 (壓縮矩陣, 每行縮放係數, 每行範數)
+    
+    int8 為逐向量對稱量化: v ≈ q * scale，scale = max|v| / 127。
+    範數按壓縮後的值計算，粗排時的餘弦相似度與縮放係數無關。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    if mode == "float16":
+        data = vectors.astype(np.float16)
+        scales = np.ones(len(vectors), dtype=np.float32)
+    elif mode == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0 if vectors.size else np.zeros(len(vectors), dtype=np.float32)
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        data = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    else:
+        data = vectors
+        scales = np.ones(len(vectors), dtype=np.float32)
+    norms = np.linalg.norm(data.astype(np.float32), axis=1) if len(data) else np.zeros(0, dtype=np.float32)
+    return data, scales, norms.astype(np.float32)
+
+def cosine_scores(matrix: np.ndarray, rows: np.ndarray, query: np.ndarray,
+                  norms: np.ndarray = None, block_size: int = 8192) -> np.ndarray:
+    """分塊計算 matrix[rows] 與單位化查詢向量的餘弦相似度
+    
+    每塊先轉為 float32 再做矩陣乘法，壓縮矩陣不會被整體展開。
+    rows 可為 range（連續的行，例如預載後的一個分片），此時直接切片讀取。
+    norms 為 None 時按塊即時計算範數（用於記憶體映射的磁碟矩陣）。
+    query 為 (m, dim) 的多個查詢向量時，每塊只做一次矩陣乘法，返回每行在各查詢中的最高相似度。
+    """
+    scores = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        block = np.asarray(_take(matrix, block_rows), dtype=np.float32)
+        block_norms = _take(norms, block_rows) if norms is not None else np.linalg.norm(block, axis=1)
+        if query.ndim == 2:
+            block_scores = (block @ query.T).max(axis=1)
+        else:
+            block_scores = block @ query
+        scores[start:start + len(block_rows)] = block_scores / np.maximum(block_norms, 1e-12)
+    return scores
+
+def batch_top_k(matrix: np.ndarray, rows: np.ndarray, queries: np.ndarray, k: int,
+                norms: np.ndarray = None, block_size: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+    """分塊計算 matrix[rows] 與多個單位化查詢向量（每行一個）的餘弦相似度，返回每個查詢的前 k 個
+    
+    每塊做一次矩陣–矩陣乘法，並與累積的前 k 個合併，不保存完整的 (查詢數 × 片段數) 分數矩陣。
+    返回 (positions, scores)，形狀皆為 (查詢數, k)，按分數降序；positions 是 rows 中的位置。
+    """
+    k = min(k, len(rows))
+    best_positions = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    if k <= 0:
+        return best_positions, best_scores
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        block = np.asarray(_take(matrix, block_rows), dtype=np.float32)
+        block_norms = _take(norms, block_rows) if norms is not None else np.linalg.norm(block, axis=1)
+        scores = (queries @ block.T) / np.maximum(block_norms, 1e-12)
+        if scores.shape[1] > k:
+            positions = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(scores, positions, axis=1)
+        else:
+            positions = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best_positions = np.concatenate([best_positions, positions + start], axis=1)
+        if best_scores.shape[1] > k:
+            keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+            best_positions = np.take_along_axis(best_positions, keep, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_positions, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """返回分數最高的 k 個位置（降序）"""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+class EmbeddingStore:
+    """以單一 float32 二進位文件保存嵌入向量
+    
+    每個向量佔一行（dim 個 float32），行號記錄在索引的 embedding_rows 中。
+    只追加寫入：重寫或刪除的片段留下的舊行由 JSONVectorDB.compact() 回收。
+    讀取時以記憶體映射存取，只讀入被選中的行。
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._mmap = None
+        self._mmap_key = None
+    
+    def row_count(self, dim: int) -> int:
+        if not dim or not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (dim * 4)
+    
+    def append(self, vectors: np.ndarray) -> List[int]:
+        """追加向量，返回各向量的行號
+        
+        文件末尾有寫入中斷留下的殘缺行時，先截斷到完整行的邊界，新向量從該處開始寫入，
+        否則之後所有行都會錯位。
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+        row_bytes = vectors.shape[1] * 4
+        with open(self.path, 'ab') as f:
+            size = f.seek(0, os.SEEK_END)
+            partial = size % row_bytes
+            if partial:
+                print(f"嵌入文件末尾有 {partial} 位元組的殘缺行，截斷後再追加: {self.path}")
+                size -= partial
+                f.truncate(size)
+            f.write(vectors.tobytes())
+        first = size // row_bytes
+        return list(range(first, first + len(vectors)))
+    
+    def matrix(self, dim: int) -> np.ndarray:
+        """整個嵌入文件的唯讀記憶體映射視圖 (rows, dim)"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return np.zeros((0, dim or 0), dtype=np.float32)
+        if not dim or stat.st_size < dim * 4:
+            return np.zeros((0, dim or 0), dtype=np.float32)
+        # 文件被追加或重建（其他進程寫入）時重新映射
+        key = (stat.st_ino, stat.st_size)
+        if self._mmap is None or self._mmap_key != key:
+            self._mmap = np.memmap(self.path, dtype=np.float32, mode='r',
+                                   shape=(stat.st_size // (dim * 4), dim))
+            self._mmap_key = key
+        return self._mmap
+    
+    def read_rows(self, rows: List[int], dim: int) -> np.ndarray:
+        """讀取指定行，返回 (len(rows), dim) 的陣列"""
+        if not rows:
+            return np.zeros((0, dim or 0), dtype=np.float32)
+        return np.asarray(self.matrix(dim)[rows], dtype=np.float32)
+    
+    def clear(self):
+        self._mmap = None
+        self._mmap_key = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 class JSONVectorDB:
-    def __init__(self, db_path: str = "./json_db"):
+    def __init__(self, db_path: str = "./json_db", quantization: str = None):
         self.db_path = db_path
         self.index_file = os.path.join(db_path, "index.json")
+        # 嵌入向量與片段內容分開存放，只需元數據或內容時不必讀入向量
+        self.embeddings = EmbeddingStore(os.path.join(db_path, EMBEDDINGS_FILE))
         
         # 創建資料庫目錄
         os.makedirs(db_path, exist_ok=True)
         
-        # 初始化或載入索引
+        # 保護索引與記憶體快取的鎖（實例可能被多個請求線程共享）
+        self._lock = threading.RLock()
+        # 寫入鎖：進程內同一時間只有一個線程等待文件鎖（可重入），見 _write_lock()
+        self._write_mutex = threading.RLock()
+        self._write_depth = 0
+        self._write_lock_file = None
+        
+        # 記憶體中搜索矩陣的精度（float32 / float16 / int8）
+        self.quantization = quantization or os.environ.get("TSD_EMBEDDING_QUANTIZATION", "float32")
+        if self.quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"不支援的量化模式: {self.quantization}，可選: {', '.join(QUANTIZATION_MODES)}")
+        # 壓縮模式下粗排保留 n_results * rerank_factor 個候選，再以 float32 精排
+        self.rerank_factor = 4
+        # 並行評分的線程數與每個工作單元的最少行數
+        self.search_threads = SEARCH_THREADS
+        self.parallel_min_rows = SEARCH_PARALLEL_ROWS
+        
+        # 記憶體快取，preload() 之後才啟用
+        self._cache_loaded = False
+        self._doc_cache = {}  # {doc_id: 不含 embedding 的文檔資料}
+        self._embedding_matrix = np.zeros((0, 0), dtype=np.float32)  # 按 quantization 壓縮
+        self._embedding_scales = np.zeros(0, dtype=np.float32)
+        self._embedding_norms = np.zeros(0, dtype=np.float32)
+        self._row_of = {}  # {doc_id: 嵌入矩陣中的行號}
+        
+        # 片段定位器 {original_filename: {chunk_id: doc_id}} 與熱門片段的 LRU 快取
+        self._chunk_locator = {}
+        # 文件內片段的順序 {original_filename: 排序後的 chunk_id 列表}，查詢相鄰片段時按需建立，文件變動時失效
+        self._chunk_order = {}
+        self._chunk_cache = OrderedDict()
+        self.chunk_cache_size = 256
+        
+        # 時間分片 {YYYYMM: {doc_id: None}}（由元數據中的時間戳重建），時間區間搜索只掃描重疊的分片
+        self._shards = {}
+        # 各分片（與全庫 "*"）對應的 (candidate_ids, 矩陣行)，索引或矩陣變動時清空
+        self._target_cache = {}
+        
+        # 快取命中統計（供 /metrics 使用）
+        self.cache_stats = {'chunk_cache_hits': 0, 'chunk_cache_misses': 0,
+                            'document_cache_hits': 0, 'document_disk_reads': 0}
+        
+        # 每次寫入遞增，背景壓縮據此判斷複製期間是否有寫入
+        self._write_generation = 0
+        self._compact_mutex = threading.Lock()
+        
+        # 初始化或載入索引（先讀取寫入標記：其間若有其他進程寫入，下次寫入時會重新載入）
+        self._write_stamp = self._read_write_stamp()
         self.index = self._load_index()
+        self._index_mtime = self._get_index_mtime()
+        self._sync_embedding_store()
+        self._rebuild_locator()
+        if self.index.get("storage_version", 1) < STORAGE_VERSION:
+            self._migrate_storage()
     
     def _load_index(self) -> Dict:
         """載入索引文件"""
+        index = self._read_index_file()
+        if "files" not in index:
+            index["files"] = self._build_catalog(index)
+        if not index["documents"]:
+            index.setdefault("storage_version", STORAGE_VERSION)
+        index.setdefault("embedding_rows", {})
+        # 時間戳放在元數據中，get(include=["metadatas"]) 可直接返回索引中的元數據
+        for doc_info in index["documents"]:
+            metadata = index["metadata"].get(doc_info["id"])
+            if metadata is not None and "timestamp" not in metadata:
+                metadata["timestamp"] = doc_info.get("timestamp")
+        return index
+    
+    def _sync_embedding_store(self):
+        """按索引中記錄的文件名切換嵌入文件（其他進程壓縮後索引指向新的文件）"""
+        path = os.path.join(self.db_path, self.index.get("embeddings_file", EMBEDDINGS_FILE))
+        if self.embeddings.path != path:
+            self.embeddings = EmbeddingStore(path)
+    
+    def _migrate_storage(self):
+        """將舊版片段文件中的 embedding 移到嵌入文件（一次性遷移）"""
+        with self._write_lock():
+            if self.index.get("storage_version", 1) >= STORAGE_VERSION:
+                return
+            print("正在將嵌入向量遷移到獨立的嵌入文件...")
+            migrated = 0
+            for doc_info in self.index["documents"]:
+                doc_id = doc_info["id"]
+                doc = self._read_document_file(doc_id)
+                if not doc or "embedding" not in doc:
+                    continue
+                embedding = doc.pop("embedding")
+                dim = self.index.setdefault("embedding_dim", len(embedding))
+                if len(embedding) == dim:
+                    self.index["embedding_rows"][doc_id] = self.embeddings.append(np.array([embedding]))[0]
+                    migrated += 1
+                else:
+                    print(f"向量維度不匹配，跳過嵌入: {doc_id} ({len(embedding)} != {dim})")
+                self._write_document_file(doc)
+            self.index["storage_version"] = STORAGE_VERSION
+            self._save_index()
+            print(f"已遷移 {migrated} 個嵌入向量")
+    
+    def _read_index_file(self) -> Dict:
+        """讀取索引文件"""
         if os.path.exists(self.index_file):
             try:
                 with open(self.index_file, 'r', encoding='utf-8') as f:
@@ -51,6 +373,9 @@ class JSONVectorDB:
             
             # 原子性替換
             os.replace(temp_file, self.index_file)
+            self._index_mtime = self._get_index_mtime()
+            self._target_cache = {}
+            self._stamp_write()
             
         except Exception as e:
             print(f"保存索引文件失敗: {e}")
@@ -58,6 +383,365 @@ class JSONVectorDB:
                 os.remove(temp_file)
             raise
     
+    def _build_catalog(self, index: Dict) -> Dict:
+        """由索引中的元數據重建文件目錄（舊版索引沒有 files 欄位）"""
+        files = {}
+        for doc_info in index.get("documents", []):
+            metadata = index.get("metadata", {}).get(doc_info["id"])
+            if metadata is not None:
+                self._catalog_add(files, doc_info["id"], metadata)
+        return files
+    
+    @staticmethod
+    def _catalog_add(files: Dict, doc_id: str, metadata: Dict):
+        """將一個片段登記到文件目錄: source -> 片段 id、類型與額外資訊"""
+        source = str(metadata.get("source", "unknown"))
+        file_type = metadata.get("file_type", "unknown")
+        entry = files.get(source)
+        if entry is None:
+            entry = files[source] = {
+                "source": source,
+                "original_filename": metadata.get("original_filename"),
+                "type": file_type,
+                "ids": [],
+                "extra_info": {}
+            }
+        entry["ids"].append(doc_id)
+        
+        if file_type == "docx":
+            entry["extra_info"]["paragraphs"] = metadata.get("paragraphs_count", 0)
+            entry["extra_info"]["tables"] = metadata.get("tables_count", 0)
+        elif file_type == "excel":
+            entry["extra_info"]["sheets"] = metadata.get("sheets_count", 0)
+            entry["extra_info"]["sheet_names"] = metadata.get("sheet_names", [])
+    
+    def _catalog_remove(self, ids: set):
+        """從文件目錄中移除片段，只處理這些片段所屬的文件"""
+        files = self.index["files"]
+        affected_sources = set()
+        for doc_id in ids:
+            metadata = self.index["metadata"].get(doc_id)
+            if metadata is not None:
+                affected_sources.add(str(metadata.get("source", "unknown")))
+        for source in affected_sources:
+            entry = files.get(source)
+            if entry is None:
+                continue
+            entry["ids"] = [doc_id for doc_id in entry["ids"] if doc_id not in ids]
+            if not entry["ids"]:
+                del files[source]
+    
+    def _rebuild_locator(self):
+        """由索引元數據重建片段定位器與時間分片"""
+        locator = {}
+        shards = {}
+        for doc_id, metadata in self.index.get("metadata", {}).items():
+            name = metadata.get("original_filename")
+            locator.setdefault(name, {})[metadata.get("chunk_id", 0)] = doc_id
+            shards.setdefault(shard_key(metadata.get("timestamp")), {})[doc_id] = None
+        self._chunk_locator = locator
+        self._chunk_order = {}
+        self._chunk_cache.clear()
+        self._shards = shards
+        self._target_cache = {}
+    
+    def _locator_remove(self, ids: set):
+        """從片段定位器與 LRU 快取中移除片段"""
+        for doc_id in ids:
+            self._chunk_cache.pop(doc_id, None)
+            metadata = self.index["metadata"].get(doc_id)
+            if metadata is None:
+                continue
+            self._shard_discard(doc_id, metadata.get("timestamp"))
+            self._chunk_order.pop(metadata.get("original_filename"), None)
+            chunks = self._chunk_locator.get(metadata.get("original_filename"))
+            if chunks is not None and chunks.get(metadata.get("chunk_id", 0)) == doc_id:
+                del chunks[metadata.get("chunk_id", 0)]
+                if not chunks:
+                    del self._chunk_locator[metadata.get("original_filename")]
+    
+    def _shard_discard(self, doc_id: str, timestamp):
+        shard = self._shards.get(shard_key(timestamp))
+        if shard is not None:
+            shard.pop(doc_id, None)
+            if not shard:
+                del self._shards[shard_key(timestamp)]
+    
+    def _get_chunk_by_id(self, doc_id: str) -> Dict:
+        """經由 LRU 快取讀取單個片段的內容與元數據"""
+        with self._lock:
+            chunk = self._chunk_cache.get(doc_id)
+            if chunk is not None:
+                self.cache_stats['chunk_cache_hits'] += 1
+                self._chunk_cache.move_to_end(doc_id)
+                return chunk
+            self.cache_stats['chunk_cache_misses'] += 1
+        doc = self._get_document(doc_id)
+        if doc is None:
+            return None
+        metadata = dict(doc["metadata"])
+        metadata["timestamp"] = doc.get("timestamp")
+        chunk = {"id": doc["id"], "content": doc["content"], "metadata": metadata}
+        with self._lock:
+            self._chunk_cache[doc_id] = chunk
+            while len(self._chunk_cache) > self.chunk_cache_size:
+                self._chunk_cache.popitem(last=False)
+        return chunk
+    
+    def get_chunk(self, original_filename: str, chunk_id: int) -> Dict:
+        """按 (原始文件名, chunk_id) 直接讀取單個片段，找不到時返回 None"""
+        self._refresh_if_stale()
+        doc_id = self._chunk_locator.get(original_filename, {}).get(chunk_id)
+        if doc_id is None:
+            return None
+        return self._get_chunk_by_id(doc_id)
+    
+    def neighbor_ids(self, doc_id: str, radius: int) -> List[str]:
+        """同一文件中按 chunk_id 順序位於 doc_id 前後各 radius 個片段的 id（按順序，不含 doc_id 本身）"""
+        if radius <= 0:
+            return []
+        self._refresh_if_stale()
+        with self._lock:
+            metadata = self.index["metadata"].get(doc_id)
+            if metadata is None:
+                return []
+            name = metadata.get("original_filename")
+            chunk_id = metadata.get("chunk_id", 0)
+            chunks = self._chunk_locator.get(name)
+            if not chunks:
+                return []
+            order = self._chunk_order.get(name)
+            if order is None:
+                order = self._chunk_order[name] = sorted(chunks)
+            position = bisect_left(order, chunk_id)
+            if position >= len(order) or order[position] != chunk_id:
+                return []
+            window = order[max(position - radius, 0):position] + order[position + 1:position + 1 + radius]
+            return [chunks[c] for c in window]
+    
+    def get_neighbors(self, doc_id: str, radius: int, exclude: set = None) -> List[Dict]:
+        """讀取 doc_id 前後各 radius 個相鄰片段（經由 LRU 快取），略過 exclude 中的片段"""
+        neighbors = []
+        for neighbor_id in self.neighbor_ids(doc_id, radius):
+            if exclude and neighbor_id in exclude:
+                continue
+            chunk = self._get_chunk_by_id(neighbor_id)
+            if chunk is not None:
+                neighbors.append(chunk)
+        return neighbors
+    
+    def get_file_chunks(self, original_filename: str, offset: int = 0, limit: int = None):
+        """按 chunk_id 順序分頁讀取文件的片段，返回 (片段列表, 總片段數)"""
+        self._refresh_if_stale()
+        chunks = self._chunk_locator.get(original_filename, {})
+        chunk_ids = sorted(chunks)
+        selected = chunk_ids[offset:offset + limit] if limit is not None else chunk_ids[offset:]
+        result = []
+        for chunk_id in selected:
+            chunk = self._get_chunk_by_id(chunks[chunk_id])
+            if chunk is not None:
+                result.append(chunk)
+        return result, len(chunk_ids)
+    
+    def list_files(self) -> List[Dict]:
+        """列出所有文件（每個文件一筆，含片段數與額外資訊），不讀取任何片段文件"""
+        self._refresh_if_stale()
+        with self._lock:
+            return [
+                {
+                    "chunks": len(entry["ids"]),
+                    "type": entry["type"],
+                    "path": entry["source"],
+                    "display_name": entry["original_filename"] or os.path.basename(entry["source"]),
+                    "original_filename": entry["original_filename"],
+                    "extra_info": dict(entry["extra_info"])
+                }
+                for entry in self.index["files"].values()
+            ]
+    
+    def find_file_ids(self, filenames: List[str]) -> List[str]:
+        """按文件名（原始文件名、存儲路徑或其 basename）查找文件的所有片段 id"""
+        self._refresh_if_stale()
+        wanted = set(filenames)
+        wanted_basenames = {os.path.basename(f) for f in filenames}
+        ids = []
+        with self._lock:
+            for source, entry in self.index["files"].items():
+                source_basename = os.path.basename(source)
+                if (source_basename in wanted_basenames or
+                        entry["original_filename"] in wanted or
+                        source_basename in wanted):
+                    ids.extend(entry["ids"])
+        return ids
+    
+    def _get_index_mtime(self):
+        """獲取索引文件的修改時間，用於偵測其他進程的寫入"""
+        try:
+            return os.path.getmtime(self.index_file)
+        except OSError:
+            return None
+    
+    def _read_write_stamp(self) -> str:
+        try:
+            with open(os.path.join(self.db_path, WRITE_LOCK_FILE), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return ""
+    
+    def _stamp_write(self):
+        """在寫入鎖文件中記錄本次寫入的標記（持有寫入鎖時）"""
+        if self._write_lock_file is None:
+            return
+        self._write_stamp = f"{os.getpid()}-{time.time_ns()}-{self._write_generation}"
+        self._write_lock_file.seek(0)
+        self._write_lock_file.truncate()
+        self._write_lock_file.write(self._write_stamp)
+        self._write_lock_file.flush()
+    
+    @contextmanager
+    def _write_lock(self):
+        """修改索引時持有的寫入鎖
+        
+        跨進程以 write.lock 的文件鎖互斥（gunicorn 多 worker、服務運行中執行的 shard_tool / compact_db），
+        取得後若其他進程在本進程上次寫入後修改過索引，先重新載入，修改與保存都基於最新的索引。
+        以索引文件的修改時間判斷不夠可靠（同一時鐘刻度內的兩次寫入修改時間相同），改用鎖文件中的寫入標記。
+        可重入：同一線程在持有鎖時再次取得不會重複加鎖。
+        """
+        with self._write_mutex:
+            lock_file = None
+            if self._write_depth == 0:
+                lock_file = open(os.path.join(self.db_path, WRITE_LOCK_FILE), 'a+', encoding='utf-8')
+                try:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    lock_file.seek(0)
+                    stamp = lock_file.read()
+                except BaseException:
+                    lock_file.close()
+                    raise
+            self._write_depth += 1
+            try:
+                with self._lock:
+                    if lock_file is not None:
+                        self._write_lock_file = lock_file
+                        if stamp != self._write_stamp:
+                            self._index_mtime = None
+                        self._refresh_if_stale()
+                        self._write_stamp = stamp
+                    yield
+            finally:
+                self._write_depth -= 1
+                if lock_file is not None:
+                    self._write_lock_file = None
+                    lock_file.close()
+    
+    def _refresh_if_stale(self):
+        """索引文件被其他進程修改時，重新載入索引（以及已啟用的記憶體快取）"""
+        mtime = self._get_index_mtime()
+        if mtime == self._index_mtime:
+            return
+        with self._lock:
+            if mtime == self._index_mtime:
+                return
+            print("偵測到索引文件已被更新，重新載入索引")
+            self._write_stamp = self._read_write_stamp()
+            self.index = self._load_index()
+            self._index_mtime = mtime
+            self._sync_embedding_store()
+            self._rebuild_locator()
+            if self._cache_loaded:
+                self.preload()
+    
+    def preload(self):
+        """將所有文檔片段與嵌入矩陣載入記憶體
+        
+        多 worker 部署時應在 fork 之前呼叫：嵌入矩陣保存為單一 numpy 陣列，
+        各 worker 透過寫時複製共享同一份記憶體頁。
+        矩陣按時間分片排列，每個分片佔連續的行，掃描分片時直接切片而不必複製。
+        """
+        with self._lock:
+            doc_cache = {}
+            row_of = {}
+            store_rows = []
+            embedding_rows = self.index["embedding_rows"]
+            metadata = self.index["metadata"]
+            ordered = sorted(self.index["documents"],
+                             key=lambda doc_info: shard_key(metadata.get(doc_info["id"], {}).get("timestamp")))
+            for doc_info in ordered:
+                doc = self._read_document_file(doc_info["id"])
+                if not doc:
+                    continue
+                doc.pop("embedding", None)
+                doc_cache[doc["id"]] = doc
+                if doc["id"] in embedding_rows:
+                    row_of[doc["id"]] = len(store_rows)
+                    store_rows.append(embedding_rows[doc["id"]])
+            
+            # 按索引順序讀入一份緊湊的記憶體矩陣（不含已作廢的舊行），並按設定壓縮
+            matrix = self.embeddings.read_rows(store_rows, self.index.get("embedding_dim"))
+            matrix, scales, norms = quantize_embeddings(matrix, self.quantization)
+            
+            self._doc_cache = doc_cache
+            self._row_of = row_of
+            self._embedding_matrix = matrix
+            self._embedding_scales = scales
+            self._embedding_norms = norms
+            self._target_cache = {}
+            self._cache_loaded = True
+        print(f"已載入 {len(doc_cache)} 個文檔片段到記憶體，嵌入矩陣形狀: {matrix.shape} "
+              f"({self.quantization}, {matrix.nbytes / 1024 / 1024:.1f} MB)")
+    
+    def is_loaded(self) -> bool:
+        """記憶體快取（含嵌入矩陣）是否已載入完成"""
+        return self._cache_loaded
+    
+    def _cache_put(self, docs: List[Dict]):
+        """將新寫入的文檔同步到記憶體快取"""
+        new_rows = []
+        base_rows = self._embedding_matrix.shape[0] if self._embedding_matrix.size else 0
+        for doc in docs:
+            doc = dict(doc)
+            embedding = doc.pop("embedding", None)
+            self._doc_cache[doc["id"]] = doc
+            if embedding is None:
+                continue
+            if self._embedding_matrix.size and len(embedding) != self._embedding_matrix.shape[1]:
+                print(f"向量維度不匹配，跳過嵌入: {doc['id']}")
+                continue
+            if doc["id"] in self._row_of:
+                row = self._row_of[doc["id"]]
+                data, scales, norms = quantize_embeddings(embedding, self.quantization)
+                self._embedding_matrix[row] = data[0]
+                self._embedding_scales[row] = scales[0]
+                self._embedding_norms[row] = norms[0]
+            else:
+                self._row_of[doc["id"]] = base_rows + len(new_rows)
+                new_rows.append(embedding)
+        if new_rows:
+            data, scales, norms = quantize_embeddings(np.array(new_rows, dtype=np.float32), self.quantization)
+            if self._embedding_matrix.size:
+                self._embedding_matrix = np.vstack([self._embedding_matrix, data])
+                self._embedding_scales = np.concatenate([self._embedding_scales, scales])
+                self._embedding_norms = np.concatenate([self._embedding_norms, norms])
+            else:
+                self._embedding_matrix = data
+                self._embedding_scales = scales
+                self._embedding_norms = norms
+    
+    def _cache_remove(self, ids: List[str]):
+        """從記憶體快取中移除文檔並壓縮嵌入矩陣"""
+        ids = set(ids)
+        for doc_id in ids:
+            self._doc_cache.pop(doc_id, None)
+        removed_rows = [self._row_of[doc_id] for doc_id in ids if doc_id in self._row_of]
+        if not removed_rows:
+            return
+        self._embedding_matrix = np.delete(self._embedding_matrix, removed_rows, axis=0)
+        self._embedding_scales = np.delete(self._embedding_scales, removed_rows)
+        self._embedding_norms = np.delete(self._embedding_norms, removed_rows)
+        remaining = sorted((row, doc_id) for doc_id, row in self._row_of.items() if doc_id not in ids)
+        self._row_of = {doc_id: new_row for new_row, (_, doc_id) in enumerate(remaining)}
+    
     def _extract_timestamp(self, content: str) -> str:
         """從文本內容中提取時間戳"""
         if not content or not isinstance(content, str):
@@ -77,10 +761,25 @@ class JSONVectorDB:
     def add(self, ids: List[str], embeddings: List[List[float]], 
             documents: List[str], metadatas: List[Dict]):
         """添加文檔到資料庫"""
+        with self._write_lock():
+            self._add(ids, embeddings, documents, metadatas)
+    
+    def _add(self, ids: List[str], embeddings: List[List[float]], 
+             documents: List[str], metadatas: List[Dict]):
+        self._write_generation += 1
+        written_docs = []
+        existing_docs = {doc["id"]: doc for doc in self.index["documents"]}
         for i in range(len(ids)):
             try:
+                dim = self.index.setdefault("embedding_dim", len(embeddings[i]))
+                if len(embeddings[i]) != dim:
+                    print(f"向量維度不匹配，跳過文檔: {ids[i]} ({len(embeddings[i])} != {dim})")
+                    continue
+                
                 # 從文檔內容中提取時間戳
-                timestamp = self._extract_timestamp(documents[i])
+                # 按工單紀錄切分的片段帶有自己的日期，從其他資料庫搬移的片段沿用原時間戳，其餘從內容中提取
+                timestamp = (metadatas[i].get("ticket_date") or metadatas[i].get("timestamp")
+                             or self._extract_timestamp(documents[i]))
                 
                 # 確保文件名是字符串類型
                 filename = str(metadatas[i].get("source", "unknown"))
@@ -91,114 +790,658 @@ class JSONVectorDB:
                     "filename": filename,
                     "original_filename": original_filename,
                     "content": documents[i],
-                    "embedding": embeddings[i],
                     "metadata": metadatas[i],
                     "timestamp": timestamp
                 }
                 
-                # 保存文檔到單獨的JSON文件
-                doc_file = os.path.join(self.db_path, f"{ids[i]}.json")
-                with open(doc_file, 'w', encoding='utf-8') as f:
-                    json.dump(doc_data, f, ensure_ascii=False, indent=2)
+                # 保存文檔到單獨的JSON文件（不含嵌入向量）
+                doc_file = self._write_document_file(doc_data)
+                written_docs.append(dict(doc_data, embedding=embeddings[i]))
                 
                 # 更新索引
-                if not any(doc["id"] == ids[i] for doc in self.index["documents"]):
-                    self.index["documents"].append({
-                        "id": ids[i],
-                        "filename": os.path.basename(filename),
-                        "original_filename": original_filename,
-                        "file_path": doc_file,
-                        "timestamp": timestamp
-                    })
-                    self.index["metadata"][ids[i]] = metadatas[i]
+                doc_info = {
+                    "id": ids[i],
+                    "filename": os.path.basename(filename),
+                    "original_filename": original_filename,
+                    "file_path": doc_file,
+                    "timestamp": timestamp
+                }
+                if ids[i] in existing_docs:
+                    # 同 id 重寫：按舊元數據移除文件目錄、片段定位器與時間分片中的條目，並讓快取失效
+                    self._catalog_remove({ids[i]})
+                    self._locator_remove({ids[i]})
+                    existing_docs[ids[i]].update(doc_info)
+                else:
+                    existing_docs[ids[i]] = doc_info
+                    self.index["documents"].append(doc_info)
+                self._catalog_add(self.index["files"], ids[i], metadatas[i])
+                self._chunk_locator.setdefault(metadatas[i].get("original_filename"), {})[metadatas[i].get("chunk_id", 0)] = ids[i]
+                self._chunk_order.pop(metadatas[i].get("original_filename"), None)
+                self._shards.setdefault(shard_key(timestamp), {})[ids[i]] = None
+                self.index["metadata"][ids[i]] = dict(metadatas[i], timestamp=timestamp)
             except Exception as e:
                 print(f"處理文檔時發生錯誤: {str(e)}")
                 continue
         
+        # 一次追加本批所有嵌入向量
+        if written_docs:
+            rows = self.embeddings.append(np.array([doc["embedding"] for doc in written_docs]))
+            for doc, row in zip(written_docs, rows):
+                self.index["embedding_rows"][doc["id"]] = row
+        
+        if self._cache_loaded:
+            self._cache_put(written_docs)
+        
         self._save_index()
     
-    def get(self, include: List[str] = None) -> Dict:
-        """獲取所有文檔"""
+    def get(self, ids: List[str] = None, where: Dict = None, include: List[str] = None,
+            limit: int = None, offset: int = 0) -> Dict:
+        """按需讀取文檔欄位
+        
+        - ids / where: 選擇片段；where 為元數據條件，如 {"file_type": "pdf"}
+          或 {"original_filename": {"$in": [...]}}
+        - include: 只讀取要求的欄位（ids、documents、metadatas、embeddings）。
+          ids 與 metadatas 直接由索引提供，不讀取片段文件；
+          embeddings 從嵌入文件讀取選中的行，以 numpy 陣列返回
+        - limit / offset: 在選擇結果上分頁（片段很多時分批讀取）
+        
+        返回的元數據（含 timestamp）與嵌入陣列都是副本，調用方修改它們不會影響索引。
+        """
         if include is None:
             include = ["documents", "metadatas", "ids"]
         
-        result = {}
-        documents = []
-        metadatas = []
-        ids = []
-        embeddings = []
+        self._refresh_if_stale()
         
-        for doc_info in self.index["documents"]:
-            doc = self._get_document(doc_info["id"])
-            if doc:
-                ids.append(doc["id"])
-                documents.append(doc["content"])
-                # 將時間戳添加到元數據中
-                metadata = doc["metadata"].copy()
-                metadata["timestamp"] = doc["timestamp"]
-                metadatas.append(metadata)
-                embeddings.append(doc["embedding"])
-        
-        if "ids" in include:
-            result["ids"] = ids
-        if "documents" in include:
-            result["documents"] = documents
-        if "metadatas" in include:
-            result["metadatas"] = metadatas
-        if "embeddings" in include:
-            result["embeddings"] = embeddings
+        with self._lock:
+            selected = self._select_ids(ids, where)
+            selected = selected[offset:offset + limit] if limit is not None else selected[offset:]
+            
+            documents = []
+            if "documents" in include:
+                kept = []
+                for doc_id in selected:
+                    doc = self._get_document(doc_id)
+                    if doc:
+                        kept.append(doc_id)
+                        documents.append(doc["content"])
+                selected = kept
+            
+            result = {}
+            if "ids" in include:
+                result["ids"] = selected
+            if "documents" in include:
+                result["documents"] = documents
+            if "metadatas" in include:
+                result["metadatas"] = [dict(self.index["metadata"][doc_id]) for doc_id in selected]
+            if "embeddings" in include:
+                result["embeddings"] = self._get_embeddings(selected)
         
         return result
     
-    def _get_document(self, doc_id: str) -> Dict:
-        """獲取特定文檔"""
+    def _select_ids(self, ids: List[str] = None, where: Dict = None) -> List[str]:
+        """按 id 列表與元數據條件選擇片段（只查索引）"""
+        metadata = self.index["metadata"]
+        if ids is not None:
+            selected = [doc_id for doc_id in ids if doc_id in metadata]
+        else:
+            selected = [doc_info["id"] for doc_info in self.index["documents"] if doc_info["id"] in metadata]
+        if where:
+            selected = [doc_id for doc_id in selected if self._match_where(metadata[doc_id], where)]
+        return selected
+    
+    @staticmethod
+    def _match_where(metadata: Dict, where: Dict) -> bool:
+        for key, condition in where.items():
+            value = metadata.get(key)
+            if isinstance(condition, dict):
+                if "$in" in condition and value not in condition["$in"]:
+                    return False
+                if "$ne" in condition and value == condition["$ne"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
+    
+    def _get_embeddings(self, ids: List[str]) -> np.ndarray:
+        """讀取指定片段的嵌入向量，沒有嵌入的片段以零向量填充"""
+        dim = self.index.get("embedding_dim") or 0
+        if self._cache_loaded and self.quantization == "float32":
+            rows = [self._row_of.get(doc_id) for doc_id in ids]
+            source = self._embedding_matrix
+        else:
+            rows = [self.index["embedding_rows"].get(doc_id) for doc_id in ids]
+            source = None
+        present = [i for i, row in enumerate(rows) if row is not None]
+        if len(present) == len(rows):
+            if source is not None:
+                return source[rows] if rows else np.zeros((0, dim), dtype=np.float32)
+            return self.embeddings.read_rows(rows, dim)
+        result = np.zeros((len(rows), dim), dtype=np.float32)
+        present_rows = [rows[i] for i in present]
+        if present_rows:
+            result[present] = source[present_rows] if source is not None else self.embeddings.read_rows(present_rows, dim)
+        return result
+    
+    def _get_document(self, doc_id: str, with_embedding: bool = False) -> Dict:
+        """獲取特定文檔（已載入快取時不讀盤），需要時附上嵌入向量"""
+        if self._cache_loaded:
+            doc = self._doc_cache.get(doc_id)
+            if doc is None:
+                return None
+            self.cache_stats['document_cache_hits'] += 1
+            doc = dict(doc)
+        else:
+            self.cache_stats['document_disk_reads'] += 1
+            doc = self._read_document_file(doc_id)
+            if doc is None:
+                return None
+            doc.pop("embedding", None)
+        if with_embedding:
+            if self._cache_loaded and self.quantization == "float32":
+                if doc_id in self._row_of:
+                    doc["embedding"] = self._embedding_matrix[self._row_of[doc_id]]
+            elif doc_id in self.index["embedding_rows"]:
+                doc["embedding"] = self._get_embeddings([doc_id])[0]
+        return doc
+    
+    def _read_document_file(self, doc_id: str) -> Dict:
+        """從磁碟讀取特定文檔"""
         doc_file = os.path.join(self.db_path, f"{doc_id}.json")
         if os.path.exists(doc_file):
             with open(doc_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
         return None
     
+    def _write_document_file(self, doc: Dict) -> str:
+        """將文檔內容與元數據寫入單獨的 JSON 文件，返回文件路徑"""
+        doc_file = os.path.join(self.db_path, f"{doc['id']}.json")
+        with open(doc_file, 'w', encoding='utf-8') as f:
+            json.dump(doc, f, ensure_ascii=False, indent=2)
+        return doc_file
+    
+    def search(self, query_embedding, n_results: int = 6, ids: List[str] = None,
+               date_range: Tuple[int, int] = None) -> List[Tuple[str, float]]:
+        """以餘弦相似度搜索，返回按相似度降序的 [(doc_id, similarity)]
+        
+        - query_embedding 可為多個查詢向量（每行一個，例如查詢改寫），
+          各片段取最高相似度，合併後去重排序
+        - ids: 只在這些片段中搜索
+        - date_range: (start, end)，YYYYMMDD 整數；只掃描與區間重疊的月份分片
+        - 分片與大型候選集合（按行切塊）在線程池中並行評分，各取前 k 個後以堆合併
+        - 已預載時在記憶體矩陣上計算；量化模式下先在壓縮矩陣上粗排，
+          再從磁碟讀取候選的 float32 向量精排
+        - 未預載時直接以記憶體映射讀取磁碟上的 float32 向量
+        """
+        self._refresh_if_stale()
+        
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query.reshape(1, -1) if query.ndim == 1 else query.reshape(query.shape[0], -1)
+        query_norms = np.linalg.norm(query, axis=1)
+        query = query[query_norms > 0] / query_norms[query_norms > 0, None]
+        if len(query) == 0 or n_results <= 0:
+            return []
+        # 單一查詢時以向量計算，與改寫前的行為一致
+        if len(query) == 1:
+            query = query[0]
+        
+        target = self._search_targets(ids, date_range, query.shape[-1])
+        if target is None:
+            return []
+        targets, matrix, norms, exact, dim = target
+        # 量化模式下粗排保留較多候選，再以 float32 精排
+        k = n_results if exact else n_results * self.rerank_factor
+        
+        def scan(work):
+            candidate_ids, rows, offset = work
+            scores = cosine_scores(matrix, rows, query, norms)
+            return [(candidate_ids[offset + i], float(scores[i])) for i in top_k_indices(scores, k)]
+        
+        # 各工作單元（分片或行塊）各取前 k 個，再以堆合併
+        per_work = parallel_map(scan, self._work_units(targets), self.search_threads)
+        hits = per_work[0] if len(per_work) == 1 else heapq.nlargest(k, chain.from_iterable(per_work), key=lambda hit: hit[1])
+        if exact:
+            return hits
+        return self._exact_rerank([doc_id for doc_id, _ in hits], query, n_results, dim)
+    
+    def search_batch(self, query_embeddings, n_results: int = 6, ids: List[str] = None,
+                     date_range: Tuple[int, int] = None) -> List[List[Tuple[str, float]]]:
+        """多個問題的批量搜索：每行一個查詢向量，各自返回 [(doc_id, similarity)]
+        
+        與逐一呼叫 search 結果相同，但每個矩陣塊只讀取一次，以一次矩陣–矩陣乘法為所有問題評分。
+        """
+        self._refresh_if_stale()
+        
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+        results = [[] for _ in range(len(queries))]
+        query_norms = np.linalg.norm(queries, axis=1)
+        valid = np.nonzero(query_norms > 0)[0]
+        if len(valid) == 0 or n_results <= 0:
+            return results
+        queries = queries[valid] / query_norms[valid, None]
+        
+        target = self._search_targets(ids, date_range, queries.shape[1])
+        if target is None:
+            return results
+        targets, matrix, norms, exact, dim = target
+        k = n_results if exact else n_results * self.rerank_factor
+        
+        def scan(work):
+            candidate_ids, rows, offset = work
+            positions, scores = batch_top_k(matrix, rows, queries, k, norms)
+            return [[(candidate_ids[offset + p], float(score)) for p, score in zip(positions[j], scores[j])]
+                    for j in range(len(queries))]
+        
+        per_work = parallel_map(scan, self._work_units(targets), self.search_threads)
+        for j, i in enumerate(valid):
+            hits = heapq.nlargest(k, chain.from_iterable(hits[j] for hits in per_work), key=lambda hit: hit[1])
+            if exact:
+                results[i] = hits
+            else:
+                results[i] = self._exact_rerank([doc_id for doc_id, _ in hits], queries[j], n_results, dim)
+        return results
+    
+    def _search_targets(self, ids: List[str], date_range: Tuple[int, int], query_dim: int):
+        """搜索所用的候選分組與矩陣: (targets, matrix, norms, exact, dim)
+        
+        targets 為 [(candidate_ids, rows)]：指定 date_range 時每個重疊的分片一組（整月在區間內的分片
+        直接使用快取的行，邊界月份逐一比對時間戳），否則只有一組。維度不符或沒有候選時返回 None。
+        """
+        with self._lock:
+            dim = self.index.get("embedding_dim")
+            if not dim or query_dim != dim:
+                print(f"向量維度不匹配: 查詢向量 {query_dim}, 資料庫 {dim}")
+                return None
+            metadata = self.index["metadata"]
+            if ids is not None:
+                if date_range is not None:
+                    ids = [doc_id for doc_id in ids if doc_id in metadata and
+                           shard_key(metadata[doc_id].get("timestamp")) != UNDATED_SHARD and
+                           date_range[0] <= int(metadata[doc_id]["timestamp"]) <= date_range[1]]
+                targets = [self._target_rows(None, ids)]
+            elif date_range is not None:
+                start, end = date_range
+                targets = []
+                for shard in sorted(self._shards):
+                    overlap = shard_overlap(shard, start, end)
+                    if overlap == "full":
+                        targets.append(self._target_cache.get(shard) or self._target_rows(shard, self._shards[shard]))
+                    elif overlap == "partial":
+                        shard_ids = [doc_id for doc_id in self._shards[shard]
+                                     if start <= int(metadata[doc_id]["timestamp"]) <= end]
+                        targets.append(self._target_rows(None, shard_ids))
+            else:
+                targets = [self._target_cache.get("*") or
+                           self._target_rows("*", [doc_info["id"] for doc_info in self.index["documents"]])]
+            targets = [target for target in targets if target[0]]
+            if self._cache_loaded:
+                matrix, norms = self._embedding_matrix, self._embedding_norms
+                exact = self.quantization == "float32"
+            else:
+                matrix, norms = self.embeddings.matrix(dim), None
+                exact = True
+        if not targets:
+            return None
+        return targets, matrix, norms, exact, dim
+    
+    def _work_units(self, targets: List) -> List[Tuple[List[str], object, int]]:
+        """把候選分組切成並行評分的工作單元 [(candidate_ids, rows, offset)]
+        
+        超過 parallel_min_rows 行的分組按連續的行平均切成最多 search_threads 塊，
+        candidate_ids[offset + i] 對應塊內第 i 行；預載矩陣與記憶體映射的磁碟矩陣皆適用。
+        """
+        units = []
+        for candidate_ids, rows in targets:
+            parts = min(self.search_threads, max(1, len(rows) // self.parallel_min_rows))
+            step = -(-len(rows) // parts)
+            for start in range(0, len(rows), step):
+                units.append((candidate_ids, rows[start:start + step], start))
+        return units
+    
+    def _target_rows(self, key, ids) -> Tuple[List[str], object]:
+        """候選片段按矩陣行排序後的 (candidate_ids, rows)，行號連續時 rows 為 range
+        
+        key 不為 None 時快取結果（呼叫時需持有鎖）。
+        """
+        row_of = self._row_of if self._cache_loaded else self.index["embedding_rows"]
+        candidates = sorted((row_of[doc_id], doc_id) for doc_id in ids if doc_id in row_of)
+        candidate_ids = [doc_id for _, doc_id in candidates]
+        rows = np.array([row for row, _ in candidates], dtype=np.int64)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            # 已排序且無重複，首尾差等於長度即為連續的行
+            rows = range(int(rows[0]), int(rows[-1]) + 1)
+        target = (candidate_ids, rows)
+        if key is not None:
+            self._target_cache[key] = target
+        return target
+    
+    def _exact_rerank(self, shortlist_ids: List[str], query: np.ndarray, n_results: int, dim: int) -> List[Tuple[str, float]]:
+        """以磁碟上的 float32 向量為粗排候選重新計算相似度"""
+        with self._lock:
+            store_rows = [self.index["embedding_rows"].get(doc_id) for doc_id in shortlist_ids]
+        pairs = [(doc_id, row) for doc_id, row in zip(shortlist_ids, store_rows) if row is not None]
+        if not pairs:
+            return []
+        exact_rows = np.array([row for _, row in pairs], dtype=np.int64)
+        exact_scores = cosine_scores(self.embeddings.matrix(dim), exact_rows, query)
+        top = top_k_indices(exact_scores, n_results)
+        return [(pairs[i][0], float(exact_scores[i])) for i in top]
+    
     def query(self, query_embeddings: List[List[float]], n_results: int = 6) -> Dict:
         """向量相似度搜索"""
-        query_vec = np.array(query_embeddings[0]).reshape(1, -1)
-        results = []
-        
-        for doc_info in self.index["documents"]:
-            doc = self._get_document(doc_info["id"])
-            if doc and "embedding" in doc:
-                doc_vec = np.array(doc["embedding"]).reshape(1, -1)
-                similarity = cosine_similarity(query_vec, doc_vec)[0][0]
-                distance = 1 - similarity
-                results.append({
-                    "document": doc["content"],
-                    "metadata": doc["metadata"],
-                    "distance": distance,
-                    "id": doc["id"]
-                })
-        
-        # 按距離排序
-        results.sort(key=lambda x: x["distance"])
-        results = results[:n_results]
+        hits = self.search(query_embeddings[0], n_results)
+        docs = self.get(ids=[doc_id for doc_id, _ in hits], include=["ids", "documents", "metadatas"])
+        similarity = dict(hits)
         
         return {
-            "documents": [[r["document"] for r in results]],
-            "metadatas": [[r["metadata"] for r in results]],
-            "distances": [[r["distance"] for r in results]],
-            "ids": [[r["id"] for r in results]]
+            "documents": [docs["documents"]],
+            "metadatas": [docs["metadatas"]],
+            "distances": [[1 - similarity[doc_id] for doc_id in docs["ids"]]],
+            "ids": [docs["ids"]]
         }
     
+    def export_state(self) -> Tuple[Dict, np.ndarray]:
+        """匯出用的一致狀態: (索引的深複本, 嵌入文件的記憶體映射)
+        
+        兩者在同一時間點取得：嵌入文件只追加（或整個原子替換），映射中的行號與索引副本始終對應。
+        """
+        self._refresh_if_stale()
+        with self._lock:
+            index = json.loads(json.dumps(self.index, ensure_ascii=False))
+            matrix = self.embeddings.matrix(self.index.get("embedding_dim"))
+        return index, matrix
+    
+    def read_document(self, doc_id: str) -> Dict:
+        """讀取片段的存儲內容（id、文件名、內容、元數據、時間戳，不含嵌入），找不到時返回 None"""
+        return self._get_document(doc_id)
+    
+    def list_shards(self) -> List[Dict]:
+        """列出時間分片（按月份排序）: [{"shard": YYYYMM, "chunks": 片段數}]，沒有日期的片段以空字串表示"""
+        self._refresh_if_stale()
+        with self._lock:
+            return [{"shard": shard, "chunks": len(ids)} for shard, ids in sorted(self._shards.items())]
+    
+    def archive_shard(self, shard: str, archive_root: str) -> int:
+        """把一個月份分片的片段移到 archive_root/<YYYYMM>（獨立的 JSONVectorDB），返回移動的片段數
+        
+        內容、元數據（含時間戳）與 float32 嵌入向量原樣複製，不需重新計算嵌入；
+        本資料庫嵌入文件中留下的舊行由壓縮工具回收。
+        """
+        if shard == UNDATED_SHARD:
+            print("沒有日期的片段不屬於任何月份分片，不能歸檔")
+            return 0
+        with self._write_lock():
+            ids = list(self._shards.get(shard, {}))
+            if not ids:
+                return 0
+            data = self.get(ids=ids, include=["ids", "documents", "metadatas", "embeddings"])
+            archive = JSONVectorDB(os.path.join(archive_root, shard), quantization="float32")
+            archive.add(data["ids"], data["embeddings"], data["documents"], data["metadatas"])
+            self._delete(data["ids"])
+        print(f"已將分片 {shard} 的 {len(data['ids'])} 個片段歸檔到 {os.path.join(archive_root, shard)}")
+        return len(data["ids"])
+    
+    def restore_shard(self, shard: str, archive_root: str) -> int:
+        """把 archive_shard 歸檔的分片移回本資料庫，返回恢復的片段數；全部恢復後刪除歸檔目錄"""
+        path = os.path.join(archive_root, shard)
+        if not os.path.exists(os.path.join(path, "index.json")):
+            print(f"找不到分片 {shard} 的歸檔: {path}")
+            return 0
+        archive = JSONVectorDB(path, quantization="float32")
+        data = archive.get(include=["ids", "documents", "metadatas", "embeddings"])
+        if not data["ids"]:
+            return 0
+        with self._write_lock():
+            self._add(data["ids"], data["embeddings"], data["documents"], data["metadatas"])
+            restored = [doc_id for doc_id in data["ids"] if doc_id in self.index["metadata"]]
+        if len(restored) == len(data["ids"]):
+            shutil.rmtree(path)
+        else:
+            print(f"分片 {shard} 有 {len(data['ids']) - len(restored)} 個片段未能恢復，保留歸檔目錄 {path}")
+        print(f"已從歸檔恢復分片 {shard} 的 {len(restored)} 個片段")
+        return len(restored)
+    
+    def storage_stats(self) -> Dict:
+        """嵌入文件的總行數、被索引引用的行數與作廢的行數"""
+        self._refresh_if_stale()
+        with self._lock:
+            rows = self.embeddings.row_count(self.index.get("embedding_dim"))
+            live = len(self.index["embedding_rows"])
+        return {"rows": rows, "live_rows": live, "dead_rows": max(rows - live, 0)}
+    
+    @contextmanager
+    def _compaction_lock(self):
+        """非阻塞的壓縮鎖，取得時產出 True；跨進程以文件鎖互斥（沒有 fcntl 的平台只在本進程內互斥）"""
+        if not self._compact_mutex.acquire(blocking=False):
+            yield False
+            return
+        try:
+            if fcntl is None:
+                yield True
+                return
+            with open(os.path.join(self.db_path, "compact.lock"), "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    yield False
+                    return
+                yield True
+        finally:
+            self._compact_mutex.release()
+    
+    def compact(self, reclaim_embeddings: bool = True, min_age: float = 600, dry_run: bool = False) -> Dict:
+        """對帳片段文件與索引、校驗並重寫嵌入文件以回收空間，返回報告
+        
+        - 索引中文件已遺失的片段從索引移除
+        - 目錄中不在索引內的片段文件、殘留的臨時索引與不再使用的嵌入文件，超過 min_age 秒未修改時刪除
+          （其他進程剛寫入、尚未登記到索引的文件不受影響）
+        - 校驗嵌入：文件大小須為 embedding_dim 的整數倍，行號須在範圍內，向量須為有限值；
+          不合格的嵌入從索引移除（片段保留，重新導入後才能被搜索到）
+        - reclaim_embeddings 時只把有效的行按時間分片順序寫入新的嵌入文件，並以索引原子切換；
+          舊文件保留 min_age 秒，讓其他進程有時間切換，之後的壓縮再刪除
+        多進程部署時同一時間只有一個進程在壓縮；複製期間資料庫有寫入時放棄本次重寫，下次再試。
+        """
+        start_time = time.time()
+        report = {
+            "dry_run": dry_run, "skipped": None,
+            "missing_files": 0, "orphan_files": 0, "stale_files": 0,
+            "invalid_embeddings": 0, "partial_row_bytes": 0,
+            "rows_before": 0, "rows_after": 0, "embedding_bytes_before": 0, "embedding_bytes_after": 0,
+            "bytes_reclaimed": 0, "bytes_pending": 0,
+        }
+        with self._compaction_lock() as acquired:
+            if not acquired:
+                report["skipped"] = "另一個進程正在壓縮"
+            else:
+                self._refresh_if_stale()
+                self._reconcile_files(report, min_age, dry_run)
+                self._rewrite_embeddings(report, reclaim_embeddings, dry_run)
+                self._remove_unused_embedding_files(report, min_age, dry_run)
+        report["seconds"] = round(time.time() - start_time, 3)
+        return report
+    
+    def _reconcile_files(self, report: Dict, min_age: float, dry_run: bool):
+        """片段文件與索引對帳：移除文件已遺失的索引條目，刪除不在索引中的舊片段文件與臨時文件"""
+        now = time.time()
+        chunk_files = {}
+        with os.scandir(self.db_path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".json") and entry.name != "index.json":
+                    chunk_files[entry.name[:-len(".json")]] = entry
+        
+        with self._write_lock():
+            indexed = {doc_info["id"] for doc_info in self.index["documents"]}
+            missing = [doc_id for doc_id in indexed if doc_id not in chunk_files
+                       and not os.path.exists(os.path.join(self.db_path, f"{doc_id}.json"))]
+            report["missing_files"] = len(missing)
+            if missing and not dry_run:
+                print(f"索引中有 {len(missing)} 個片段的文件已遺失，從索引移除")
+                self._delete(missing)
+        
+        stale = [entry for doc_id, entry in chunk_files.items() if doc_id not in indexed]
+        temp_index = f"{self.index_file}.tmp"
+        if os.path.exists(temp_index):
+            stale.append(temp_index)
+        for entry in stale:
+            path = entry if isinstance(entry, str) else entry.path
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime < min_age:
+                continue
+            report["orphan_files" if path != temp_index else "stale_files"] += 1
+            report["bytes_reclaimed"] += stat.st_size
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"刪除文件 {path} 時發生錯誤: {e}")
+    
+    def _rewrite_embeddings(self, report: Dict, reclaim: bool, dry_run: bool, block_rows: int = 16384):
+        """校驗嵌入文件，需要時把有效的行寫入新的嵌入文件並切換"""
+        with self._lock:
+            dim = self.index.get("embedding_dim")
+            if not dim:
+                return
+            generation, stamp = self._write_generation, self._write_stamp
+            store = self.embeddings
+            matrix = store.matrix(dim)
+            metadata = self.index["metadata"]
+            embedding_rows = self.index["embedding_rows"]
+            # 新文件按時間分片排列，記憶體映射掃描一個分片時讀取連續的區域
+            ordered = sorted(
+                (shard_key(metadata.get(doc_info["id"], {}).get("timestamp")), position, doc_info["id"])
+                for position, doc_info in enumerate(self.index["documents"]) if doc_info["id"] in embedding_rows
+            )
+            rows = [(doc_id, embedding_rows[doc_id]) for _, _, doc_id in ordered]
+        
+        total = matrix.shape[0]
+        file_bytes = os.path.getsize(store.path) if os.path.exists(store.path) else 0
+        report["rows_before"] = report["rows_after"] = total
+        report["embedding_bytes_before"] = report["embedding_bytes_after"] = file_bytes
+        report["partial_row_bytes"] = file_bytes - total * dim * 4
+        bad_ids = [doc_id for doc_id, row in rows if not 0 <= row < total]
+        rows = [(doc_id, row) for doc_id, row in rows if 0 <= row < total]
+        rewrite = bool(reclaim and (total > len(rows) or report["partial_row_bytes"] > 0 or bad_ids))
+        
+        new_name = f"embeddings.{int(time.time() * 1000)}.f32"
+        new_path = os.path.join(self.db_path, new_name) if rewrite and not dry_run else None
+        new_rows = {}
+        nonfinite = 0
+        try:
+            output = open(new_path, "wb") if new_path else None
+            try:
+                for start in range(0, len(rows), block_rows):
+                    block_ids = [doc_id for doc_id, _ in rows[start:start + block_rows]]
+                    block = np.asarray(matrix[[row for _, row in rows[start:start + block_rows]]], dtype=np.float32)
+                    finite = np.isfinite(block).all(axis=1)
+                    nonfinite += int((~finite).sum())
+                    bad_ids.extend(doc_id for doc_id, ok in zip(block_ids, finite) if not ok)
+                    if output is not None:
+                        output.write(np.ascontiguousarray(block[finite]).tobytes())
+                        for doc_id in (doc_id for doc_id, ok in zip(block_ids, finite) if ok):
+                            new_rows[doc_id] = len(new_rows)
+            finally:
+                if output is not None:
+                    output.close()
+        except Exception:
+            if new_path and os.path.exists(new_path):
+                os.remove(new_path)
+            raise
+        
+        report["invalid_embeddings"] = len(bad_ids)
+        if bad_ids:
+            print(f"有 {len(bad_ids)} 個片段的嵌入無效（行號超出範圍或含非有限值），需重新導入: {bad_ids[:10]}")
+        if rewrite:
+            report["rows_after"] = len(rows) - nonfinite
+            report["embedding_bytes_after"] = report["rows_after"] * dim * 4
+        if dry_run or not (new_path or bad_ids):
+            return
+        
+        with self._write_lock():
+            if self._write_generation != generation or self._write_stamp != stamp:
+                if new_path:
+                    os.remove(new_path)
+                report["skipped"] = "壓縮期間資料庫有寫入，下次再試"
+                report["rows_after"], report["embedding_bytes_after"] = total, file_bytes
+                return
+            for doc_id in bad_ids:
+                self.index["embedding_rows"].pop(doc_id, None)
+            if new_path:
+                self.index["embedding_rows"] = new_rows
+                retired = {name: retired_at for name, retired_at in self.index.get("retired_embeddings", {}).items()
+                           if os.path.exists(os.path.join(self.db_path, name))}
+                retired[os.path.basename(store.path)] = time.time()
+                self.index["retired_embeddings"] = retired
+                self.index["embeddings_file"] = new_name
+            self._save_index()
+            self._sync_embedding_store()
+        if new_path:
+            print(f"嵌入文件已重寫: {total} 行 -> {len(new_rows)} 行 ({new_name})")
+    
+    def _remove_unused_embedding_files(self, report: Dict, min_age: float, dry_run: bool):
+        """刪除不再使用的嵌入文件：壓縮後被替換超過 min_age 秒的文件，以及未被記錄的舊文件"""
+        now = time.time()
+        with self._lock:
+            current = os.path.basename(self.embeddings.path)
+            retired = dict(self.index.get("retired_embeddings", {}))
+        with os.scandir(self.db_path) as entries:
+            candidates = [entry for entry in entries if entry.is_file() and entry.name != current
+                          and entry.name.startswith("embeddings") and entry.name.endswith(".f32")]
+        for entry in candidates:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - retired.get(entry.name, stat.st_mtime) < min_age:
+                report["bytes_pending"] += stat.st_size
+                continue
+            report["stale_files"] += 1
+            report["bytes_reclaimed"] += stat.st_size
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    print(f"刪除文件 {entry.path} 時發生錯誤: {e}")
+    
     def delete_collection(self, name: str):
         """刪除集合（清空資料庫）"""
-        for doc_info in self.index["documents"]:
-            doc_file = os.path.join(self.db_path, f"{doc_info['id']}.json")
-            if os.path.exists(doc_file):
-                os.remove(doc_file)
-        
-        self.index = {"documents": [], "metadata": {}}
-        self._save_index()
+        with self._write_lock():
+            for doc_info in self.index["documents"]:
+                doc_file = os.path.join(self.db_path, f"{doc_info['id']}.json")
+                if os.path.exists(doc_file):
+                    os.remove(doc_file)
+            
+            self._write_generation += 1
+            self.embeddings.clear()
+            self.index = {"documents": [], "metadata": {}, "files": {},
+                          "embedding_rows": {}, "storage_version": STORAGE_VERSION}
+            self._sync_embedding_store()
+            self._chunk_locator = {}
+            self._chunk_order = {}
+            self._chunk_cache.clear()
+            self._shards = {}
+            self._doc_cache = {}
+            self._row_of = {}
+            self._embedding_matrix = np.zeros((0, 0), dtype=np.float32)
+            self._embedding_scales = np.zeros(0, dtype=np.float32)
+            self._embedding_norms = np.zeros(0, dtype=np.float32)
+            self._save_index()
 
     def delete(self, ids: List[str]):
         """刪除指定的文檔"""
+        with self._write_lock():
+            self._delete(ids)
+    
+    def _delete(self, ids: List[str]):
+        self._write_generation += 1
+        ids = set(ids)
+        
+        # 先更新文件目錄與片段定位器（需要用到待刪片段的元數據）
+        self._catalog_remove(ids)
+        self._locator_remove(ids)
+        
         # 創建要保留的文檔列表
         remaining_docs = []
         remaining_metadata = {}
@@ -218,9 +1461,14 @@ class JSONVectorDB:
                     except Exception as e:
                         print(f"刪除文件 {doc_file} 時發生錯誤: {e}")
         
-        # 更新索引
+        # 更新索引（嵌入文件中的舊行留待壓縮時回收）
         self.index["documents"] = remaining_docs
         self.index["metadata"] = remaining_metadata
+        for doc_id in ids:
+            self.index["embedding_rows"].pop(doc_id, None)
+        
+        if self._cache_loaded:
+            self._cache_remove(ids)
         
         # 保存更新後的索引
         self._save_index()